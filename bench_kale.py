@@ -0,0 +1,1002 @@
+# -*- coding: utf-8 -*-
+"""
+    kale benchmarks
+
+    micro-benchmarks for kale's hot paths. `python bench_kale.py` runs them
+    all, or pass the names of the ones you want, eg.
+    `python bench_kale.py collection`.
+
+    Most run in-process. The ones that need round trips use the mongod (or
+    anything speaking its protocol) at $KALE_BENCH_URI, localhost by default,
+    and are skipped if there isn't one.
+
+    Each benchmark runs `--repeat` times (3 by default) and keeps the median
+    of what it measured, since single runs of the same code can differ by
+    half. `--json results.json` saves the measurements along with the
+    versions they were taken with, and `--compare before.json after.json`
+    lists what got worse by more than `--threshold` (10% by default),
+    exiting with status 1 if anything did.
+
+    :copyright: Calama Consulting, written and maintained by uniphil
+    :license: :) see http://license.visualidiot.com/
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import timeit
+import datetime
+import platform
+import argparse
+import collections
+import bson
+import pymongo
+import kale
+
+
+# nothing here talks to the server unless it has to
+server_uri = os.environ.get('KALE_BENCH_URI', 'mongodb://localhost:27017')
+client = pymongo.MongoClient(server_uri, connect=False,
+                             serverSelectionTimeoutMS=1000)
+database = client.kale_benchmark_database
+
+# what each benchmark measured: {benchmark: {label: [median, unit, samples]}}
+results = collections.OrderedDict()
+running = [None]  # the benchmark's name
+
+# units where more is better. less is better for the rest.
+higher_is_better = frozenset(['docs/s', '%'])
+
+
+class BenchModel(kale.Model):
+    _database = database
+    _collection_name = 'bench_models'
+
+
+def server_available():
+    """Is there a mongod to run the round-trip benchmarks against?"""
+    try:
+        client.admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        print('  (no mongod at {}, skipping round trips)'.format(
+            server_uri))
+        return False
+
+
+def make_document(size):
+    """A document of roughly `size` bytes, with some nesting"""
+    section = {'heading': 'section', 'tags': ['a', 'b', 'c'],
+               'text': 'lorem ipsum ' * 8}
+    section_size = len(bson.BSON.encode(section))
+    return {
+        'title': 'benchmark',
+        'counter': 0,
+        'meta': {'author': {'name': 'alice', 'email': 'alice@example.com'}},
+        'sections': [dict(section)
+                     for _ in range(max(1, size // section_size))],
+    }
+
+
+def wide_document(width=2000):
+    """lots of small sub-documents side by side"""
+    doc = dict(('field{}'.format(i), {'n': i, 'tags': ['a', 'b']})
+               for i in range(width))
+    doc['_id'] = 'wide'
+    return doc
+
+
+def deep_document(items=500, depth=6):
+    """an array of deeply nested sub-documents"""
+    def nest(level):
+        if not level:
+            return {'leaf': True, 'values': [1, 2, 3]}
+        return {'level': level, 'child': nest(level - 1), 'siblings': [{}]}
+    return {'_id': 'deep', 'title': 'deep', 'items': [nest(depth)
+                                                      for _ in range(items)]}
+
+
+def peak_memory(fn):
+    """Peak bytes allocated while calling fn, or None without tracemalloc"""
+    try:
+        import tracemalloc
+    except ImportError:  # py2
+        return None
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def timed(fn, number=10000, repeat=5):
+    """Best per-call time of fn, in seconds"""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def record(label, value, unit, format='{:>10.3f}'):
+    """Print a measurement of the running benchmark, and keep it for --json
+    along with the ones from earlier repeats
+    """
+    print('  {:<44} {} {}'.format(label, format.format(value), unit))
+    measured = results.setdefault(running[0], collections.OrderedDict())
+    samples = measured[label][2] if label in measured else []
+    samples.append(value)
+    measured[label] = [median(samples), unit, samples]
+
+
+def report(label, seconds):
+    record(label, seconds * 1e6, 'us')
+
+
+def bench_collection():
+    """Model.collection and Collection.raw() per-call overhead"""
+    report('Collection() (uncached, before)', timed(
+        lambda: kale.Collection(BenchModel, database, 'bench_models')))
+    report('Model.collection (cached)', timed(lambda: BenchModel.collection))
+    report('pymongo Collection() (raw, uncached, before)', timed(
+        lambda: pymongo.collection.Collection(database, 'bench_models')))
+    report('Model.collection.raw() (cached)', timed(
+        lambda: BenchModel.collection.raw()))
+
+
+def bench_save_changes():
+    """Model.save() with one changed field: $set diff vs whole document"""
+    live = server_available()
+    for label, size in (('1KB', 1024), ('100KB', 100 * 1024),
+                        ('1MB', 1024 * 1024)):
+        instance = BenchModel.inflate(dict(make_document(size), _id=label))
+        instance.counter += 1
+        full = len(bson.BSON.encode(instance))
+        diff = len(bson.BSON.encode(instance.pending_changes()))
+        record('{} bytes sent, whole'.format(label), full, 'bytes', '{:>10}')
+        record('{} bytes sent, changes'.format(label), diff, 'bytes',
+               '{:>10}')
+        if not live:
+            continue
+        raw = BenchModel.collection.raw()
+        raw.replace_one({'_id': label}, instance, upsert=True)
+        number = 20
+
+        def save_whole():
+            instance.counter += 1
+            raw.replace_one({'_id': label}, instance)
+
+        def save_changes():
+            instance.counter += 1
+            instance.save()
+        instance._mark_clean()
+        report('{} save (whole, before)'.format(label),
+               timed(save_whole, number=number, repeat=3))
+        report('{} save (changes)'.format(label),
+               timed(save_changes, number=number, repeat=3))
+    if live:
+        BenchModel.collection.drop()
+
+
+def bench_lazy_inflate():
+    """Model.inflate and two field reads: eager vs _lazy_inflate"""
+    class LazyBenchModel(BenchModel):
+        _lazy_inflate = True
+
+    for label, json, read in (
+            ('wide', wide_document(), lambda m: (m.field1.n, m.field2.n)),
+            ('deep', deep_document(), lambda m: (m.title, m['items'][0]))):
+        for mode, model in (('eager', BenchModel), ('lazy', LazyBenchModel)):
+            def inflate():
+                read(model.inflate(json))
+            report('{} {} inflate+read'.format(label, mode),
+                   timed(inflate, number=20, repeat=3))
+            peak = peak_memory(inflate)
+            if peak is not None:
+                record('{} {} peak memory'.format(label, mode),
+                       peak / 1024.0, 'KB', '{:>10.1f}')
+
+
+class LegacyAttrDict(kale.AttrDict):
+    """AttrDict's dot access as it was, for comparison"""
+
+    def __getattribute__(self, attr):
+        try:
+            return object.__getattribute__(self, attr)
+        except AttributeError as attr_error:
+            try:
+                return self[attr]
+            except KeyError:
+                raise attr_error
+
+    def __setattr__(self, attr, value):
+        for cls in self.__class__.__mro__ + (self,):
+            if attr in cls.__dict__:
+                return object.__setattr__(self, attr, value)
+        self[attr] = value
+
+    def __delattr__(self, key):
+        for cls in self.__class__.__mro__ + (self,):
+            if key in cls.__dict__:
+                return object.__delattr__(self, key)
+        try:
+            del self[key]
+        except KeyError as e:
+            raise AttributeError(e)
+
+
+def bench_attribute_access():
+    """AttrDict dot access: read, write and delete"""
+    for label, cls in (('before', LegacyAttrDict), ('after', kale.AttrDict)):
+        ad = cls({'field': 1, 'nested': {'inner': 2}})
+
+        def write_delete():
+            ad.scratch = 1
+            del ad.scratch
+
+        report('{} read key'.format(label), timed(lambda: ad.field))
+        report('{} read nested key'.format(label),
+               timed(lambda: ad.nested.inner))
+        report('{} read method'.format(label), timed(lambda: ad.keys))
+        report('{} read missing'.format(label),
+               timed(lambda: getattr(ad, 'missing', None)))
+        report('{} write key'.format(label), timed(
+            lambda: setattr(ad, 'field', 2)))
+        report('{} write+delete key'.format(label), timed(write_delete))
+    instance = BenchModel.inflate({'_id': 'tracked', 'field': 1,
+                                   'nested': {'inner': 2}})
+    report('model write key (tracked)', timed(
+        lambda: setattr(instance, 'field', 2)))
+    report('model write nested key (tracked)', timed(
+        lambda: setattr(instance.nested, 'inner', 3)))
+
+
+def rate(label, fn, count):
+    """Time one call of fn, which handles `count` documents"""
+    start = timeit.default_timer()
+    fn()
+    per_second = count / (timeit.default_timer() - start)
+    record(label, per_second, 'docs/s', '{:>10.0f}')
+
+
+def bench_bulk_writes():
+    """save_many/insert_many/remove_many vs per-instance loops, docs/sec"""
+    if not server_available():
+        return
+    count = 2000
+
+    def each(method, instances):
+        return lambda: [getattr(instance, method)() for instance in instances]
+
+    def fresh():
+        BenchModel.collection.drop()
+        return [BenchModel({'n': 1}) for _ in range(count)]
+
+    rate('insert() loop', each('insert', fresh()), count)
+    instances = fresh()
+    rate('insert_many', lambda: BenchModel.insert_many(instances), count)
+    rate('save() loop (new)', each('save', fresh()), count)
+    instances = fresh()
+    rate('save_many (new)', lambda: BenchModel.save_many(instances), count)
+    for instance in instances:
+        instance.n += 1
+    rate('save() loop (changed)', each('save', instances), count)
+    for instance in instances:
+        instance.n += 1
+    rate('save_many (changed)', lambda: BenchModel.save_many(instances),
+         count)
+    half = count // 2
+    rate('remove() loop', each('remove', instances[:half]), half)
+    rate('remove_many', lambda: BenchModel.remove_many(instances[half:]),
+         half)
+    BenchModel.collection.drop()
+
+
+def bench_identity_map():
+    """Model.inflate churning through 10k rows of 1000 hot _ids"""
+    import random
+    rng = random.Random(42)
+    rows = [{'_id': rng.randrange(1000), 'n': 1} for _ in range(10000)]
+    for keep in (0, 1000):
+        class KeepModel(BenchModel):
+            _identity_map_keep = keep
+
+        def churn():
+            KeepModel.identity_map.clear()
+            for row in rows:
+                KeepModel.inflate(row)
+        report('inflate, keep={} (per row)'.format(keep),
+               timed(churn, number=3, repeat=3) / len(rows))
+        stats = KeepModel.identity_map.stats()
+        total = float(stats['hits'] + stats['misses'])
+        record('hit rate, keep={}'.format(keep), 100 * stats['hits'] / total,
+               '%', '{:>10.1f}')
+
+
+def bench_refresh_policies():
+    """re-inflating live instances under each refresh policy, rows/sec"""
+    count = 2000
+    rows = [{'_id': n, 'n': n, 'meta': {'tags': ['a', 'b'], 'v': 1}}
+            for n in range(count)]
+    changed = [dict(row, n=-row['n']) for row in rows]
+    for policy in (kale.KEEP_LOCAL, kale.OVERWRITE, kale.MERGE):
+        class PolicyModel(BenchModel):
+            _refresh_policy = policy
+
+        live = [PolicyModel.inflate(row) for row in rows]
+        for label, batch in (('unchanged', rows), ('changed', changed)):
+            for instance in live[::10]:
+                instance.n += 1  # some local changes for merge to keep
+            rate('{} inflate ({})'.format(policy, label),
+                 lambda: [PolicyModel.inflate(row) for row in batch], count)
+        if server_available():
+            PolicyModel.collection.drop()
+            PolicyModel.collection.raw().insert_many(rows)
+            rate('{} cursor scan'.format(policy),
+                 lambda: list(PolicyModel.collection.find()), count)
+            PolicyModel.collection.drop()
+
+
+def bench_cursor_scan():
+    """full-collection scan, rows/sec: per-document vs batch inflation"""
+    count = 20000
+    rows = [{'_id': n, 'name': 'row', 'n': n, 'meta': {'a': 1, 'b': {'c': 2}},
+             'tags': ['a', 'b'], 'items': [{'k': 1}, {'k': 2}]}
+            for n in range(count)]
+
+    def inflate_each_before():
+        instances = []
+        for row in rows:
+            instance = BenchModel.__new__(BenchModel)
+            kale.Model.__init__(instance, row)  # the old item-by-item build
+            instance._mark_clean()
+            instances.append(instance)
+        return instances
+
+    for label, scan in (
+            ('inflate() each (before)', inflate_each_before),
+            ('inflate() each', lambda: [BenchModel.inflate(row)
+                                        for row in rows]),
+            ('inflate_many', lambda: BenchModel.inflate_many(rows))):
+        BenchModel.identity_map.clear()
+        rate(label, scan, count)
+    if not server_available():
+        return
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many(rows)
+    scans = (
+        ('raw().find() + inflate() (before)',
+         lambda: [BenchModel.inflate(row) for row in collection.raw().find()]),
+        ('find()', lambda: list(collection.find())),
+        ('find().iter_batches(1000)',
+         lambda: list(collection.find().iter_batches(1000))),
+        ('find(inflate=False)', lambda: list(collection.find(inflate=False))))
+    for label, scan in scans:
+        BenchModel.identity_map.clear()
+        rate(label, scan, count)
+    collection.drop()
+
+
+def bench_aggregate():
+    """aggregate, rows/sec: inflating by hand vs Collection.aggregate"""
+    if not server_available():
+        return
+    count = 20000
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many([
+        {'_id': n, 'n': n, 'meta': {'a': 1, 'b': {'c': 2}},
+         'items': [{'k': 1}, {'k': 2}]} for n in range(count)])
+    pipeline = [{'$match': {'n': {'$gte': 0}}}]
+    scans = (
+        ('raw().aggregate() + inflate() (before)',
+         lambda: [BenchModel.inflate(document) for document in
+                  collection.raw().aggregate(pipeline)]),
+        ('aggregate()', lambda: list(collection.aggregate(pipeline))),
+        ('aggregate(batch_size=1000)',
+         lambda: list(collection.aggregate(pipeline, batch_size=1000))))
+    for label, scan in scans:
+        BenchModel.identity_map.clear()
+        rate(label, scan, count)
+    collection.drop()
+
+
+def bench_pipelined_scan():
+    """scan with work per row, rows/sec: find() vs find().pipeline()"""
+    if not server_available():
+        return
+    count = 10000
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many([
+        {'_id': n, 'n': n, 'meta': {'a': 1, 'b': {'c': 2}},
+         'items': [{'k': 1}, {'k': 2}]} for n in range(count)])
+
+    def waiting(instance):  # like waiting on a socket or a disk
+        time.sleep(0.00002)
+
+    def computing(instance):  # holds the GIL
+        sum(range(200))
+
+    for work_name, work in (('no work', read_fields),
+                            ('20us waiting', waiting),
+                            ('computing', computing)):
+        for label, cursor in (
+                ('find()', lambda: collection.find()),
+                ('pipeline()', lambda: collection.find().pipeline()),
+                ('pipeline(inflate=True)',
+                 lambda: collection.find().pipeline(inflate=True))):
+            BenchModel.identity_map.clear()
+            rate('{}, {}'.format(label, work_name),
+                 lambda: [work(instance)
+                          for instance in cursor().batch_size(500)], count)
+    collection.drop()
+
+
+def bench_projection():
+    """reading one field of big documents: whole vs projected, rows/sec"""
+    if not server_available():
+        return
+    count = 200
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many([dict(make_document(100 * 1024), n=n)
+                                  for n in range(count)])
+    for label, scan in (
+            ('find() whole', lambda: [m.title for m in collection.find()]),
+            ('find() projected', lambda: [m.title for m in collection.find(
+                {}, ['title'])])):
+        BenchModel.identity_map.clear()
+        rate(label, scan, count)
+    BenchModel.identity_map.clear()
+    rate('projected, then one missing field each', lambda: [
+        m.counter for m in collection.find({}, ['title'])], count)
+    BenchModel.identity_map.clear()
+    rate('... fetched together', lambda: [m.counter for m in collection.find(
+        {}, ['title'], fetch_together=True)], count)
+    collection.drop()
+
+
+def zipf_keys(keys, count, s=1.1, seed=42):
+    """`count` picks from keys, the first ones far more often than the rest"""
+    import bisect
+    import random
+    rng = random.Random(seed)
+    cumulative, total = [], 0.0
+    for rank in range(1, len(keys) + 1):
+        total += 1.0 / rank ** s
+        cumulative.append(total)
+    return [keys[bisect.bisect(cumulative, rng.random() * total)]
+            for _ in range(count)]
+
+
+def bench_query_cache():
+    """find_one by _id and by email on zipfian keys, lookups/sec"""
+    if not server_available():
+        return
+    count = 5000
+    rows = [{'_id': n, 'email': 'user{}@example.com'.format(n)}
+            for n in range(1000)]
+    BenchModel.collection.drop()
+    BenchModel.collection.raw().insert_many(rows)
+    ids = zipf_keys([row['_id'] for row in rows], count)
+    emails = zipf_keys([row['email'] for row in rows], count)
+    for size in (0, 50, 500):
+        class CachedModel(BenchModel):
+            _query_cache_size = size
+
+        find_one = CachedModel.collection.find_one
+        rate('by _id, cache size {}'.format(size),
+             lambda: [find_one(_id) for _id in ids], count)
+        rate('by email, cache size {}'.format(size),
+             lambda: [find_one({'email': email}) for email in emails], count)
+        if size:
+            stats = CachedModel.query_cache.stats()
+            record('hit rate, cache size {}'.format(size),
+                   100 * stats['hit_rate'], '%', '{:>10.1f}')
+            record('evictions, cache size {}'.format(size),
+                   stats['evictions'], 'evictions', '{:>10}')
+    BenchModel.collection.drop()
+
+
+def bench_raw_bson():
+    """reading two fields of 300KB documents: decoded vs raw BSON"""
+    from bson.codec_options import CodecOptions
+    from bson.raw_bson import RawBSONDocument
+    count = 50
+    rows = [dict(make_document(300 * 1024), _id=n) for n in range(count)]
+    data = b''.join(bson.BSON.encode(row) for row in rows)
+
+    class LazyBenchModel(BenchModel):
+        _lazy_inflate = True
+
+    class RawBenchModel(BenchModel):
+        _raw_bson = True
+
+    raw_options = CodecOptions(document_class=RawBSONDocument)
+    for label, model, options in (
+            ('decoded (before)', BenchModel, None),
+            ('decoded, lazy', LazyBenchModel, None),
+            ('raw', RawBenchModel, raw_options)):
+        def scan():
+            model.identity_map.clear()
+            documents = bson.decode_all(data, options or CodecOptions())
+            return [(m.title, m.meta.author.name)
+                    for m in model.inflate_many(documents)]
+        report('{} inflate+read (per doc)'.format(label),
+               timed(scan, number=3, repeat=3) / count)
+        peak = peak_memory(scan)
+        if peak is not None:
+            record('{} peak memory'.format(label), peak / 1024.0, 'KB',
+                   '{:>10.1f}')
+    if not server_available():
+        return
+    BenchModel.collection.drop()
+    BenchModel.collection.raw().insert_many(rows)
+    for label, model in (('find() decoded (before)', BenchModel),
+                         ('find() _raw_bson', RawBenchModel)):
+        model.identity_map.clear()
+        rate(label, lambda: [(m.title, m.meta.author.name)
+                             for m in model.collection.find()], count)
+    BenchModel.collection.drop()
+
+
+def allocations(fn):
+    """Blocks and bytes allocated by fn that are still held once it returns
+    (along with whatever it returns), and its peak bytes. None without
+    tracemalloc.
+    """
+    try:
+        import tracemalloc
+    except ImportError:  # py2
+        return None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = fn()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    del kept
+    return (sum(stat.count_diff for stat in stats),
+            sum(stat.size_diff for stat in stats), peak)
+
+
+def touch_all(value):
+    """Access every field, so everything is cast"""
+    if isinstance(value, dict):
+        for key in list(value):
+            touch_all(value[key])
+    elif isinstance(value, list):
+        for item in value:
+            touch_all(item)
+
+
+def bench_decoding():
+    """find(): dicts copied into AttrDicts vs decoded in place"""
+    if not server_available():
+        return
+    count = 200
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many([dict(make_document(10 * 1024), _id=n)
+                                  for n in range(count)])
+
+    def copied():  # what find() did before
+        return BenchModel.inflate_many(collection.find(inflate=False))
+    for label, find in (('dicts (before)', copied),
+                        ('in place', lambda: list(collection.find()))):
+        for reads, read in (('two fields', lambda m: m.meta.author.name),
+                            ('everything', touch_all)):
+            def scan():
+                BenchModel.identity_map.clear()
+                instances = find()
+                for instance in instances:
+                    read(instance)
+                return instances
+            name = '{}, {}'.format(label, reads)
+            report(name + ' (per doc)', timed(scan, number=3, repeat=3) /
+                   count)
+            counted = allocations(scan)
+            if counted is not None:
+                blocks, size, peak = counted
+                record(name + ' blocks kept', blocks, 'blocks', '{:>10}')
+                record(name + ' kept', size / 1024.0, 'KB', '{:>10.0f}')
+                record(name + ' peak', peak / 1024.0, 'KB', '{:>10.0f}')
+    collection.drop()
+
+
+class CompactBenchModel(kale.CompactModel):
+    _database = database
+    _collection_name = 'bench_models'
+    _fields = ('name', 'email', 'visits', 'active')
+
+
+def plain(value):
+    """what API code did to JSON-encode models: copy them to plain dicts"""
+    if isinstance(value, dict):
+        return dict((key, plain(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def bench_json():
+    """models to JSON: copying to plain dicts vs kale.to_json"""
+    count = 5000
+    when = datetime.datetime(2020, 1, 1)
+    data = b''.join(bson.BSON.encode({
+        '_id': bson.ObjectId(), 'n': n, 'created': when, 'title': 'row',
+        'meta': {'author': bson.ObjectId(), 'tags': ['a', 'b']},
+        'items': [{'k': k, 'at': when} for k in range(5)]})
+        for n in range(count))
+    options = BenchModel.collection.codec_options
+
+    def instances():
+        BenchModel.identity_map.clear()
+        return BenchModel.inflate_many(bson.decode_all(data, options))
+    for label, encode in (
+            ('json.dumps(plain(model)) (before)',
+             lambda models: [json.dumps(plain(model)) for model in models]),
+            ('json.dumps(dict(model), default=str)',
+             lambda models: [json.dumps(dict(model), default=str)
+                             for model in models]),
+            ('model.to_json()',
+             lambda models: [model.to_json() for model in models]),
+            ('kale.to_json(models)', kale.to_json)):
+        models = instances()  # fresh, since encoding can cast them
+        rate(label, lambda: encode(models), count)
+    if not server_available():
+        return
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many(bson.decode_all(data))
+    for label, respond in (
+            ('list(find()) + json.dumps (before)',
+             lambda: json.dumps(plain(list(collection.find())))),
+            ('find().batch_size(500).iter_json()',
+             lambda: sum(len(chunk) for chunk in
+                         collection.find().batch_size(500).iter_json())),
+            ('find(inflate=False)...iter_json(ndjson=True)',
+             lambda: sum(len(chunk) for chunk in collection.find(
+                 inflate=False).batch_size(500).iter_json(True)))):
+        BenchModel.identity_map.clear()
+        rate(label, respond, count)
+        BenchModel.identity_map.clear()
+        peak = peak_memory(respond)
+        if peak is not None:
+            record('{} peak memory'.format(label), peak / 1024.0, 'KB',
+                   '{:>10.1f}')
+    collection.drop()
+
+
+def bench_compact_models():
+    """memory per inflated instance: Model vs CompactModel's slots"""
+    count = 20000
+    documents = [{'_id': n, 'name': 'user{}'.format(n),
+                  'email': 'user{}@example.com'.format(n), 'visits': n,
+                  'active': True} for n in range(count)]
+    data = b''.join(bson.BSON.encode(document) for document in documents)
+
+    def decode():
+        return bson.decode_all(data)
+    for label, model in (('Model', BenchModel),
+                         ('CompactModel', CompactBenchModel)):
+        def load():
+            model.identity_map.clear()
+            return model.inflate_many(decode())
+        counted = allocations(load)
+        if counted is not None:
+            blocks, size, peak = counted
+            record(label, size / float(count), 'bytes/instance', '{:>10.0f}')
+        report(label + ' inflate (per doc)',
+               timed(load, number=3, repeat=3) / count)
+    counted = allocations(decode)
+    if counted is not None:
+        record('plain dicts, for reference', counted[1] / float(count),
+               'bytes/document', '{:>10.0f}')
+    for label, model in (('Model', BenchModel),
+                         ('CompactModel', CompactBenchModel)):
+        instance = model.inflate(dict(documents[0], _id='read'))
+        report(label + ' dot access', timed(lambda: instance.email))
+
+
+def bench_instrumentation():
+    """inflate_many and find: no listeners vs OperationStats"""
+    documents = [{'_id': n, 'n': n, 'tags': ['a', 'b']} for n in range(1000)]
+
+    def inflate():
+        BenchModel.identity_map.clear()
+        BenchModel.inflate_many(documents)
+    live = server_available()
+    if live:
+        BenchModel.collection.drop()
+        BenchModel.collection.raw().insert_many(documents)
+
+    def scan():
+        BenchModel.identity_map.clear()
+        list(BenchModel.collection.find())
+    for label, listener in (('no listeners', None),
+                            ('OperationStats', kale.OperationStats()),
+                            ('OperationStats(sizes=True)',
+                             kale.OperationStats(sizes=True))):
+        if listener is not None:
+            kale.add_listener(listener)
+        try:
+            report('inflate_many, {} (per doc)'.format(label),
+                   timed(inflate, number=20) / len(documents))
+            if live:
+                report('find, {} (per doc)'.format(label),
+                       timed(scan, number=5, repeat=3) / len(documents))
+        finally:
+            if listener is not None:
+                kale.remove_listener(listener)
+    if live:
+        BenchModel.collection.drop()
+
+
+def read_fields(instance):
+    """what parallel scans do with each instance. module-level, to pickle"""
+    return len(instance.meta.b) + len(instance['items'])
+
+
+def bench_parallel_scan():
+    """full-collection scan, rows/sec: one cursor vs parallel_scan"""
+    import operator
+    if not server_available():
+        return
+    count = 20000
+    collection = BenchModel.collection
+    collection.drop()
+    collection.raw().insert_many([
+        {'_id': n, 'n': n, 'meta': {'a': 1, 'b': {'c': 2}},
+         'items': [{'k': 1}, {'k': 2}]} for n in range(count)])
+    rate('one cursor', lambda: sum(read_fields(instance)
+                                   for instance in collection.find()), count)
+    for workers in (1, 2, 4, 8):
+        rate('parallel_scan, {} workers'.format(workers),
+             lambda: collection.parallel_scan(
+                 fn=read_fields, workers=workers, reduce=operator.add,
+                 initial=0), count)
+    rate('parallel_scan, 4 workers, streamed',
+         lambda: sum(collection.parallel_scan(fn=read_fields, workers=4)),
+         count)
+    collection.drop()
+
+
+class BenchAuthor(kale.Model):
+    _database = database
+    _collection_name = 'bench_authors'
+
+
+class BenchPost(kale.Model):
+    _database = database
+    _collection_name = 'bench_posts'
+    author = kale.Reference(BenchAuthor)
+
+
+def bench_references():
+    """10k-row listing with authors: find_one per row, Reference, prefetch"""
+    if not server_available():
+        return
+    count, authors = 10000, 500
+    BenchAuthor.collection.drop()
+    BenchPost.collection.drop()
+    BenchAuthor.collection.raw().insert_many(
+        [{'_id': n, 'name': 'author{}'.format(n)} for n in range(authors)])
+    BenchPost.collection.raw().insert_many(
+        [{'_id': n, 'title': 'post', 'author': n % authors}
+         for n in range(count)])
+
+    def by_find_one():
+        return [(post.title, BenchAuthor.collection.find_one(
+            post['author'])['name']) for post in BenchPost.collection.find()]
+
+    def by_reference():
+        return [(post.title, post.author.name)
+                for post in BenchPost.collection.find()]
+
+    def by_prefetch():
+        return [(post.title, post.author.name)
+                for post in BenchPost.collection.find().prefetch('author')]
+    queries = []
+
+    def count_queries(event):
+        if event.operation == 'find':
+            queries.append(event)
+    kale.add_listener(count_queries)
+    try:
+        for label, listing in (('find_one per row (before)', by_find_one),
+                               ('Reference, looked up lazily', by_reference),
+                               ('cursor.prefetch', by_prefetch)):
+            BenchAuthor.identity_map.clear()
+            BenchPost.identity_map.clear()
+            del queries[:]
+            rate(label, listing, count)
+            record(label + ' round trips', len(queries), 'queries', '{:>10}')
+    finally:
+        kale.remove_listener(count_queries)
+    BenchAuthor.collection.drop()
+    BenchPost.collection.drop()
+
+
+def bench_paging():
+    """page N of 50: skip/limit vs Collection.page's keyset tokens"""
+    if not server_available():
+        return
+    # millions, to be meaningful. set KALE_BENCH_PAGING_DOCS to change it.
+    count = int(os.environ.get('KALE_BENCH_PAGING_DOCS', 2000000))
+    size = 50
+    collection = BenchModel.collection
+    collection.drop()
+    for start in range(0, count, 10000):
+        collection.raw().insert_many(
+            [{'_id': n, 'n': n} for n in range(start, min(count,
+                                                          start + 10000))])
+    sort = [('_id', pymongo.ASCENDING)]
+    number = 1
+    while (number - 1) * size < count:
+        skip = (number - 1) * size
+        token = kale._page_token('after', [skip - 1], sort) if skip else None
+        report('page {}, skip/limit (before)'.format(number), timed(
+            lambda: list(collection.find(sort=sort, skip=skip, limit=size)),
+            number=3, repeat=3))
+        report('page {}, keyset'.format(number), timed(
+            lambda: collection.page(size=size, token=token),
+            number=3, repeat=3))
+        number *= 10
+    collection.drop()
+
+
+def bench_async_lookups():
+    """concurrent lookups by _id: AsyncCollection.get vs find_one per task"""
+    try:
+        import asyncio
+        import kale_async
+    except (ImportError, SyntaxError):  # py2
+        print('  (needs python 3.5+)')
+        return
+    if not server_available():
+        return
+
+    class AsyncBenchModel(kale_async.AsyncModel):
+        _database = database
+        _collection_name = 'bench_models'
+
+    count = 2000
+    collection = AsyncBenchModel.collection
+    collection.drop()
+    ids = collection.raw().insert_many(
+        [{'n': n} for n in range(count)]).inserted_ids
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    found = []
+
+    def find_one_each():
+        return asyncio.gather(*[
+            loop.run_in_executor(None, collection.find_one, _id)
+            for _id in ids])
+
+    def get_each():
+        return asyncio.gather(*[AsyncBenchModel.async_collection.get(_id)
+                                for _id in ids])
+
+    def run(lookups):
+        found[:] = loop.run_until_complete(lookups())  # keep them live
+
+    for label, lookups in (('find_one per task (before)', find_one_each),
+                           ('async_collection.get', get_each)):
+        del found[:]
+        AsyncBenchModel.identity_map.clear()
+        rate(label, lambda: run(lookups), count)
+    rate('async_collection.get (all live)', lambda: run(get_each), count)
+    asyncio.set_event_loop(None)
+    loop.close()
+    collection.drop()
+
+
+def environment():
+    """What the measurements were taken with"""
+    info = collections.OrderedDict([
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('pymongo', pymongo.version),
+        ('c_extensions', pymongo.has_c() and bson.has_c()),
+        ('server', None),
+    ])
+    try:
+        info['server'] = client.server_info()['version']
+    except pymongo.errors.PyMongoError:
+        pass
+    return info
+
+
+def compare(before, after, threshold):
+    """Print how each measurement changed between two --json files.
+    Returns how many got worse by more than `threshold`.
+    """
+    regressions = 0
+    for bench, measured in after['results'].items():
+        old = before['results'].get(bench, {})
+        print('{}:'.format(bench))
+        for label, measurement in measured.items():
+            value, unit = measurement[:2]  # older files have no samples
+            if label not in old or old[label][1] != unit:
+                print('  {:<44} {:>10} {} (new)'.format(label, value, unit))
+                continue
+            previous = old[label][0]
+            if not previous:
+                change = 0.0 if not value else float('inf')
+            else:
+                change = (value - previous) / float(abs(previous))
+            worse = -change if unit in higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            elif worse < -threshold:
+                flag = '  improved'
+            print('  {:<44} {:>+9.1f}%{}'.format(label, change * 100, flag))
+        for label in old:
+            if label not in measured:
+                print('  {:<44} {:>10}'.format(label, '(gone)'))
+    print('{} regression{} over {:.0%}'.format(
+        regressions, '' if regressions == 1 else 's', threshold))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='kale benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (all of them by default)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the measurements to FILE')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two --json files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change that counts as a regression')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each benchmark to take the median of')
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            return 1 if compare(json.load(before), json.load(after),
+                                args.threshold) else 0
+    benches = sorted((name[len('bench_'):], fn)
+                     for name, fn in globals().items()
+                     if name.startswith('bench_'))
+    for name, fn in benches:
+        if args.names and name not in args.names:
+            continue
+        print('{}: {}'.format(name, fn.__doc__))
+        running[0] = name
+        for run in range(args.repeat):
+            if args.repeat > 1:
+                print(' run {} of {}'.format(run + 1, args.repeat))
+            fn()
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'environment': environment(), 'results': results},
+                      out, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
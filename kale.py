@@ -10,11 +10,45 @@
 """
 
 
+import re
+import sys
 import abc
+import json
+import time
+import uuid
+import random
+import base64
+import pickle
+import socket
 import weakref
+import datetime
+import traceback
 import functools
+import itertools
+import threading
+import collections
+import multiprocessing
+import bson
+import bson.json_util
 import pymongo
 
+try:
+    from bson.raw_bson import RawBSONDocument
+except ImportError:  # pymongo < 3.2
+    RawBSONDocument = None
+
+
+try:
+    import queue as _queue
+except ImportError:  # py2
+    import Queue as _queue
+
+
+try:
+    import contextvars
+except ImportError:  # python < 3.7
+    contextvars = None
+
 
 try:
     basestring
@@ -27,6 +61,49 @@ class WrongLevel(AttributeError):
     pass
 
 
+class BulkError(pymongo.errors.PyMongoError):
+    """Some instances in a bulk write couldn't be written. `errors` pairs each
+    failed instance with the server's error document, and `unwritten` lists
+    the instances an ordered write stopped before getting to.
+    """
+
+    def __init__(self, errors, unwritten):
+        super(BulkError, self).__init__('{} failed, {} not written'.format(
+            len(errors), len(unwritten)))
+        self.errors = errors
+        self.unwritten = unwritten
+
+
+class ScanError(Exception):
+    """A worker process of a parallel_scan failed. `error` is the exception
+    it raised (if it could be sent back) and `traceback` its traceback.
+    """
+
+    def __init__(self, message, error=None, traceback=None):
+        super(ScanError, self).__init__(message)
+        self.error = error
+        self.traceback = traceback
+
+
+_missing = object()
+
+# what inflate() does with a document whose instance is already live
+KEEP_LOCAL = 'keep_local'  # hand back the instance as it is
+OVERWRITE = 'overwrite'  # replace its contents with the fresh document
+MERGE = 'merge'  # take the fresh document, except for unsaved local changes
+EVICT = 'evict'  # (for ChangeWatcher) forget the instance instead
+
+try:
+    _now = time.monotonic
+except AttributeError:  # py2
+    _now = time.time
+
+_clock = getattr(time, 'perf_counter', _now)  # for timing operations
+
+_dict_get = dict.get
+_object_getattribute = object.__getattribute__
+
+
 class GetClassProperty(property):
     """A property. On a class. Yep.
     Json R. Coombs on StackOverflow: http://stackoverflow.com/a/1383402/1299695
@@ -38,26 +115,796 @@ class GetClassProperty(property):
 classproperty = GetClassProperty
 
 
+# instrumentation. replaced whole rather than changed, so it's safe to loop
+# over without a lock. see add_listener.
+_listeners = ()
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener):
+    """Call `listener(event)` with an Event after each instrumented
+    operation: find_one, save, insert and remove, each batch a cursor gets
+    from the server (as 'find'), each batch of documents inflated, each
+    bulk write a Session flushes, and each query explained because of a
+    model's `_explain_sample` (as a QueryPlan). With no listeners, the
+    only cost is a check that there aren't any.
+
+    Listeners are called in the thread that did the operation, and should be
+    quick about it. Operations that raise aren't reported.
+    """
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+
+
+def remove_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = tuple(other for other in _listeners
+                           if other != listener)
+
+
+def _document_size(document):
+    raw = document if type(document) is RawBSONDocument else \
+        getattr(document, '_raw', None)  # a model still holding raw BSON
+    if raw is not None:
+        return len(raw.raw)
+    try:
+        return len(bson.BSON.encode(document))
+    except (bson.errors.InvalidDocument, TypeError):
+        return 0
+
+
+class Event(object):
+    """What an instrumented operation did: `operation`, the `namespace`
+    ('database.collection') it was on, its `duration` in seconds, how many
+    `documents` it handled, and, for inflating, how many were already live
+    in the identity map (`hits`) or not (`misses`).
+    """
+
+    __slots__ = ('operation', 'namespace', 'duration', 'documents', 'hits',
+                 'misses', '_documents', '_bytes')
+
+    def __init__(self, operation, namespace, duration, documents=(), hits=0,
+                 misses=0):
+        self.operation = operation
+        self.namespace = namespace
+        self.duration = duration
+        self.documents = len(documents)
+        self.hits = hits
+        self.misses = misses
+        self._documents = documents
+        self._bytes = None
+
+    @property
+    def bytes(self):
+        """Roughly how big the documents are as BSON. Worked out when it's
+        first read, by encoding any that weren't loaded as raw BSON -- so it
+        isn't free. (Don't hold on to events: they keep their documents.)
+        """
+        if self._bytes is None:
+            self._bytes = sum(_document_size(document)
+                              for document in self._documents)
+        return self._bytes
+
+    def __repr__(self):
+        return '<Event {} {}: {:.6f}s, {} documents>'.format(
+            self.operation, self.namespace, self.duration, self.documents)
+
+
+class QueryPlan(Event):
+    """An 'explain' event, for a query sampled by a model with
+    `_explain_sample` set: the `model`, the query's `shape` (as JSON, with
+    its values as '?'), the server's `plan`, and from that: the `stages`
+    of the winning plan, the `index` it used (or None), how many
+    documents and keys it `examined`, and how many it `returned`.
+
+    `problem` is 'COLLSCAN' if the plan scanned the whole collection,
+    'unselective' if it returned less than the model's
+    `_explain_selectivity` (a fraction) of what it examined, or None.
+    """
+
+    __slots__ = ('model', 'shape', 'plan', 'stages', 'index', 'examined',
+                 'returned', 'problem')
+
+    def __init__(self, model, shape, plan, duration):
+        super(QueryPlan, self).__init__('explain', model.collection.full_name,
+                                        duration)
+        self.model = model
+        self.shape = shape
+        self.plan = plan
+        winning = plan.get('queryPlanner', {}).get('winningPlan', {})
+        self.stages = []
+        self.index = None
+        stages = [winning]
+        while stages:
+            stage = stages.pop()
+            self.stages.append(stage.get('stage'))
+            self.index = self.index or stage.get('indexName')
+            stages.extend(stage.get('inputStages', ()))
+            if 'inputStage' in stage:
+                stages.append(stage['inputStage'])
+        execution = plan.get('executionStats', {})
+        self.examined = max(execution.get('totalDocsExamined', 0),
+                            execution.get('totalKeysExamined', 0))
+        self.returned = execution.get('nReturned', 0)
+        if 'COLLSCAN' in self.stages:
+            self.problem = 'COLLSCAN'
+        elif (execution and self.examined and self.returned <
+                self.examined * model._explain_selectivity):
+            self.problem = 'unselective'
+        else:
+            self.problem = None
+
+    def __repr__(self):
+        return '<QueryPlan {} {}: {}, {}>'.format(
+            self.model.__name__, self.shape, '/'.join(self.stages),
+            self.problem or 'ok')
+
+
+def _emit(operation, namespace, start, documents=(), hits=0, misses=0):
+    event = Event(operation, namespace, _clock() - start, documents, hits,
+                  misses)
+    for listener in _listeners:
+        listener(event)
+
+
+def _timed(operation):
+    """Report a Model or Collection method to the listeners, if any"""
+    def decorate(method):
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            if not _listeners:
+                return method(self, *args, **kwargs)
+            start = _clock()
+            result = method(self, *args, **kwargs)
+            if isinstance(self, Collection):  # find_one
+                namespace = self.full_name
+                documents = () if result is None else (result,)
+            else:
+                namespace, documents = self.collection.full_name, (self,)
+            _emit(operation, namespace, start, documents)
+            return result
+        return timed
+    return decorate
+
+
+class OperationStats(object):
+    """A listener that adds up events by operation and namespace in memory:
+
+        stats = kale.OperationStats()
+        kale.add_listener(stats)
+        ...
+        stats.stats()[('find_one', 'mydb.users')]['mean']
+
+    Pass `sizes=True` to total the events' bytes as well, which costs an
+    encode for each document that wasn't loaded as raw BSON.
+    """
+
+    def __init__(self, sizes=False):
+        self.sizes = sizes
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        size = event.bytes if self.sizes else 0
+        key = (event.operation, event.namespace)
+        with self._lock:
+            totals = self._totals.get(key)
+            if totals is None:
+                totals = self._totals[key] = [0, 0.0, 0.0, 0, 0, 0, 0]
+            totals[0] += 1
+            totals[1] += event.duration
+            totals[2] = max(totals[2], event.duration)
+            totals[3] += event.documents
+            totals[4] += size
+            totals[5] += event.hits
+            totals[6] += event.misses
+
+    def stats(self):
+        """Totals for each (operation, namespace) seen"""
+        with self._lock:
+            totals = dict((key, list(values))
+                          for key, values in self._totals.items())
+        return dict((key, {'count': count, 'seconds': seconds,
+                           'mean': seconds / count, 'max': longest,
+                           'documents': documents, 'bytes': size,
+                           'hits': hits, 'misses': misses})
+                    for key, (count, seconds, longest, documents, size, hits,
+                              misses) in totals.items())
+
+    def clear(self):
+        with self._lock:
+            self._totals.clear()
+
+
+class StatsdListener(object):
+    """A listener that sends each event to statsd: a timer for its duration
+    and counters for the rest, as `prefix.database.collection.operation.*`.
+    `address` is a (host, port) for UDP, or the path of a unix socket.
+    Sending is fire-and-forget; errors are ignored.
+    """
+
+    def __init__(self, address=('127.0.0.1', 8125), prefix='kale',
+                 sizes=False):
+        self.address = address
+        self.prefix = prefix
+        self.sizes = sizes
+        family = (socket.AF_UNIX if isinstance(address, basestring) else
+                  socket.AF_INET)
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+
+    def __call__(self, event):
+        name = '{}.{}.{}'.format(self.prefix, event.namespace,
+                                 event.operation)
+        lines = ['{}.time:{:.3f}|ms'.format(name, event.duration * 1000),
+                 '{}.calls:1|c'.format(name),
+                 '{}.documents:{}|c'.format(name, event.documents)]
+        if event.hits or event.misses:
+            lines.append('{}.hits:{}|c'.format(name, event.hits))
+            lines.append('{}.misses:{}|c'.format(name, event.misses))
+        if self.sizes:
+            lines.append('{}.bytes:{}|c'.format(name, event.bytes))
+        try:
+            self._socket.sendto('\n'.join(lines).encode('utf-8'),
+                                self.address)
+        except (socket.error, OSError):
+            pass
+
+    def close(self):
+        self._socket.close()
+
+
+class IdentityMap(object):
+    """The live instances of one model's documents in one collection, by _id.
+    Instances are held weakly, so they're forgotten once nothing else uses
+    them -- except for the `keep` most recently used, which are held on to.
+    """
+
+    def __init__(self, keep=0):
+        self.keep = keep
+        self.hits = self.misses = self.evictions = 0
+        self._weak = weakref.WeakValueDictionary()
+        self._strong = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, _id, default=None):
+        """The live instance for _id, or `default`. Counts as a hit or a
+        miss.
+        """
+        instance = self._weak.get(_id)
+        if instance is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        if self.keep:
+            self._hold(_id, instance)
+        return instance
+
+    def peek(self, _id):
+        """The live instance for _id, or None, without counting it"""
+        return self._weak.get(_id)
+
+    def add(self, _id, instance):
+        self._weak[_id] = instance
+        if self.keep:
+            self._hold(_id, instance)
+
+    def _hold(self, _id, instance):
+        with self._lock:
+            self._strong.pop(_id, None)
+            self._strong[_id] = instance
+            while len(self._strong) > self.keep:
+                self._strong.popitem(last=False)
+                self.evictions += 1
+
+    def evict(self, _id):
+        """Forget the instance for _id, if there is one"""
+        with self._lock:
+            self._strong.pop(_id, None)
+            self._weak.pop(_id, None)
+
+    def clear(self):
+        """Forget every instance"""
+        with self._lock:
+            self._strong.clear()
+            self._weak.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'live': len(self._weak),
+                'held': len(self._strong)}
+
+    def __contains__(self, _id):
+        return _id in self._weak
+
+    def __getitem__(self, _id):
+        return self._weak[_id]
+
+    def __setitem__(self, _id, instance):
+        self.add(_id, instance)
+
+    def __delitem__(self, _id):
+        if self.pop(_id, None) is None:
+            raise KeyError(_id)
+
+    def pop(self, _id, *default):
+        """Forget the instance for _id and return it, like dict.pop"""
+        with self._lock:
+            self._strong.pop(_id, None)
+            return self._weak.pop(_id, *default)
+
+    # the rest of the dict-like API Model._live_documents used to have.
+    # Lists, since instances can be forgotten at any time.
+    def keys(self):
+        return list(self._weak.keys())
+
+    def values(self):
+        return list(self._weak.values())
+
+    def items(self):
+        return list(self._weak.items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._weak)
+
+
+def _ids_in_filter(spec):
+    """The _ids a query is limited to, or None if it might match any"""
+    if spec is None:
+        return None
+    if not isinstance(spec, dict):
+        return [spec]  # a bare _id, like find_one takes
+    if list(spec) != ['_id']:
+        return None
+    value = spec['_id']
+    if isinstance(value, dict):
+        if list(value) == ['$in']:
+            return list(value['$in'])
+        return None
+    return [value]
+
+
+def _ids_in_documents(documents):
+    """The _ids of a document or list of documents, or None if unknown"""
+    if isinstance(documents, dict):
+        documents = [documents]
+    elif not isinstance(documents, (list, tuple)):
+        return None  # an iterator, which the write has used up
+    if not all('_id' in document for document in documents):
+        return None
+    return [document['_id'] for document in documents]
+
+
+class QueryCache(object):
+    """Recent find_one results for one model's collection, by query. Holds up
+    to `size` documents, each for at most `ttl` seconds (None for no limit).
+
+    Writes through kale invalidate the results they might have changed. A
+    lookup by _id stays cached through writes to other documents, but any
+    other lookup is dropped on every write, since we can't know which
+    documents it might match now.
+    """
+
+    def __init__(self, size=0, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.invalidations = 0
+        self.generation = 0  # bumped by every invalidate, see put
+        # key -> (expiry time, document, the _id it looked up or _missing)
+        self._entries = collections.OrderedDict()
+        self._by_id = {}  # queried _id -> keys
+        self._other = set()  # keys of lookups not by _id
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(spec, projection=None):
+        """A hashable key for a find_one query, or None if it can't be
+        cached. Field order at the top level doesn't matter.
+        """
+        if not isinstance(spec, dict):
+            spec = {'_id': spec} if spec is not None else {}
+        if projection is not None:
+            if not isinstance(projection, dict):
+                projection = dict((field, 1) for field in projection)
+            projection = bson.son.SON(sorted(projection.items()))
+        try:
+            return bson.BSON.encode({
+                'filter': bson.son.SON(sorted(spec.items())),
+                'projection': projection})
+        except (bson.errors.InvalidDocument, TypeError):
+            return None
+
+    def get(self, key):
+        """The cached document (or None) for key, and whether it was found.
+        Counts as a hit or a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and \
+                    entry[0] < _now():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self.hits += 1
+            self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[1], True
+
+    def put(self, key, spec, document, generation=None):
+        """Cache document for key -- unless there's been an invalidate since
+        `generation`, the cache's generation from before it was read, when
+        it might be from before a write.
+        """
+        ids = _ids_in_filter(spec)
+        queried_id = ids[0] if ids is not None and len(ids) == 1 else _missing
+        try:
+            hash(queried_id)
+        except TypeError:
+            queried_id = _missing
+        expires = None if self.ttl is None else _now() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, document, queried_id)
+            if queried_id is _missing:
+                self._other.add(key)
+            else:
+                self._by_id.setdefault(queried_id, set()).add(key)
+            while len(self._entries) > self.size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        queried_id = self._entries.pop(key)[2]
+        if queried_id is _missing:
+            self._other.discard(key)
+        else:
+            keys = self._by_id[queried_id]
+            keys.discard(key)
+            if not keys:
+                del self._by_id[queried_id]
+
+    def invalidate(self, ids=None):
+        """Drop results that writes to documents with these _ids might have
+        changed -- or every result, if ids is None.
+        """
+        with self._lock:
+            self.generation += 1  # even if empty: a read might be under way
+            if not self._entries:
+                return
+            self.invalidations += 1
+            try:
+                keys = set(self._other)
+                for _id in ids:
+                    keys.update(self._by_id.get(_id, ()))
+            except TypeError:  # no ids, or unhashable ones
+                keys = list(self._entries)
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_id.clear()
+            self._other.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / float(total) if total else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'cached': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class Cursor(pymongo.cursor.Cursor):
-    """inflatable"""
+    """inflatable. Documents are inflated a whole server batch at a time."""
     def __init__(self, collection, *args, **kwargs):
         super(Cursor, self).__init__(collection, *args, **kwargs)
-        self._model_class = collection._model_class
+        options = getattr(collection, '_decode_options', None)
+        if options is not None:  # see Collection.__init__
+            self._Cursor__codec_options = options
+        self._model_class = getattr(collection, '_model_class', None)
+        self._refresh_policy = None
+        self._inflate = True  # False for raw documents, see Collection.find
+        self._fetch_together = False
+        self._prefetch = ()
+        self._inflated = collections.deque()
+        self._pipeline = None  # (depth, inflate ahead?), see pipeline()
+        self._fetcher = None
+        self._explained = False  # see Model._explain_sample
 
     def next(self):
-        document = super(Cursor, self).next()
-        model_instance = self._model_class.inflate(document)
-        return model_instance
+        if self._inflated:
+            return self._inflated.popleft()
+        if self._pipeline is not None:
+            return self._next_pipelined()
+        documents = self._fetch_batch()
+        if self._inflate:
+            documents = self._inflate_batch(documents)
+        self._inflated.extend(documents)
+        return self._inflated.popleft()
+
+    def _fetch_batch(self):
+        """The rest of the server's batch, fetching another if it's empty"""
+        if not self._explained:
+            self._explained = True
+            model = self._model_class
+            if (_listeners and model is not None and model._explain_sample
+                    and random.random() < model._explain_sample):
+                self._explain_sampled()
+        # a round trip, if pymongo has nothing left from the last batch
+        start = _clock() if _listeners and not self._Cursor__data else None
+        documents = [super(Cursor, self).next()]
+        # pymongo already has the rest of the server's batch; take it too.
+        for _ in range(len(self._Cursor__data)):
+            documents.append(super(Cursor, self).next())
+        if start is not None:
+            _emit('find', self.collection.full_name, start, documents)
+        return documents
 
-    def __getitem__(self, index):
-        if isinstance(index, slice):
-            # pymongo will return an iterator, so next will be called.
-            return super(Cursor, self).__getitem__(index)
-        elif isinstance(index, int):
-            # get a particular item by index
-            document = super(Cursor, self).__getitem__(index)
-            model_instance = self._model_class.inflate(document)
-            return model_instance
+    def _explain_sampled(self):
+        """Explain the query for the listeners, as a QueryPlan event, if
+        its shape hasn't been explained before
+        """
+        model = self._model_class
+        shape = json.dumps(_query_shape(self._Cursor__spec), sort_keys=True)
+        ordering = self._Cursor__ordering
+        if ordering:
+            shape += ' sort ' + json.dumps(list(ordering.items()))
+        explained = model.collection._explained_shapes
+        if shape in explained:
+            return
+        explained.add(shape)
+        query = bson.SON([('find', self.collection.name),
+                          ('filter', self._Cursor__spec)])
+        for option, value in (('sort', ordering),
+                              ('projection', self._Cursor__projection),
+                              ('hint', self._Cursor__hint)):
+            if value:
+                query[option] = value
+        start = _clock()
+        plan = self.collection.database.command(bson.SON([
+            ('explain', query), ('verbosity', 'executionStats')]))
+        event = QueryPlan(model, shape, plan, _clock() - start)
+        for listener in _listeners:
+            listener(event)
+
+    def _inflate_batch(self, documents):
+        model, refresh = self._model_class, self._refresh_policy
+        # any projection at all might leave fields out
+        partial = bool(self._Cursor__projection)
+        if partial and not self._fetch_together:
+            instances = [model.inflate(document, refresh, partial)
+                         for document in documents]
+        else:
+            instances = model.inflate_many(documents, refresh, partial)
+        if self._prefetch:
+            model.prefetch(instances, *self._prefetch)
+        return instances
+
+    __next__ = next  # py3 iteration, which pymongo points at its own next
+
+    @property
+    def alive(self):
+        # pymongo can be done with a batch we're still handing out
+        if self._inflated:
+            return True
+        if self._fetcher is not None:
+            return self._batch_ahead()
+        return super(Cursor, self).alive
+
+    def prefetch(self, *names):
+        """Look up the instances the Reference fields `names` refer to for
+        each batch, with one `$in` query per referenced model, instead of
+        one query per instance when they're accessed.
+        """
+        self._prefetch += names
+        return self
+
+    def pipeline(self, depth=2, inflate=False):
+        """Fetch up to `depth` server batches ahead, in a background thread,
+        so the next batch is on its way while this one is worked through.
+        With `inflate=True` they're inflated there too -- refresh policies
+        are then applied to live instances from that thread.
+
+        Close the cursor (or use `with`) if you stop iterating early; the
+        thread also goes away once the cursor is garbage collected.
+        """
+        self._pipeline = (depth, inflate)
+        return self
+
+    def _next_pipelined(self):
+        if self._fetcher is None:
+            depth, ahead = self._pipeline
+            self._fetched = _queue.Queue(depth)
+            self._stopping = threading.Event()
+            self._fetcher = threading.Thread(
+                target=_fetch_ahead, args=(weakref.ref(self), self._fetched,
+                                           self._stopping, ahead))
+            self._fetcher.daemon = True
+            self._fetcher.start()
+        if self._stopping.is_set():  # finished, or closed
+            raise StopIteration
+        documents, error = self._fetched.get()
+        if documents is None:
+            self._stopping.set()
+            raise error or StopIteration()
+        if self._inflate and not self._pipeline[1]:
+            documents = self._inflate_batch(documents)
+        self._inflated.extend(documents)
+        return self._inflated.popleft()
+
+    def _batch_ahead(self):
+        """Is the fetcher's next item a batch, rather than the end? Waits
+        for it, if it's not there yet; pymongo may be done already.
+        """
+        fetched = self._fetched
+        with fetched.not_empty:
+            while not fetched.queue:
+                if self._stopping.is_set():  # finished, or closed
+                    return False
+                fetched.not_empty.wait(0.1)
+            return fetched.queue[0][0] is not None
+
+    def _stop_fetcher(self):
+        fetcher, self._fetcher = self._fetcher, None
+        if fetcher is not None:
+            self._stopping.set()
+            if fetcher is not threading.current_thread():
+                fetcher.join()
+
+    def close(self):
+        # pymongo closes exhausted cursors itself, maybe from the fetcher
+        if self._fetcher is not threading.current_thread():
+            self._stop_fetcher()
+            self._inflated.clear()
+        super(Cursor, self).close()
+
+    def iter_batches(self, size):
+        """Iterate over lists of up to `size` instances (or documents)"""
+        return _iter_batches(self, size)
+
+    def iter_json(self, ndjson=False, size=100, extended=False):
+        """The results as a JSON array (or as newline-delimited JSON, one
+        document per line), in chunks of `size` documents, for streaming
+        responses without holding them all. See kale.to_json. Set a
+        batch_size to bound how many the driver fetches at once.
+        """
+        return _iter_json(self, ndjson, size, extended)
+
+    def rewind(self):
+        self._stop_fetcher()
+        self._inflated.clear()
+        return super(Cursor, self).rewind()
+
+    def _clone_base(self, *args, **kwargs):
+        cursor = super(Cursor, self)._clone_base(*args, **kwargs)
+        cursor._refresh_policy = self._refresh_policy
+        cursor._inflate = self._inflate
+        cursor._fetch_together = self._fetch_together
+        cursor._prefetch = self._prefetch
+        cursor._pipeline = self._pipeline
+        return cursor
+
+
+def _query_shape(value):
+    """A query with its values replaced by '?', so queries that differ only
+    by the values they look for can be grouped together
+    """
+    if isinstance(value, dict):
+        return dict((key, _query_shape(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)) and value and all(
+            isinstance(item, dict) for item in value):  # $and, $or...
+        return [_query_shape(item) for item in value]
+    return '?'
+
+
+def _iter_batches(cursor, size):
+    while True:
+        batch = list(itertools.islice(cursor, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _fetch_ahead(ref, fetched, stopping, inflate):
+    """Put a Cursor's batches on the `fetched` queue, as (documents, None),
+    until (None, an error or None at the end). Only holds the cursor while
+    fetching, so it can still be collected if it's dropped.
+    """
+    while not stopping.is_set():
+        cursor = ref()
+        if cursor is None:
+            return
+        try:
+            documents = cursor._fetch_batch()
+            if inflate and cursor._inflate:
+                documents = cursor._inflate_batch(documents)
+            item = documents, None
+        except StopIteration:
+            item = None, None
+        except Exception as e:
+            item = None, e
+        del cursor
+        while True:
+            try:
+                fetched.put(item, timeout=0.1)
+                break
+            except _queue.Full:
+                if stopping.is_set() or ref() is None:
+                    return
+        if item[0] is None:
+            return
+
+
+# aggregate() stages that hand on whole documents. After any other stage,
+# the results might be missing fields, like with a projection, or not be
+# the model's documents at all.
+_whole_document_stages = frozenset(['$match', '$sort', '$limit', '$skip'])
+
+
+class AggregateCursor(pymongo.command_cursor.CommandCursor):
+    """aggregate() results, inflated a whole server batch at a time. See
+    Collection.aggregate, which makes them from pymongo's CommandCursors.
+    """
+
+    def next(self):
+        if self._inflated:
+            return self._inflated.popleft()
+        # a round trip, if pymongo has nothing left from the last batch
+        start = (_clock() if _listeners and not self._CommandCursor__data
+                 else None)
+        documents = [super(AggregateCursor, self).next()]
+        # pymongo already has the rest of the server's batch; take it too.
+        for _ in range(len(self._CommandCursor__data)):
+            documents.append(super(AggregateCursor, self).next())
+        if start is not None:
+            _emit('aggregate', self._namespace, start, documents)
+        if self._unmapped:
+            instances = self._model_class._inflate_unmapped(documents)
+        else:
+            instances = self._model_class.inflate_many(
+                documents, self._refresh_policy, self._partial)
+        self._inflated.extend(instances)
+        return self._inflated.popleft()
+
+    __next__ = next  # py3 iteration, which pymongo points at its own next
+
+    @property
+    def alive(self):
+        # see Cursor.alive
+        return bool(self._inflated) or super(AggregateCursor, self).alive
+
+    def iter_batches(self, size):
+        """Iterate over lists of up to `size` instances"""
+        return _iter_batches(self, size)
+
+    def iter_json(self, ndjson=False, size=100, extended=False):
+        """The results as a JSON array (or as newline-delimited JSON, one
+        document per line), in chunks of `size` documents, for streaming
+        responses without holding them all. See kale.to_json. Set a
+        batch_size to bound how many the driver fetches at once.
+        """
+        return _iter_json(self, ndjson, size, extended)
+
+    def close(self):
+        self._inflated.clear()
+        super(AggregateCursor, self).close()
 
 
 class Collection(pymongo.collection.Collection):
@@ -67,20 +914,481 @@ class Collection(pymongo.collection.Collection):
 
     def __init__(self, model, database, name, *args, **kwargs):
         """make sure database is a pymongo database, not a string name"""
+        self._raw_args = (database, name) + args
+        self._raw_kwargs = dict(kwargs)  # raw() is for plain documents
         super(Collection, self).__init__(database, name, *args, **kwargs)
+        # what find() and aggregate() have the driver decode documents into,
+        # straight into something inflate can use. Everything else still
+        # gets plain dicts.
+        self._decode_options = None
+        if 'codec_options' not in kwargs:
+            self._decode_options = self.codec_options._replace(
+                document_class=(RawBSONDocument if model._raw_bson else
+                                _DecodedDocument))
+        self._decoding_collection = None
         self._model_class = model
-        self.raw = lambda: pymongo.collection.Collection(
-            database, name, *args, **kwargs)
+        self.identity_map = IdentityMap(model._identity_map_keep)
+        self.query_cache = QueryCache(model._query_cache_size,
+                                      model._query_cache_ttl)
+        self._raw_collection = None
+        self._explained_shapes = set()  # see Model._explain_sample
+
+    def raw(self):
+        """The plain pymongo collection, which doesn't inflate documents.
+        Built on first use and reused after that.
+        """
+        if self._raw_collection is None:
+            self._raw_collection = pymongo.collection.Collection(
+                *self._raw_args, **self._raw_kwargs)
+        return self._raw_collection
+
+    def _decoding(self):
+        """A plain pymongo collection decoding with _decode_options, for
+        aggregate() to inflate from
+        """
+        if self._decode_options is None:
+            return self
+        if self._decoding_collection is None:
+            kwargs = dict(self._raw_kwargs,
+                          codec_options=self._decode_options)
+            self._decoding_collection = pymongo.collection.Collection(
+                *self._raw_args, **kwargs)
+        return self._decoding_collection
 
     def find(self, *args, **kwargs):
-        cursor = Cursor(self, *args, **kwargs)
+        """Like pymongo's find. Pass `refresh` to override the model's
+        `_refresh_policy` for instances that are already live, or
+        `inflate=False` to get the plain documents.
+
+        Instances found with a projection fetch the fields it left out when
+        they're first needed. Pass `fetch_together=True` to fetch them for
+        every instance from the same server batch in one query.
+        """
+        refresh = kwargs.pop('refresh', None)
+        inflate = kwargs.pop('inflate', True)
+        fetch_together = kwargs.pop('fetch_together', False)
+        cursor = Cursor(self if inflate else self.raw(), *args, **kwargs)
+        cursor._model_class = self._model_class
+        cursor._refresh_policy = refresh
+        cursor._inflate = inflate
+        cursor._fetch_together = fetch_together
         return cursor
 
+    def aggregate(self, pipeline, *args, **kwargs):
+        """Like pymongo's aggregate, but the results are inflated into the
+        model a server batch at a time as they're iterated over, like find.
+
+        Pass `model=` to inflate them into another model instead, for
+        results that aren't this model's documents (eg. from `$group` or
+        `$lookup`), or `inflate=False` for plain documents.
+
+        Unless every stage is a $match, $sort, $limit or $skip, there's no
+        telling whether the results are still this model's documents, so
+        without `model=` they're left out of the identity map and don't
+        fetch missing fields. Pass `model=` (this model, if the stages keep
+        its documents' _ids) to have them inflated as usual. `refresh` and
+        `partial` are passed on to inflate then; `partial` is True by default
+        after other stages, so missing fields are fetched and saving doesn't
+        drop them.
+
+        For big results, set `batch_size` to bound how many are held at
+        once, and `allow_disk_use=True` to let the server's stages spill to
+        disk.
+        """
+        model = kwargs.pop('model', None)
+        reshaped = any(set(stage) - _whole_document_stages
+                       for stage in pipeline)
+        unmapped = model is None and reshaped
+        model = model or self._model_class
+        refresh = kwargs.pop('refresh', None)
+        partial = kwargs.pop('partial', None)
+        if partial is None:
+            partial = reshaped
+        inflate = kwargs.pop('inflate', True)
+        if 'batch_size' in kwargs:
+            kwargs['batchSize'] = kwargs.pop('batch_size')
+        if 'allow_disk_use' in kwargs:
+            kwargs['allowDiskUse'] = kwargs.pop('allow_disk_use')
+        collection = self._decoding() if inflate else self.raw()
+        cursor = pymongo.collection.Collection.aggregate(
+            collection, pipeline, *args, **kwargs)
+        if not inflate:
+            return cursor
+        cursor.__class__ = AggregateCursor
+        cursor._model_class = model
+        cursor._unmapped = unmapped
+        cursor._refresh_policy = refresh
+        cursor._partial = partial
+        cursor._namespace = self.full_name
+        cursor._inflated = collections.deque()
+        return cursor
+
+    @_timed('find_one')
     def find_one(self, *args, **kwargs):
-        document = super(Collection, self).find_one(*args, **kwargs)
-        if document:
-            model_instance = self._model_class.inflate(document)
-            return model_instance
+        """Like pymongo's find_one, which goes through find(), so the
+        document comes back already inflated.
+
+        If the model has a `_query_cache_size`, lookups with just a filter
+        and projection (and maybe `refresh`) go through its query_cache.
+
+        Inside a Session, a lookup by _id gets the instance waiting to be
+        written (or None, if it's waiting to be removed).
+        """
+        session = _current_session()
+        if session is not None:
+            pending = session._find(self, args, kwargs)
+            if pending is not _missing:
+                return pending
+        cache = self.query_cache
+        if not cache.size or len(args) > 2 or \
+                set(kwargs) - set(['filter', 'projection', 'refresh']):
+            return super(Collection, self).find_one(*args, **kwargs)
+        spec = args[0] if args else kwargs.get('filter')
+        projection = args[1] if len(args) > 1 else kwargs.get('projection')
+        key = cache.key(spec, projection)
+        if key is None:
+            return super(Collection, self).find_one(*args, **kwargs)
+        document, found = cache.get(key)
+        if not found:
+            generation = cache.generation  # before reading, see put
+            document = super(Collection, self).find_one(
+                spec, projection, inflate=False)
+            cache.put(key, spec, document, generation)
+        if document is None:
+            return None
+        return self._model_class.inflate(document, kwargs.get('refresh'),
+                                         projection is not None)
+
+    def page(self, spec=None, size=20, sort='_id', token=None,
+             projection=None):
+        """One page of the documents matching spec, as a Page of instances.
+        Pass the page's `next_token` or `previous_token` back as `token` to
+        get the page after or before it.
+
+        Pages are found by where the last one ended in the `sort` order (a
+        key, or a list of (key, direction) pairs -- ideally indexed), not by
+        skipping, so deep pages come back as quickly as the first one, and
+        documents added or removed elsewhere don't shift the pages. _id is
+        added to the sort to break ties. Every document needs the sort keys,
+        and so does the projection, if there is one.
+        """
+        sort = _page_sort(sort)
+        direction = 'after'
+        if token is not None:
+            direction, values = _read_page_token(token, sort)
+            position = _past(values, sort, reverse=direction == 'before')
+            spec = _and(spec or {}, position)
+        order = sort
+        if direction == 'before':  # walk back from the token, then flip
+            order = [(key, -way) for key, way in sort]
+        found = list(self.find(spec, projection, sort=order, limit=size + 1))
+        more = len(found) > size
+        found = found[:size]
+        if direction == 'before':
+            found.reverse()
+        page = Page(found)
+        if found:
+            first = [_value_at(found[0], key.split('.')) for key, _ in sort]
+            last = [_value_at(found[-1], key.split('.')) for key, _ in sort]
+            if direction == 'after' and more or direction == 'before':
+                page.next_token = _page_token('after', last, sort)
+            if direction == 'before' and more or (direction == 'after' and
+                                                  token is not None):
+                page.previous_token = _page_token('before', first, sort)
+        return page
+
+    def pages(self, spec=None, size=20, sort='_id', projection=None):
+        """Iterate over every Page of the documents matching spec"""
+        page = self.page(spec, size, sort, projection=projection)
+        while True:
+            yield page
+            if page.next_token is None:
+                return
+            page = self.page(spec, size, sort, page.next_token, projection)
+
+    def partition(self, spec=None, key='_id', partitions=4):
+        """Split the documents matching spec into up to `partitions` ranges
+        of `key`, with about as many documents in each, and return a query
+        for each range. The split only depends on the data, so the same
+        documents give the same queries.
+
+        Ranges are compared the way MongoDB does, within one type, so `key`
+        should hold one type of value -- though nulls get a query of their
+        own. Documents without it aren't in any range.
+        """
+        raw = self.raw()
+        spec = spec or {}
+        count = raw.count_documents(spec)
+        bounds = []
+        for part in range(1, partitions):
+            found = list(raw.find(spec, {key: 1}).sort(key, 1)
+                         .skip(part * count // partitions).limit(1))
+            if found:
+                bound = _value_at(found[0], key.split('.'))
+                if bound not in (None, _missing) and (not bounds or
+                                                      bound != bounds[-1]):
+                    bounds.append(bound)
+        # _missing for the open ends: None is a value like any other
+        ranges = zip([_missing] + bounds, bounds + [_missing])
+        queries = []
+        for low, high in ranges:
+            condition = {}
+            if low is not _missing:
+                condition['$gte'] = low
+            if high is not _missing:
+                condition['$lt'] = high
+            queries.append(_and(spec, {key: condition or {'$exists': True}}))
+        nulls = _and(spec, {key: {'$in': [None], '$exists': True}})
+        # no range has them, though {'$exists': True} alone has everything
+        if bounds and raw.find_one(nulls, {'_id': 1}) is not None:
+            queries.insert(0, nulls)
+        return queries
+
+    def parallel_scan(self, spec=None, fn=None, workers=None, key='_id',
+                      partitions=None, reduce=None, initial=None,
+                      combine=None, chunk=1000):
+        """Scan the documents matching spec in `workers` processes (one per
+        core by default), each running its own cursors and inflating its own
+        instances. The collection is split into `partitions` (`workers` by
+        default) ranges of `key`; see partition().
+
+        Without `reduce`, returns an iterator over `fn(instance)` for every
+        instance (or the instances themselves, pickled), sent back `chunk`
+        at a time in no particular order. Workers wait while there are
+        a couple of chunks each that haven't been taken yet.
+
+        With `reduce`, each worker folds a partition's results as
+        `reduce(result, fn(instance))`, starting from the first one, and
+        the partitions' results are folded into `initial` as
+        `combine(total, result)` for the return value. `combine` is
+        `reduce` by default, which is only right if reduce is associative
+        and takes its own results, like operator.add; pass it for anything
+        else, eg. `combine=operator.add` for a `reduce` that counts.
+
+        `fn` and `reduce` are sent to the workers, so they can't be lambdas
+        or local functions. If any worker fails, ScanError is raised and the
+        rest are stopped.
+        """
+        workers = workers or multiprocessing.cpu_count()
+        queries = self.partition(spec, key, partitions or workers)
+        results = _parallel_scan(self._model_class, queries, fn, workers,
+                                 reduce, chunk)
+        if reduce is None:
+            return (item for items in results for item in items)
+        combine = combine or reduce
+        total = initial
+        for partial in results:  # [result], or [] for an empty partition
+            for result in partial:
+                total = combine(total, result)
+        return total
+
+
+class Page(list):
+    """A page of instances from Collection.page. `next_token` and
+    `previous_token` get the pages either side, and are None if there's
+    nothing there.
+    """
+
+    next_token = None
+    previous_token = None
+
+
+def _page_sort(sort):
+    """A sort (a key or (key, direction) pairs) that's unique, by _id"""
+    if isinstance(sort, basestring):
+        sort = [(sort, pymongo.ASCENDING)]
+    sort = [(key, direction) for key, direction in sort]
+    if '_id' not in [key for key, _ in sort]:
+        sort.append(('_id', pymongo.ASCENDING))
+    return sort
+
+
+def _page_token(direction, values, sort):
+    data = bson.BSON.encode({'d': direction, 'v': values,
+                             's': [list(pair) for pair in sort]})
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _read_page_token(token, sort):
+    """(direction, values) from a token, which has to be for this sort"""
+    try:
+        data = bson.BSON(base64.urlsafe_b64decode(str(token))).decode()
+        direction, values = data['d'], data['v']
+        token_sort = [tuple(pair) for pair in data['s']]
+    except Exception:
+        raise ValueError('Not a page token: {!r}'.format(token))
+    if token_sort != [tuple(pair) for pair in sort] or \
+            direction not in ('after', 'before'):
+        raise ValueError('That page token is for a different sort')
+    return direction, values
+
+
+def _past(values, sort, reverse=False):
+    """A query for what comes after (or before) values in the sort order:
+    greater on the first key, or equal on it and greater on the next...
+    """
+    alternatives = []
+    for depth, (key, direction) in enumerate(sort):
+        condition = dict((earlier, values[index]) for index, (earlier, _)
+                         in enumerate(sort[:depth]))
+        after = (direction == pymongo.ASCENDING) != reverse
+        condition[key] = {'$gt' if after else '$lt': values[depth]}
+        alternatives.append(condition)
+    return alternatives[0] if len(alternatives) == 1 else \
+        {'$or': alternatives}
+
+
+def _value_at(document, path):
+    for key in path:
+        if not isinstance(document, dict) or key not in document:
+            return _missing
+        document = document[key]
+    return document
+
+
+def _and(spec, condition):
+    return dict(spec, **condition) if not set(spec) & set(condition) else \
+        {'$and': [spec, condition]}
+
+
+def _parallel_scan(model, queries, fn, workers, reduce, chunk):
+    """Run queries in worker processes, yielding each chunk of results (or
+    each partition's reduced result) as it comes back. See parallel_scan.
+    """
+    tasks = multiprocessing.Queue()
+    for task in enumerate(queries):
+        tasks.put(task)
+    workers = min(workers, len(queries))
+    for _ in range(workers):
+        tasks.put(None)
+    # bounded, so workers block instead of piling results up in memory
+    results = multiprocessing.Queue(2 * workers)
+    processes = [multiprocessing.Process(
+        target=_scan_worker,
+        args=(model, tasks, results, fn, reduce, chunk))
+        for _ in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    remaining = len(queries)
+    try:
+        while remaining:
+            try:
+                message = results.get(timeout=1)
+            except _queue.Empty:
+                dead = [process for process in processes
+                        if process.exitcode not in (None, 0)]
+                if dead:
+                    raise ScanError('A worker exited with code {}'.format(
+                        dead[0].exitcode))
+                continue
+            kind, value = message
+            if kind == 'error':
+                error, trace = value
+                raise ScanError('A worker failed:\n' + trace, error, trace)
+            if kind == 'done':
+                remaining -= 1
+            yield value
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def _scan_worker(model, tasks, results, fn, reduce, chunk):
+    """Scan partitions in a worker process until there are no more"""
+    try:
+        database = model._database
+        duplicate = getattr(database.client, '_duplicate', None)
+        if duplicate is not None:  # a client from before forking isn't safe
+            model._database = duplicate(connect=False)[database.name]
+        for _, query in iter(tasks.get, None):
+            batch = []  # with reduce, just the partition's result so far
+            for instance in model.collection.find(query):
+                value = instance if fn is None else fn(instance)
+                if reduce is None:
+                    batch.append(value)
+                    if len(batch) >= chunk:
+                        results.put(('items', batch))
+                        batch = []
+                elif batch:
+                    batch[0] = reduce(batch[0], value)
+                else:  # initial is only folded in once, by the parent
+                    batch.append(value)
+            results.put(('done', batch))
+    except Exception as e:
+        trace = traceback.format_exc()
+        try:
+            pickle.dumps(e)
+        except Exception:  # the parent gets the traceback, at least
+            e = None
+        results.put(('error', (e, trace)))
+
+
+def _invalidating(name, affected):
+    """Wrap a pymongo write method to invalidate the query cache for the
+    documents it might have changed. `affected` gets the method's arguments,
+    after the call, and returns their _ids or None for any.
+    """
+    method = getattr(pymongo.collection.Collection, name)
+
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if self.query_cache.size:
+                self.query_cache.invalidate(affected(*args, **kwargs))
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def _filter_affected(spec=None, *args, **kwargs):
+    for name in ('filter', 'spec', 'spec_or_id'):
+        spec = kwargs.get(name, spec)
+    return _ids_in_filter(spec)
+
+
+def _documents_affected(documents=None, *args, **kwargs):
+    for name in ('document', 'documents', 'to_save', 'doc_or_docs'):
+        documents = kwargs.get(name, documents)
+    return _ids_in_documents(documents)
+
+
+def _requests_affected(requests=None, *args, **kwargs):
+    ids = []
+    for request in kwargs.get('requests', requests):
+        if isinstance(request, pymongo.InsertOne):
+            found = _ids_in_documents(request._doc)
+        else:
+            found = _ids_in_filter(getattr(request, '_filter', None))
+        if found is None:
+            return None
+        ids.extend(found)
+    return ids
+
+
+for _name, _affected in (
+        ('insert_one', _documents_affected),
+        ('insert_many', _documents_affected),
+        ('save', _documents_affected),
+        ('insert', _documents_affected),
+        ('replace_one', _filter_affected),
+        ('update_one', _filter_affected),
+        ('update_many', _filter_affected),
+        ('update', _filter_affected),
+        ('delete_one', _filter_affected),
+        ('delete_many', _filter_affected),
+        ('remove', _filter_affected),
+        ('find_one_and_delete', _filter_affected),
+        ('find_one_and_replace', _filter_affected),
+        ('find_one_and_update', _filter_affected),
+        ('bulk_write', _requests_affected),
+        ('drop', lambda *args, **kwargs: None)):
+    if hasattr(pymongo.collection.Collection, _name):  # not in every 3.x
+        setattr(Collection, _name, _invalidating(_name, _affected))
 
 
 def collectionmethod(fn):
@@ -91,34 +1399,302 @@ def collectionmethod(fn):
     return wrapper
 
 
-class AttrDict(dict):
+class TrackedList(list):
+    """A list that tells the AttrDict holding it when it changes.
+    Lists are saved whole, so any change dirties the list's own key.
+    """
+
+    _owner = None
+
+    def _changed(self, path=()):
+        owner = self._owner
+        if owner is not None:
+            container, key = owner[0](), owner[1]
+            if container is not None and container._stored(key) is self:
+                container._changed((key,))
+
+    def __getstate__(self):
+        """owner links are weakrefs, which don't pickle"""
+        state = self.__dict__.copy()
+        state.pop('_owner', None)
+        return state
+
+
+def _tracked(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'reverse', 'sort', 'clear'):
+    if hasattr(list, _name):  # py2 lists have no clear, py3 no *slice
+        setattr(TrackedList, _name, _tracked(_name))
+
+
+def _iso_datetime(value):
+    # bson's naive datetimes are UTC
+    return value.isoformat() + ('Z' if value.utcoffset() is None else '')
+
+
+# how to_json writes what json can't, by type
+_json_converters = {
+    bson.ObjectId: str,
+    datetime.datetime: _iso_datetime,
+    uuid.UUID: str,
+    bson.Binary: lambda value: base64.b64encode(value).decode('ascii'),
+}
+if hasattr(bson, 'Decimal128'):  # pymongo 3.4+
+    _json_converters[bson.Decimal128] = str
+if bytes is not str:  # py3. on py2 they're just strings.
+    _json_converters[bytes] = _json_converters[bson.Binary]
+
+
+def _json_default(value):
+    converter = _json_converters.get(type(value))
+    if converter is not None:
+        return converter(value)
+    if isinstance(value, datetime.datetime):
+        return _iso_datetime(value)
+    if RawBSONDocument is not None and isinstance(value, RawBSONDocument):
+        return dict(value)
+    return bson.json_util.default(value)  # MongoDB extended JSON for others
+
+
+def _extended_json_default(value):
+    if RawBSONDocument is not None and isinstance(value, RawBSONDocument):
+        return dict(value)  # _raw_bson models' sub-documents, still raw
+    return bson.json_util.default(value)
+
+
+class _Encoding(threading.local):
+    # to_json is reading documents as they're stored: anything lazy
+    # inflating left uncast is as good as cast for json, and cheaper.
+    raw = False
+
+
+_encoding = _Encoding()
+_json_encoder = json.JSONEncoder(separators=(',', ':'),
+                                 default=_json_default)
+_extended_json_encoder = json.JSONEncoder(separators=(',', ':'),
+                                          default=_extended_json_default)
+
+
+def to_json(value, extended=False):
+    """Models, AttrDicts, lists of them... as compact JSON, encoded straight
+    from the documents without copying them. ObjectIds, UUIDs and
+    Decimal128s are written as strings, datetimes in ISO 8601 and binary
+    data in base64. Pass `extended=True` for MongoDB extended JSON
+    (`{"$oid": ...}`) instead.
+    """
+    encoder = _extended_json_encoder if extended else _json_encoder
+    _encoding.raw = True
+    try:
+        if sys.version_info < (3,):
+            # py2's C encoder reads dicts directly, missing CompactModel
+            # fields. its python one goes through iteritems.
+            return ''.join(encoder.iterencode(value))
+        return encoder.encode(value)
+    finally:
+        _encoding.raw = False
+
+
+def _iter_json(cursor, ndjson, size, extended):
+    encode = functools.partial(to_json, extended=extended)
+    if ndjson:
+        for batch in _iter_batches(cursor, size):
+            yield ''.join([encode(document) + '\n' for document in batch])
+        return
+    separator = '['
+    for batch in _iter_batches(cursor, size):
+        yield separator + encode(batch)[1:-1]
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+class _AttrDictType(type):
+    """Gives each AttrDict class `_attr_names`: every name defined on it or
+    its bases, which dot access should leave to the class (methods,
+    descriptors and so on) rather than treat as document keys. It's kept in
+    the class's own __dict__, and worked out again for the class and its
+    subclasses whenever an attribute is set on or deleted from it.
+    """
+
+    def __init__(cls, name, bases, namespace):
+        super(_AttrDictType, cls).__init__(name, bases, namespace)
+        cls._find_attr_names()
+
+    def _find_attr_names(cls):
+        names = frozenset(dir(cls)) | frozenset(['_attr_names'])
+        type.__setattr__(cls, '_attr_names', names)
+        for subclass in cls.__subclasses__():
+            subclass._find_attr_names()
+
+    def __setattr__(cls, attr, value):
+        super(_AttrDictType, cls).__setattr__(attr, value)
+        cls._find_attr_names()
+
+    def __delattr__(cls, attr):
+        super(_AttrDictType, cls).__delattr__(attr)
+        cls._find_attr_names()
+
+
+class AttrDict(_AttrDictType('AttrDict', (dict,), {'__slots__': ()})):
     """A dictionary whose keys are accessible with dot notation
     cool __setitem__ -> http://stackoverflow.com/a/2588648/1299695
+
+    Nested AttrDicts and TrackedLists keep a weak link back to whatever holds
+    them, so a change anywhere in the tree is reported up to the top as a
+    path of keys. Models use that to save only what changed.
     """
 
+    _owner = None
+    _lazy = False  # might still hold dicts and lists as the driver made them
+
+    # the items as they're stored, without casting or change tracking.
+    # models with declared fields keep those somewhere else (CompactModel).
+    _stored = dict.get
+    _has = dict.__contains__
+    _store = dict.__setitem__
+    _store_all = dict.update
+    _store_clear = dict.clear
+
     def __init__(self, *args, **kwargs):
         self.update(*args, **kwargs)
 
+    def __getitem__(self, key):
+        value = super(AttrDict, self).__getitem__(key)
+        if type(value) in _uncast_types:
+            # left as-is by a lazy inflate. wrap it now, and keep the wrapper.
+            value = self._wrap(key, value)
+            super(AttrDict, self).__setitem__(key, value)
+        return value
+
     def __setitem__(self, key, value):
+        super(AttrDict, self).__setitem__(key, self._cast(key, value))
+        self._changed((key,))
+
+    def _cast(self, key, value):
+        """value as it should be stored at key: dicts become AttrDicts and
+        iterables TrackedLists, linked back to this AttrDict.
+        """
         if isinstance(value, dict):
-            if not isinstance(value, AttrDict):
-                value = AttrDict(value)
-        elif not isinstance(value, basestring):
+            if type(value) is _DecodedDocument:
+                _adopt(value)
+            elif not isinstance(value, AttrDict):
+                value = AttrDict._filled(value)
+            object.__setattr__(value, '_owner', (weakref.ref(self), key))
+        elif (hasattr(value, '__iter__') and
+                not isinstance(value, (basestring, set, frozenset))):
+            # sets stay sets: they have no order, and bson can't store them.
             try:
-                value = [AttrDict._try_attrdict(v) for v in value]
+                value = TrackedList(AttrDict._try_attrdict(v) for v in value)
             except TypeError:
                 """ignore iterables"""
-        super(AttrDict, self).__setitem__(key, value)
+            else:
+                value._owner = (weakref.ref(self), key)
+                list_owner = (weakref.ref(value), None)
+                for item in value:
+                    if isinstance(item, AttrDict):
+                        object.__setattr__(item, '_owner', list_owner)
+        return value
+
+    def _fill(self, items):
+        """Cast and set every item of a dict without reporting any changes.
+        For building AttrDicts that nothing could be tracking yet.
+        """
+        cast = AttrDict._cast  # not self._cast, which is a slow lookup
+        for key in items:
+            dict.__setitem__(self, key, cast(self, key, items[key]))
+
+    @classmethod
+    def _filled(cls, items):
+        instance = dict.__new__(cls)
+        AttrDict._fill(instance, items)
+        return instance
+
+    def __delitem__(self, key):
+        super(AttrDict, self).__delitem__(key)
+        self._changed((key,))
+
+    def _changed(self, path):
+        """Pass a changed key path up to whatever holds this AttrDict"""
+        owner = self._owner
+        if owner is not None:
+            container, key = owner[0](), owner[1]
+            # list items (key None) report the whole list. other values only
+            # count if they haven't been replaced or removed from their owner.
+            if container is not None and (
+                    key is None or container._stored(key) is self):
+                container._changed((key,) + path)
+
+    @classmethod
+    def _lazy_from(cls, raw, owner=None):
+        """An AttrDict of a plain dict's (or raw BSON document's) items,
+        without casting any of them until they're accessed.
+        """
+        instance = cls.__new__(cls)
+        dict.update(instance, raw)
+        object.__setattr__(instance, '_lazy', True)
+        if owner is not None:
+            object.__setattr__(instance, '_owner', owner)
+        return instance
+
+    def _wrap(self, key, value):
+        """Cast a document or list left as-is by a lazy inflate. Its own
+        documents and lists are left for later.
+        """
+        if type(value) is _DecodedDocument:
+            return _adopt(value, (weakref.ref(self), key))
+        if type(value) is not list:
+            return AttrDict._lazy_from(value, (weakref.ref(self), key))
+        items = TrackedList()
+        items._owner = (weakref.ref(self), key)
+        item_owner = (weakref.ref(items), None)
+        for item in value:
+            if type(item) is _DecodedDocument:
+                item = _adopt(item, item_owner)
+            elif type(item) is dict or type(item) is RawBSONDocument:
+                item = AttrDict._lazy_from(item, item_owner)
+            else:
+                item = AttrDict._try_attrdict(item)
+                if isinstance(item, AttrDict):
+                    object.__setattr__(item, '_owner', item_owner)
+            list.append(items, item)
+        return items
+
+    def _inflate_all(self):
+        """Cast anything a lazy inflate left as-is, one level deep"""
+        if self._lazy:
+            for key in list(self):
+                self[key]
+            object.__setattr__(self, '_lazy', False)
 
     @classmethod
     def _try_attrdict(cls, thing):
         """cast a thing to attrdict if possible"""
+        if type(thing) is _DecodedDocument:
+            return _adopt(thing)
+        if isinstance(thing, AttrDict):
+            return thing
+        if isinstance(thing, basestring) or not hasattr(thing, '__iter__'):
+            """numbers and friends, no need to try"""
+            return thing
         if not thing and not isinstance(thing, dict):
             """don't cast empty non-dict iterables"""
             return thing
+        if type(thing) is dict and cls is AttrDict:
+            return AttrDict._filled(thing)
         try:
             return cls(thing)
-        except ValueError:
+        except (TypeError, ValueError):
             return thing
 
     def update(self, *args, **kwargs):
@@ -133,41 +1709,177 @@ class AttrDict(dict):
             self[key] = value
         return self[key]
 
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(AttrDict, self).pop(key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = super(AttrDict, self).popitem()
+        if type(value) in _uncast_types:
+            value = self._wrap(key, value)
+        self._changed((key,))
+        return key, value
+
+    def __iter__(self):
+        # not dict's own: with it, dict(d), {**d} and update(d) would copy
+        # our storage directly, handing out whatever a lazy inflate left
+        # uncast -- and changes to that would never be saved. py3 only;
+        # py2 always copies directly.
+        return dict.__iter__(self)
+
+    def values(self):
+        self._inflate_all()
+        return super(AttrDict, self).values()
+
+    def items(self):
+        if not _encoding.raw:
+            self._inflate_all()
+        return super(AttrDict, self).items()
+
+    def copy(self):
+        self._inflate_all()
+        return super(AttrDict, self).copy()
+
+    def to_json(self, extended=False):
+        """The document as compact JSON. See kale.to_json."""
+        return to_json(self, extended)
+
+    def clear(self):
+        for key in list(self):
+            self._changed((key,))
+        super(AttrDict, self).clear()
+
+    def __getstate__(self):
+        """owner links are weakrefs, which don't pickle. They're rebuilt as
+        the items are restored.
+        """
+        state = self.__dict__.copy()
+        state.pop('_owner', None)
+        return state
+
     def __getattribute__(self, attr):
         """Access items with dot notation."""
-        try:
-            return object.__getattribute__(self, attr)
-        except AttributeError as attr_error:
-            try:
-                return super(AttrDict, self).__getitem__(attr)
-            except KeyError:
-                raise attr_error
+        if attr in type(self)._attr_names:
+            return _object_getattribute(self, attr)
+        value = _dict_get(self, attr, _missing)
+        if value is _missing:
+            return self._missing_attribute(attr)
+        if type(value) in _uncast_types:
+            return self[attr]
+        return value
+
+    def _missing_attribute(self, attr):
+        """Dot access to something that's neither a key nor an attribute"""
+        # raises the usual AttributeError
+        return _object_getattribute(self, attr)
 
     def __setattr__(self, attr, value):
         """Set items with dot notation"""
         # check for class stuff, like descripters, before hijacking.
         # http://stackoverflow.com/a/9161707/1299695
-        for cls in self.__class__.__mro__ + (self,):
-            if attr in cls.__dict__:
-                return object.__setattr__(self, attr, value)
+        if attr in type(self)._attr_names:
+            return object.__setattr__(self, attr, value)
         self[attr] = value
 
     def __delattr__(self, key):
         """Delete items with dot notation"""
         # see AttrDict.__setattr__()
-        for cls in self.__class__.__mro__ + (self,):
-            if key in cls.__dict__:
-                return object.__delattr__(self, key)
+        if key in type(self)._attr_names:
+            return object.__delattr__(self, key)
         try:
-            return super(AttrDict, self).__delitem__(key)
+            del self[key]
         except KeyError as e:  # it was accessed as an attribute.
             raise AttributeError(e)
 
 
+class _DecodedDocument(AttrDict):
+    """What kale's collections have the driver decode documents into. Items
+    are set without any casting or change tracking, so decoding is as cheap
+    as it is for plain dicts. Each one becomes an ordinary AttrDict (or the
+    model itself) in place when it's first used. See _adopt.
+    """
+
+    __init__ = dict.__init__
+    __setitem__ = dict.__setitem__
+    # the driver reads its replies' cursors and batches through this; they
+    # mustn't be adopted on the way, or inflate would have to copy them.
+    __getitem__ = dict.__getitem__
+
+
+def _adopt(document, owner=None):
+    """Make a document the driver decoded into an AttrDict, without copying.
+    Its own sub-documents are left for later, like a lazy inflate's.
+    """
+    object.__setattr__(document, '__class__', AttrDict)
+    object.__setattr__(document, '_lazy', True)
+    if owner is not None:
+        object.__setattr__(document, '_owner', owner)
+    return document
+
+
+# what a lazy inflate leaves as the driver made it, to be cast on access
+_uncast_types = frozenset([dict, list, RawBSONDocument, _DecodedDocument])
+
+_document_types = tuple(cls for cls in (dict, RawBSONDocument) if cls)
+
+# what a model's _dirty is until something changes, so unchanged instances
+# don't each need a set of their own
+_clean = frozenset()
+
+
+def _merge_document(target, source, overwrite, skip=(), path=()):
+    """Copy a document's fields into a (possibly partly) loaded one, without
+    reporting changes. Sub-documents on both sides are merged, other fields
+    already in target are only replaced if `overwrite`, and the key paths in
+    `skip` are left alone.
+    """
+    for key in source:
+        here = path + (key,)
+        if here in skip:
+            continue
+        value = source[key]
+        if key in target:
+            if type(target) is dict:
+                current = dict.__getitem__(target, key)
+            else:
+                current = target[key]  # cast if it was left raw
+            if (isinstance(current, dict) and
+                    isinstance(value, _document_types)):
+                _merge_document(current, value, overwrite, skip, here)
+                continue
+            if not overwrite:
+                continue
+        if type(target) is dict:  # plain dicts are left for lazy casting
+            dict.__setitem__(target, key, value)
+        else:
+            target._store(key, AttrDict._cast(target, key, value))
+
+
 class Model(AttrDict):
     """Helper methods and properties."""
 
-    _live_documents = weakref.WeakValueDictionary()
+    _collection_lock = threading.Lock()
+    _identity_map_keep = 0  # recently used instances to hold on to
+    _query_cache_size = 0  # find_one results to cache. see QueryCache.
+    _query_cache_ttl = None  # seconds to keep them for, or None for ever
+    _refresh_policy = KEEP_LOCAL  # see inflate()
+    _dirty = None  # changed key paths, or None if not known to be in the db
+    _lazy_inflate = False  # cast nested documents only when accessed
+    _partial = None  # instances loaded with this one from a projection
+    _raw_bson = False  # load documents as raw BSON, decoding fields on access
+    _raw = None  # the raw BSON document, until anything changes
+    _resolved = None  # {key: (_ids, instances)} for Reference fields
+    _indexes = ()  # keys or pymongo.IndexModels, see provision_indexes()
+    _explain_sample = 0  # fraction of queries to explain. see QueryPlan.
+    _explain_selectivity = 0.1  # report plans returning less than this
 
     def __new__(cls, *args, **kwargs):
         """Return an instance of the class.
@@ -192,45 +1904,1348 @@ class Model(AttrDict):
     @classproperty
     @classmethod
     def collection(cls):
-        """Return the pymongo collection storing instances of the model."""
-        return Collection(cls, cls._database, cls._collection_name)
+        """Return the pymongo collection storing instances of the model.
+        It's built once per model class, and rebuilt if the class's
+        `_database` or `_collection_name` are changed.
+        """
+        database, name = cls._database, cls._collection_name
+        # look in the class's own __dict__ so subclasses don't share a cache
+        cached = cls.__dict__.get('_collection_cache')
+        # databases compare equal by client and name, even if `_database`
+        # makes a new one each time -- but that's slow, so try `is` first
+        if cached is None or cached[1] != name or (
+                cached[0] is not database and cached[0] != database):
+            with cls._collection_lock:
+                cached = cls.__dict__.get('_collection_cache')
+                if cached is None or cached[1] != name or (
+                        cached[0] is not database and cached[0] != database):
+                    cached = (database, name, Collection(cls, database, name))
+                    cls._collection_cache = cached
+        return cached[2]
+
+    @classproperty
+    @classmethod
+    def identity_map(cls):
+        """The model's live instances, which inflate() hands back instead of
+        making duplicates. See IdentityMap.
+        """
+        return cls.collection.identity_map
+
+    _live_documents = identity_map  # the old name
 
+    @classproperty
+    @classmethod
+    def query_cache(cls):
+        """The model's cache of find_one results. See QueryCache."""
+        return cls.collection.query_cache
+
+    @_timed('save')
     def save(self, *args, **kwargs):
         """Create or update the instance in the database. Returns the pymongo
         ObjectId. See :meth: pymongo.collection.Collection.save.
+
+        Instances loaded from or already saved to the database only send the
+        fields that changed, as a `$set`/`$unset` update. New instances, and
+        saves with extra arguments for pymongo, replace the whole document --
+        after fetching any fields a projection left out.
+
+        Inside a Session, the save waits for the session's flush (unless
+        there are extra arguments).
         """
-        _id = self.collection.save(self, *args, **kwargs)
-        self._live_documents[_id] = self
+        session = _current_session()
+        if session is not None and not args and not kwargs:
+            return session.save(self)
+        if self._dirty is None or '_id' not in self or args or kwargs:
+            self._fetch_missing()
+            _id = self.collection.save(self._whole_document(), *args,
+                                       **kwargs)
+        else:
+            _id = self['_id']
+            changes = self.pending_changes()
+            if changes:
+                result = self.collection.update_one({'_id': _id}, changes)
+                if result.acknowledged and not result.matched_count:
+                    # someone removed it behind our back. put it all back.
+                    self._fetch_missing()
+                    self.collection.save(self)
+        self.identity_map.add(_id, self)
+        self._mark_clean()
         return _id
 
+    @_timed('insert')
     def insert(self, *args, **kwargs):
         """Save as a new document in the database. Wraps collection.insert"""
-        _id = self.collection.insert(self, *args, **kwargs)
-        self._live_documents[_id] = self
+        session = _current_session()
+        if session is not None and not args and not kwargs:
+            return session.save(self, insert=True)
+        _id = self.collection.insert(self._whole_document(), *args, **kwargs)
+        self.identity_map.add(_id, self)
+        self._mark_clean()
         return _id
 
+    @_timed('remove')
     def remove(self, spec=None, *args, **kwargs):
         """Remove this document from the databse."""
         if spec:
             raise WrongLevel('Collection-level removes blah blah blah use '
                              'Model.collection.remove(spec)')
+        session = _current_session()
+        if session is not None and not args and not kwargs:
+            return session.remove(self)
         if '_id' in self:
-            return self.collection.remove({'_id': self.pop('_id')})
+            object.__setattr__(self, '_dirty', None)
+            _id = self.pop('_id')
+            self.identity_map.evict(_id)
+            return self.collection.remove({'_id': _id})
+
+    @classmethod
+    def save_many(cls, instances, batch_size=1000, ordered=True):
+        """Save lots of instances with bulk writes of up to `batch_size`
+        operations each. Like save(), instances already in the database only
+        send their changes. Returns the instances' _ids.
+
+        Raises BulkError if any couldn't be saved, after saving the rest --
+        or, if `ordered`, after stopping at the first failure.
+        """
+        return cls._write_many(instances, cls._save_request, batch_size,
+                               ordered)
+
+    @classmethod
+    def insert_many(cls, instances, batch_size=1000, ordered=True):
+        """Insert lots of new instances with bulk writes. See save_many."""
+        def insert_request(instance, new):
+            return pymongo.InsertOne(instance)
+        return cls._write_many(instances, insert_request, batch_size, ordered)
+
+    @classmethod
+    def remove_many(cls, instances, batch_size=1000):
+        """Remove lots of instances from the database, up to `batch_size` per
+        round trip. Returns how many documents were removed.
+        """
+        stored = [instance for instance in instances if '_id' in instance]
+        removed = 0
+        for start in range(0, len(stored), batch_size):
+            batch = stored[start:start + batch_size]
+            ids = [instance['_id'] for instance in batch]
+            result = cls.collection.delete_many({'_id': {'$in': ids}})
+            removed += result.deleted_count
+            for instance in batch:
+                object.__setattr__(instance, '_dirty', None)
+                cls.identity_map.evict(instance.pop('_id'))
+        return removed
+
+    def _save_request(self, new):
+        """The bulk write request that does what save() would, or None"""
+        if new:
+            return pymongo.InsertOne(self)
+        if self._dirty is None:
+            self._fetch_missing()
+            return pymongo.ReplaceOne({'_id': self['_id']},
+                                      self._whole_document(), upsert=True)
+        changes = self.pending_changes()
+        if changes:
+            return pymongo.UpdateOne({'_id': self['_id']}, changes)
+
+    @classmethod
+    def _write_many(cls, instances, make_request, batch_size, ordered):
+        collection = cls.collection
+        instances = list(instances)
+        errors, unwritten = [], []
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            if ordered and errors:
+                unwritten.extend(batch)
+                continue
+            new = set()
+            for instance in batch:
+                if '_id' not in instance:
+                    # set here, so instances that don't make it can be reset
+                    instance['_id'] = bson.ObjectId()
+                    new.add(id(instance))
+            requests = []
+            for instance in batch:
+                request = make_request(instance, id(instance) in new)
+                if request is not None:
+                    requests.append((instance, request))
+            failed, details = {}, None
+            if requests:
+                try:
+                    result = collection.bulk_write(
+                        [request for _, request in requests], ordered=ordered)
+                    details = result.bulk_api_result
+                except pymongo.errors.BulkWriteError as e:
+                    details = e.details
+                    failed = dict((error['index'], error)
+                                  for error in details['writeErrors'])
+            tried = min(failed) + 1 if ordered and failed else len(requests)
+            written = []
+            for index, (instance, request) in enumerate(requests):
+                if index in failed:
+                    errors.append((instance, failed[index]))
+                elif index >= tried:
+                    unwritten.append(instance)
+                else:
+                    written.append((instance, request))
+                    continue
+                if id(instance) in new:
+                    del instance['_id']
+            if details is not None:  # None if nothing needed sending
+                cls._restore_missing(written, details)
+            for instance, _ in written:
+                cls.identity_map.add(instance['_id'], instance)
+                instance._mark_clean()
+        if errors or unwritten:
+            raise BulkError(errors, unwritten)
+        return [instance['_id'] for instance in instances]
+
+    @classmethod
+    def _restore_missing(cls, written, details):
+        """Like save(), put back whole any documents that were only sent
+        changes but turned out to have been removed from the database.
+        """
+        updates = [instance for instance, request in written
+                   if isinstance(request, pymongo.UpdateOne)]
+        replaces = sum(1 for _, request in written
+                       if isinstance(request, pymongo.ReplaceOne))
+        expected = len(updates) + replaces - details['nUpserted']
+        if not updates or details['nMatched'] >= expected:
+            return
+        ids = [instance['_id'] for instance in updates]
+        found = set(doc['_id'] for doc in
+                    cls.collection.raw().find({'_id': {'$in': ids}}, ['_id']))
+        missing = [instance for instance in updates
+                   if instance['_id'] not in found]
+        for instance in missing:
+            object.__setattr__(instance, '_partial', None)  # nothing to fetch
+        cls.collection.bulk_write([
+            pymongo.ReplaceOne({'_id': instance['_id']}, instance, upsert=True)
+            for instance in missing])
+
+    def pending_changes(self):
+        """The `$set`/`$unset` update that save() would send for the fields
+        changed since the instance was loaded or last saved. Lists are always
+        set whole.
+        """
+        updates = {}
+        for path, value in self._changed_values():
+            field = '.'.join(path)
+            if value is _missing:
+                updates.setdefault('$unset', {})[field] = ''
+            else:
+                updates.setdefault('$set', {})[field] = value
+        return updates
+
+    def _changed_values(self):
+        """(path, current value) for each changed path not inside another
+        changed path. The value is _missing for removed paths.
+        """
+        if not self._dirty:
+            return []
+        changed = []
+        saved = set()
+        # shortest paths first, so changes inside a replaced value are skipped
+        for path in sorted(self._dirty, key=len):
+            if path == ('_id',) or any(path[:depth] in saved
+                                       for depth in range(1, len(path))):
+                continue
+            saved.add(path)
+            value = self
+            for key in path:
+                if not isinstance(value, dict):
+                    value = _missing
+                    break
+                if isinstance(value, AttrDict):
+                    value = value._stored(key, _missing)
+                else:
+                    value = dict.get(value, key, _missing)
+                if value is _missing:
+                    break
+            changed.append((path, value))
+        return changed
+
+    def _changed(self, path):
+        dirty = self._dirty
+        if dirty is not None:
+            if dirty is _clean:  # the first change since loading or saving
+                dirty = set()
+                object.__setattr__(self, '_dirty', dirty)
+            dirty.add(path)
+        if self._raw is not None:
+            object.__setattr__(self, '_raw', None)
+        super(Model, self)._changed(path)
+
+    def _whole_document(self):
+        """What to send to write the whole document: the raw BSON it was
+        loaded from if nothing has changed, so it isn't encoded again.
+        """
+        if self._raw is not None and '_id' in self:
+            return self._raw
+        return self
+
+    def _mark_clean(self):
+        """Start tracking changes from the instance's current state"""
+        object.__setattr__(self, '_dirty', _clean)
+
+    def __getstate__(self):
+        state = super(Model, self).__getstate__()
+        if state.get('_dirty') is not None:
+            state['_dirty'] = set(state['_dirty'])  # don't share with copies
+        if state.get('_partial') is not None:
+            state['_partial'] = []  # still partial, but on its own
+        state.pop('_resolved', None)  # looked up again when needed
+        return state
+
+    def _fetch_missing(self):
+        """Load the fields a projection left out, for this instance and any
+        still-partial ones loaded along with it. Local changes are kept.
+        """
+        group = self._partial
+        if group is None:
+            return
+        instances = [self]
+        for ref in group:
+            instance = ref()
+            if (instance is not None and instance is not self and
+                    instance._partial is group):
+                instances.append(instance)
+        for instance in instances:
+            object.__setattr__(instance, '_partial', None)
+            object.__setattr__(instance, '_raw', None)
+        by_id = dict((instance['_id'], instance) for instance in instances
+                     if '_id' in instance)
+        if not by_id:
+            return
+        ids = list(by_id)
+        query = {'_id': {'$in': ids}} if len(ids) > 1 else {'_id': ids[0]}
+        for document in self.collection.raw().find(query):
+            instance = by_id[document['_id']]
+            _merge_document(instance, document, False, instance._dirty or ())
+
+    def __missing__(self, key):
+        """A field a projection left out is fetched when it's first used"""
+        if self._partial is not None:
+            self._fetch_missing()
+            if key in self:
+                return self[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        # see __missing__. so get() and `in` agree with [] on partial ones
+        if self._has(key):
+            return True
+        if self._partial is None:
+            return False
+        self._fetch_missing()
+        return self._has(key)
+
+    def _missing_attribute(self, attr):
+        # see __missing__
+        if self._partial is not None and not attr.startswith('__'):
+            self._fetch_missing()
+            if attr in self:
+                return getattr(self, attr)
+        return super(Model, self)._missing_attribute(attr)
+
+    @classmethod
+    def prefetch(cls, instances, *names):
+        """Look up what the Reference fields `names` refer to, for all of
+        the instances, with one `$in` query per referenced model. Instances
+        that are already live aren't looked up again.
+        """
+        by_target = collections.OrderedDict()
+        for name in names:
+            reference = _reference(cls, name)
+            by_target.setdefault(reference.model(cls), []).append(reference)
+        for target, references in by_target.items():
+            wanted = []
+            for reference in references:
+                for instance in instances:
+                    ids = reference.ids(instance)
+                    if not reference.resolved(instance, ids):
+                        wanted.extend(ids)
+            found = _lookup(target, wanted)
+            for reference in references:
+                for instance in instances:
+                    ids = reference.ids(instance)
+                    if not reference.resolved(instance, ids):
+                        reference.resolve(instance, ids, found)
 
     def is_in_db(self):
         """Does this instance have a record in the database?"""
         return '_id' in self
 
     @classmethod
-    def inflate(cls, json):
-        """Return a model instance given its MongoDB json representation"""
-        if '_id' in json and json['_id'] in cls._live_documents:
-            instance = cls._live_documents[json['_id']]
-        else:
+    def inflate(cls, json, refresh=None, partial=False):
+        """Return a model instance given its MongoDB json representation.
+
+        If the document's instance is already live, that instance is returned,
+        brought up to date according to `refresh` (or the model's
+        `_refresh_policy` by default): KEEP_LOCAL leaves it alone, OVERWRITE
+        replaces its contents with `json`, and MERGE does too but keeps any
+        unsaved local changes.
+
+        Pass `partial=True` if a projection might have left fields out of
+        `json`. They'll be fetched if they're needed, and save() won't
+        replace the whole document without them.
+        """
+        return cls.inflate_many((json,), refresh, partial)[0]
+
+    @classmethod
+    def inflate_many(cls, documents, refresh=None, partial=False):
+        """inflate() each of a batch of documents, in a list. The identity map
+        and refresh policy are looked up once for the whole batch, and
+        partial instances fetch their missing fields together.
+        """
+        start = _clock() if _listeners else None
+        identity_map = cls.identity_map
+        get, add = identity_map.get, identity_map.add
+        policy = refresh or cls._refresh_policy
+        new = cls.__new__
+        adoptable = True
+        group = [] if partial else None
+        instances = []
+        hits = 0
+        # any thread's: a pipelined cursor inflates in its fetcher thread
+        with _open_sessions_lock:
+            sessions = list(_open_sessions)
+        for json in documents:
+            _id = json.get('_id', _missing)
+            instance = None
+            if _id is not _missing:
+                instance = get(_id)
+                if instance is not None:
+                    # unflushed changes are newer than what's in the db
+                    if policy != KEEP_LOCAL and not any(
+                            session.is_pending(instance)
+                            for session in sessions):
+                        instance._reload(json, policy, partial)
+                    instances.append(instance)
+                    hits += 1
+                    continue
+            if type(json) is _DecodedDocument and adoptable:
+                try:  # the decoded document becomes the instance
+                    object.__setattr__(json, '__class__', cls)
+                    instance = json
+                except TypeError:  # cls has a different layout (__slots__)
+                    adoptable = False
+            if instance is None:
+                instance = new(cls)
+            instance._load(json, group)
+            if _id is not _missing:
+                add(_id, instance)
+            instances.append(instance)
+        if start is not None:
+            _emit('inflate', cls.collection.full_name, start, instances, hits,
+                  len(instances) - hits)
+        return instances
+
+    @classmethod
+    def _inflate_unmapped(cls, documents):
+        """Instances of documents that might not be the model's own, like
+        aggregate() results from a $group. They aren't looked up in or added
+        to the identity map, and don't fetch fields they don't have.
+        """
+        instances = []
+        for json in documents:
             instance = cls.__new__(cls)
-            Model.__init__(instance, json)
-        return instance
+            instance._load(json)
+            instances.append(instance)
+        return instances
+
+    def _load(self, json, group=None):
+        """Fill a new or emptied instance from the database's document. If a
+        projection was used, `group` is the list of instances that will fetch
+        their missing fields together. A raw BSON document is held on to,
+        and its sub-documents decoded as they're accessed.
+
+        `json` might be this very instance, if the driver decoded it (see
+        _DecodedDocument). Its sub-documents are cast as they're accessed.
+        """
+        raw = type(json) is RawBSONDocument
+        if json is self:
+            object.__setattr__(self, '_lazy', True)
+        elif (raw or self._lazy_inflate or
+                type(json) is _DecodedDocument):
+            self._store_all(json)
+            object.__setattr__(self, '_lazy', True)
+        else:
+            self._fill(json)
+        object.__setattr__(self, '_raw', json if raw else None)
+        self._mark_clean()
+        if group is not None:
+            group.append(weakref.ref(self))
+        object.__setattr__(self, '_partial', group)
+
+    def _reload(self, json, policy, partial=False):
+        """Bring a live instance up to date with a fresh copy of its document.
+        A partial copy only updates the fields it has. See inflate().
+        """
+        if policy not in (OVERWRITE, MERGE):
+            raise ValueError('Unknown refresh policy {!r}'.format(policy))
+        local = self._changed_values() if policy == MERGE else []
+        if partial:
+            if policy == OVERWRITE:  # local changes to other fields stay
+                local = [(path, value) for path, value in
+                         self._changed_values() if path[0] not in json]
+            _merge_document(self, json, True)
+            object.__setattr__(self, '_raw', None)
+        elif not local and type(self).__eq__(self, json) is True:
+            # nothing to do. comparing is much cheaper than rebuilding.
+            return
+        else:
+            self._store_clear()
+            self._load(json)
+        for path, value in local:
+            container = self
+            for key in path[:-1]:
+                child = container.get(key)
+                if not isinstance(child, AttrDict):
+                    container[key] = child = AttrDict()
+                container = child
+            if value is _missing:
+                container.pop(path[-1], None)
+            else:
+                container[path[-1]] = value
+        object.__setattr__(self, '_dirty', set(path for path, _ in local))
 
     def __repr__(self):
         dict_repr = dict.__repr__(self)
         return '<{}: {}>'.format(self.__class__.__name__, dict_repr)
+
+
+class _Field(object):
+    """Dot access to a declared field of a CompactModel, kept in `slot`"""
+
+    def __init__(self, name, slot):
+        self.name = name
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            value = self.slot.__get__(instance, owner)
+        except AttributeError:  # not set. a projection might have left it out
+            pass
+        else:
+            if type(value) not in _uncast_types:
+                return value
+        try:
+            return instance[self.name]  # casts it, or fetches it
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '{}'".format(
+                owner.__name__, self.name))
+
+    def __set__(self, instance, value):
+        instance[self.name] = value
+
+    def __delete__(self, instance):
+        try:
+            del instance[self.name]
+        except KeyError as e:
+            raise AttributeError(e)
+
+
+class CompactModelType(_AttrDictType):
+    """Gives each CompactModel class a slot for each of its `_fields`"""
+
+    def __new__(meta, name, bases, namespace):
+        inherited = []
+        for base in bases:
+            inherited.extend(field for field in getattr(base, '_fields', ())
+                             if field not in inherited)
+        new = [field for field in namespace.get('_fields', ())
+               if field not in inherited]
+        for field in new:
+            if field == '_id':
+                raise TypeError("_id can't be a declared field: the driver "
+                                "needs it in the document's own storage")
+            if not re.match(r'[A-Za-z_]\w*$', field):
+                raise TypeError('Declared fields need names that could be '
+                                'attributes, not {!r}'.format(field))
+            if field in namespace or any(hasattr(base, field)
+                                         for base in bases):
+                raise TypeError('Declared field {!r} would hide an attribute '
+                                'of the model'.format(field))
+        namespace = dict(namespace)
+        namespace['__slots__'] = (tuple(namespace.get('__slots__', ())) +
+                                  tuple('_field_' + field for field in new))
+        namespace['_fields'] = tuple(inherited + new)
+        cls = super(CompactModelType, meta).__new__(meta, name, bases,
+                                                    namespace)
+        slots = dict(getattr(cls, '_field_slots', {}))
+        for field in new:
+            slots[field] = cls.__dict__['_field_' + field]
+            setattr(cls, field, _Field(field, slots[field]))
+        cls._field_slots = slots
+        cls._field_items = tuple((field, slots[field])
+                                 for field in cls._fields)
+        return cls
+
+
+class CompactModel(CompactModelType('CompactModel', (Model,),
+                                    {'__slots__': ()})):
+    """A Model that keeps the fields named in `_fields` in slots, which takes
+    a lot less memory per instance. Other keys (and _id) go in the dict as
+    usual. Instances save, inflate, encode and take dot access just like any
+    Model's:
+
+        class User(kale.CompactModel):
+            _database = ...
+            _collection_name = 'users'
+            _fields = ('name', 'email', 'visits')
+
+    Instances are still dicts to the driver, which reads items through the
+    mapping methods here. Code that reads a dict's storage directly, like
+    the json module's C encoder, will only see the undeclared keys.
+    """
+
+    __slots__ = ('_dirty', '_lazy', '_raw', '_partial')
+    _fields = ()
+
+    def __new__(cls, *args, **kwargs):
+        instance = super(CompactModel, cls).__new__(cls, *args, **kwargs)
+        # the slots shadow Model's class-level defaults
+        object.__setattr__(instance, '_dirty', None)
+        object.__setattr__(instance, '_lazy', False)
+        object.__setattr__(instance, '_raw', None)
+        object.__setattr__(instance, '_partial', None)
+        return instance
+
+    def __getitem__(self, key):
+        slot = self._field_slots.get(key)
+        if slot is None:
+            return super(CompactModel, self).__getitem__(key)
+        try:
+            value = slot.__get__(self)
+        except AttributeError:
+            return self.__missing__(key)
+        if type(value) in _uncast_types:
+            value = self._wrap(key, value)
+            slot.__set__(self, value)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = self._field_slots.get(key)
+        if slot is None:
+            return super(CompactModel, self).__setitem__(key, value)
+        slot.__set__(self, self._cast(key, value))
+        self._changed((key,))
+
+    def __delitem__(self, key):
+        slot = self._field_slots.get(key)
+        if slot is None:
+            return super(CompactModel, self).__delitem__(key)
+        try:
+            slot.__delete__(self)
+        except AttributeError:
+            raise KeyError(key)
+        self._changed((key,))
+
+    def __iter__(self):
+        for key in dict.__iter__(self):
+            yield key
+        for field, slot in self._field_items:
+            try:
+                slot.__get__(self)
+            except AttributeError:
+                continue
+            yield field
+
+    def __len__(self):
+        return dict.__len__(self) + sum(1 for _ in self._stored_fields())
+
+    def _stored(self, key, default=None):
+        slot = self._field_slots.get(key)
+        if slot is None:
+            return dict.get(self, key, default)
+        try:
+            return slot.__get__(self)
+        except AttributeError:
+            return default
+
+    def _has(self, key):
+        slot = self._field_slots.get(key)
+        if slot is None:
+            return dict.__contains__(self, key)
+        return self._stored(key, _missing) is not _missing
+
+    def _store(self, key, value):
+        slot = self._field_slots.get(key)
+        if slot is None:
+            dict.__setitem__(self, key, value)
+        else:
+            slot.__set__(self, value)
+
+    def _store_all(self, items):
+        self._fill(items, cast=False)
+
+    def _store_clear(self):
+        for field, slot in self._stored_fields():
+            slot.__delete__(self)
+        dict.clear(self)
+
+    def _stored_fields(self):
+        """(field, slot) for each declared field that's set"""
+        for field, slot in self._field_items:
+            try:
+                slot.__get__(self)
+            except AttributeError:
+                continue
+            yield field, slot
+
+    def _stored_items(self):
+        items = list(dict.items(self))
+        items.extend((field, slot.__get__(self))
+                     for field, slot in self._stored_fields())
+        return items
+
+    def _fill(self, items, cast=True):
+        slots = self._field_slots
+        for key in items:
+            value = items[key]
+            if cast:
+                value = AttrDict._cast(self, key, value)
+            slot = slots.get(key)
+            if slot is None:
+                dict.__setitem__(self, key, value)
+            else:
+                slot.__set__(self, value)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        if _encoding.raw:
+            return self._stored_items()
+        return [(key, self[key]) for key in self]
+
+    def iterkeys(self):  # py2
+        return iter(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def popitem(self):
+        if dict.__len__(self):
+            return super(CompactModel, self).popitem()
+        for field, slot in self._stored_fields():
+            return field, self.pop(field)
+        raise KeyError('popitem(): dictionary is empty')
+
+    def copy(self):
+        return dict(self.items())
+
+    def clear(self):
+        for key in list(self):
+            self._changed((key,))
+        self._store_clear()
+
+    def __eq__(self, other):
+        if isinstance(other, CompactModel):
+            other = dict(other._stored_items())
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return dict(self._stored_items()) == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        state = super(CompactModel, self).__getstate__()
+        for name in CompactModel.__slots__:
+            value = object.__getattribute__(self, name)
+            if name == '_dirty' and value is not None:
+                value = set(value)  # don't share with copies
+            elif name == '_partial' and value is not None:
+                value = []  # still partial, but on its own
+            state[name] = value
+        return state
+
+    def __setstate__(self, state):
+        for name in state:
+            object.__setattr__(self, name, state[name])
+
+    def __repr__(self):
+        return '<{}: {!r}>'.format(self.__class__.__name__,
+                                   dict(self._stored_items()))
+
+
+def _subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for descendant in _subclasses(subclass):
+            yield descendant
+
+
+def provision_indexes(models=None):
+    """Create the indexes declared in the `_indexes` of each model (every
+    Model subclass, by default), with one createIndexes command per
+    collection. Declare them as keys or lists of (key, direction) pairs,
+    or as pymongo.IndexModels for options like `unique`,
+    `expireAfterSeconds` (TTL) and `partialFilterExpression`:
+
+        class User(kale.Model):
+            ...
+            _indexes = [
+                pymongo.IndexModel('email', unique=True),
+                [('team', 1), ('joined', -1)],
+            ]
+
+    Indexes that already exist are left alone, so it's fine to call at
+    every startup. Returns {namespace: [index names]}.
+    """
+    by_collection = collections.OrderedDict()
+    for model in _subclasses(Model) if models is None else models:
+        if not model._indexes or isinstance(model._collection_name,
+                                            abc.abstractproperty):
+            continue
+        collection = model.collection
+        _, indexes = by_collection.setdefault(
+            collection.full_name, (collection, collections.OrderedDict()))
+        for index in model._indexes:
+            if not isinstance(index, pymongo.IndexModel):
+                index = pymongo.IndexModel(index)
+            indexes.setdefault(index.document['name'], index)
+    return dict((namespace, collection.create_indexes(list(indexes.values())))
+                for namespace, (collection, indexes) in by_collection.items())
+
+
+def _lookup(model, ids):
+    """{_id: instance} for the ids, from the identity map or one query"""
+    found, missing = {}, []
+    for _id in ids:
+        if _id in found:
+            continue
+        instance = model.identity_map.get(_id)
+        if instance is None:
+            missing.append(_id)
+            found[_id] = None
+        else:
+            found[_id] = instance
+    if missing:
+        query = ({'_id': {'$in': missing}} if len(missing) > 1 else
+                 {'_id': missing[0]})
+        for instance in model.collection.find(query):
+            found[instance['_id']] = instance
+    return found
+
+
+def _reference(model, name):
+    for cls in model.__mro__:
+        reference = cls.__dict__.get(name)
+        if isinstance(reference, Reference):
+            return reference
+    raise AttributeError('{} has no Reference field {!r}'.format(
+        model.__name__, name))
+
+
+class Reference(object):
+    """A field holding the _id of another model's document (or a list of
+    them, if `many`), which dot access turns into the instance:
+
+        class Post(kale.Model):
+            ...
+            author = kale.Reference(User)
+            tags = kale.Reference('Tag', many=True)  # a name, if it's later
+
+    `post.author` looks up the user the first time (or gets it from the
+    identity map), and keeps it while the stored _id stays the same.
+    `post['author']` is still the _id. Assigning an instance stores its _id.
+    A missing document is None, or left out of a list. Use
+    `cursor.prefetch('author', 'tags')` or `Post.prefetch(posts, ...)` to
+    look them up for lots of instances at once.
+
+    The document key is the attribute's name, unless `key` says otherwise.
+    """
+
+    def __init__(self, model, many=False, key=None):
+        self._model = model
+        self.many = many
+        self.key = key
+
+    def __set_name__(self, owner, name):  # python 3.6+
+        if self.key is None:
+            self.key = name
+
+    def _key(self, owner):
+        if self.key is None:  # older pythons don't call __set_name__
+            for cls in owner.__mro__:
+                for name, value in vars(cls).items():
+                    if value is self:
+                        self.key = name
+        return self.key
+
+    def model(self, owner):
+        """The referenced model class. Names are looked up in the module of
+        the model declaring the reference.
+        """
+        if isinstance(self._model, basestring):
+            self._model = getattr(sys.modules[owner.__module__], self._model)
+        return self._model
+
+    def ids(self, instance):
+        """The _ids stored in the instance, as a tuple"""
+        try:
+            value = instance[self._key(type(instance))]
+        except KeyError:
+            return ()
+        if value is None:
+            return ()
+        return tuple(value) if self.many else (value,)
+
+    def resolved(self, instance, ids):
+        """Have these ids been looked up for the instance already?"""
+        cached = (instance._resolved or {}).get(self._key(type(instance)))
+        return cached is not None and cached[0] == ids
+
+    def resolve(self, instance, ids, found):
+        """Keep what the ids refer to with the instance"""
+        targets = [found.get(_id) for _id in ids]
+        if self.many:
+            value = [target for target in targets if target is not None]
+        else:
+            value = targets[0] if targets else None
+        if instance._resolved is None:
+            object.__setattr__(instance, '_resolved', {})
+        instance._resolved[self._key(type(instance))] = (ids, value)
+        return value
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        ids = self.ids(instance)
+        if self.resolved(instance, ids):
+            return instance._resolved[self._key(owner)][1]
+        return self.resolve(instance, ids, _lookup(self.model(owner), ids))
+
+    def __set__(self, instance, value):
+        key = self._key(type(instance))
+        if value is None:
+            instance[key] = None
+            return
+        targets = list(value) if self.many else [value]
+        ids = []
+        for target in targets:
+            if isinstance(target, Model):
+                if '_id' not in target:
+                    raise ValueError("Save {!r} before referring to it, so "
+                                     "it has an _id".format(target))
+                ids.append(target['_id'])
+            else:
+                ids.append(target)
+        instance[key] = ids if self.many else ids[0]
+        found = dict((_id, target) for _id, target in zip(ids, targets)
+                     if isinstance(target, Model))
+        if len(found) == len(ids):  # no need to look them up later
+            self.resolve(instance, tuple(ids), found)
+
+    def __delete__(self, instance):
+        try:
+            del instance[self._key(type(instance))]
+        except KeyError as e:
+            raise AttributeError(e)
+
+
+if contextvars is not None:
+    # the Sessions we're in, per thread and per asyncio task
+    _session_stack = contextvars.ContextVar('kale_sessions', default=())
+    _get_sessions, _set_sessions = _session_stack.get, _session_stack.set
+else:  # python < 3.7: just per thread
+    _session_state = threading.local()
+
+    def _get_sessions():
+        return getattr(_session_state, 'sessions', ())
+
+    def _set_sessions(sessions):
+        _session_state.sessions = sessions
+
+_open_sessions = []  # every thread's, for ChangeWatcher
+_open_sessions_lock = threading.Lock()
+
+
+def _current_session():
+    """The innermost Session we're in, or None"""
+    sessions = _get_sessions()
+    return sessions[-1] if sessions else None
+
+
+def _pending_in_any_session(instance):
+    """Is the instance waiting to be written by a Session in any thread?"""
+    with _open_sessions_lock:
+        sessions = list(_open_sessions)
+    return any(session.is_pending(instance) for session in sessions)
+
+
+class Session(object):
+    """A unit of work. Inside `with kale.Session():`, Model.save, insert
+    and remove don't go to the database straight away. They're collected,
+    with repeated saves of an instance merged into one, and written when
+    the block ends (or at flush()) as one ordered bulk write per model.
+
+        with kale.Session():
+            user.visits += 1
+            user.save()
+            post.save()
+            user.save()  # still just the one update for user
+
+    New instances get their _id and join the identity map when they're
+    saved, and `find_one(_id)` hands back instances waiting to be written
+    (and None for ones waiting to be removed). Other queries only see what
+    has been flushed.
+
+    If the block raises, nothing is written. If a write fails, flush raises
+    BulkError, after putting back the _ids and identity map entries of the
+    instances that weren't written, as if they'd never been saved or
+    removed. Their changes are still there to be saved again.
+
+    Sessions are per thread, and on python 3.7+ per asyncio task too, with
+    kale_async's executor calls joining the session of the task that made
+    them. Before 3.7, tasks on one thread share a session, and AsyncModel
+    writes skip it. A session inside another one has its own pending
+    writes.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        # (id(instance), 'write' or 'remove') -> [instance, new/_id, ...]
+        self._pending = collections.OrderedDict()
+
+    def __enter__(self):
+        _set_sessions(_get_sessions() + (self,))
+        with _open_sessions_lock:
+            _open_sessions.append(self)
+        return self
+
+    def __exit__(self, kind, error, trace):
+        _set_sessions(tuple(session for session in _get_sessions()
+                            if session is not self))
+        with _open_sessions_lock:
+            _open_sessions.remove(self)
+        if kind is None:
+            self.flush()
+        else:
+            self.rollback()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def is_pending(self, instance):
+        """Is the instance waiting to be written?"""
+        return (id(instance), 'write') in self._pending
+
+    def save(self, instance, insert=False):
+        """Write the instance at the next flush, and return its _id. New
+        instances get one now.
+        """
+        key = (id(instance), 'write')
+        if key not in self._pending:
+            made_id = '_id' not in instance
+            if made_id:
+                instance['_id'] = bson.ObjectId()
+            # [instance, insert it?, did we make its _id?]
+            self._pending[key] = [instance, insert or made_id, made_id]
+            if made_id:  # others join the identity map once written
+                instance.identity_map.add(instance['_id'], instance)
+        return instance['_id']
+
+    def remove(self, instance):
+        """Remove the instance's document at the next flush"""
+        if '_id' not in instance:
+            return
+        _id = instance['_id']
+        write = self._pending.pop((id(instance), 'write'), None)
+        if write is None or not write[1]:  # it's in the database
+            # [instance, its _id, its _dirty] to put back if it fails
+            self._pending[(id(instance), 'remove')] = [instance, _id,
+                                                       instance._dirty]
+        object.__setattr__(instance, '_dirty', None)
+        instance.pop('_id')
+        instance.identity_map.evict(_id)
+
+    def _find(self, collection, args, kwargs):
+        """What find_one would see pending, or _missing if nothing is"""
+        if len(args) > 1 or set(kwargs) - set(['filter', 'refresh']):
+            return _missing  # projections and such go to the database
+        ids = _ids_in_filter(args[0] if args else kwargs.get('filter'))
+        if ids is None or len(ids) != 1:
+            return _missing
+        found = _missing
+        for (_, kind), entry in self._pending.items():
+            instance = entry[0]
+            if instance.collection is not collection:
+                continue
+            if kind == 'write' and instance.get('_id') == ids[0]:
+                found = instance
+            elif kind == 'remove' and entry[1] == ids[0]:
+                found = None
+        return found
+
+    def flush(self):
+        """Write everything pending, one ordered bulk write per model
+        (per `batch_size` writes). Raises BulkError if anything failed.
+        """
+        pending, self._pending = self._pending, collections.OrderedDict()
+        groups = collections.OrderedDict()
+        for (_, kind), entry in pending.items():
+            # by model, not collection: models sharing a collection (like a
+            # subclass) still have identity maps of their own
+            groups.setdefault(type(entry[0]), []).append((kind, entry))
+        batches = []
+        for model, entries in groups.items():
+            requests = []
+            for kind, entry in entries:
+                request = self._request(kind, entry)
+                if request is None:  # saved, but nothing changed
+                    entry[0]._mark_clean()
+                else:
+                    requests.append((kind, entry, request))
+            for start in range(0, len(requests), self.batch_size):
+                batches.append((model, requests[start:start +
+                                                self.batch_size]))
+        for position, (model, batch) in enumerate(batches):
+            later = [request for _, rest in batches[position + 1:]
+                     for request in rest]
+            start = _clock() if _listeners else None
+            try:
+                result = model.collection.bulk_write(
+                    [request for _, _, request in batch], ordered=True)
+            except pymongo.errors.BulkWriteError as e:
+                # ordered, so everything before the error was written
+                error = e.details['writeErrors'][0]
+                index = error['index']
+                self._written(model, batch[:index], e.details)
+                self._roll_back(batch[index:] + later)
+                raise BulkError([(batch[index][1][0], error)],
+                                [entry[0] for _, entry, _ in
+                                 batch[index + 1:] + later])
+            except Exception:
+                self._roll_back(batch + later)
+                raise
+            self._written(model, batch, result.bulk_api_result)
+            if start is not None:
+                _emit('flush', model.collection.full_name, start,
+                      [entry[0] for _, entry, _ in batch])
+
+    @staticmethod
+    def _request(kind, entry):
+        if kind == 'remove':
+            return pymongo.DeleteOne({'_id': entry[1]})
+        if entry[1]:
+            return pymongo.InsertOne(entry[0])
+        return entry[0]._save_request(False)
+
+    @staticmethod
+    def _written(model, batch, details):
+        written = [(entry[0], request) for kind, entry, request in batch
+                   if kind == 'write']
+        model._restore_missing(written, details)
+        for instance, _ in written:
+            model.identity_map.add(instance['_id'], instance)
+            instance._mark_clean()
+
+    def rollback(self):
+        """Forget everything pending, putting back the _ids and identity map
+        entries of instances saved or removed in the session.
+        """
+        pending, self._pending = self._pending, collections.OrderedDict()
+        self._roll_back([(kind, entry, None)
+                         for (_, kind), entry in pending.items()])
+
+    @staticmethod
+    def _roll_back(requests):
+        for kind, entry, _ in requests:
+            instance = entry[0]
+            if kind == 'remove':
+                _id, dirty = entry[1], entry[2]
+                instance['_id'] = _id
+                object.__setattr__(instance, '_dirty', dirty)
+                instance.identity_map.add(_id, instance)
+            elif entry[2] and '_id' in instance:  # we made its _id
+                instance.identity_map.evict(instance['_id'])
+                del instance['_id']
+
+
+class ChangeWatcher(object):
+    """Keeps a model's live instances up to date with writes made by other
+    processes, by following its collection's change stream in a background
+    thread. Change streams need a replica set (a single node one is fine).
+
+        watcher = kale.ChangeWatcher(User, policy=kale.MERGE).start()
+        ...
+        watcher.stop()
+
+    A changed document's live instance is reloaded with the `policy`
+    (OVERWRITE, or MERGE to keep unsaved local changes), or just forgotten
+    with EVICT, so it's fetched again next time. Deleted documents are
+    always forgotten, and the query cache drops whatever changed. Instances
+    waiting to be written by a Session are left alone.
+
+    Changes are queued, and applied by calling `apply_pending()` from your
+    own thread, so instances never change under you. With `in_thread=True`
+    they're applied as they arrive instead, from the watcher's thread,
+    where other threads might catch an instance halfway through a reload.
+    If more than `max_pending` pile up, or a change arrives more than
+    `max_lag` seconds after it was made, the watcher is too far behind to
+    be trusted, and the whole identity map is forgotten.
+
+    After an error, the stream is resumed after the last change seen.
+    Save `watcher.resume_token` and pass it back as `resume_after` to
+    pick up where a previous watcher left off.
+    """
+
+    def __init__(self, model, policy=MERGE, in_thread=False,
+                 resume_after=None, max_pending=10000, max_lag=None,
+                 max_await_time_ms=500):
+        if policy not in (OVERWRITE, MERGE, EVICT):
+            raise ValueError('Unknown watch policy {!r}'.format(policy))
+        self.model = model
+        self.policy = policy
+        self.in_thread = in_thread
+        self.resume_token = resume_after
+        self.max_pending = max_pending
+        self.max_lag = max_lag
+        self.max_await_time_ms = max_await_time_ms
+        self.changes = self.applied = self.evicted = self.resets = 0
+        self.errors = self.restarts = 0
+        self.lag = self.worst_lag = None
+        self.error = None
+        self._pending = collections.deque()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start following the change stream, and return the watcher"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='kale-watch-{}'.format(
+                                                self.model.__name__))
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop following the change stream (within max_await_time_ms)"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, kind, error, trace):
+        self.stop()
+
+    def _run(self):
+        backoff = 0.1
+        while not self._stopping.is_set():
+            try:
+                self._follow()
+                backoff = 0.1
+            except Exception as e:  # anything else would end the thread
+                self.errors += 1
+                self.error = e
+                if (isinstance(e, pymongo.errors.OperationFailure) and
+                        self.resume_token is not None):
+                    # probably too old to resume from: start over, and
+                    # don't trust anything we might have missed
+                    self.resume_token = None
+                    self.reset()
+                elif not isinstance(e, pymongo.errors.PyMongoError):
+                    self.reset()  # a change we couldn't apply is skipped
+                if self._stopping.wait(backoff):
+                    return
+                backoff = min(backoff * 2, 5)
+                self.restarts += 1
+
+    def _follow(self):
+        raw = self.model.collection.raw()
+        with raw.watch(full_document='updateLookup',
+                       resume_after=self.resume_token,
+                       max_await_time_ms=self.max_await_time_ms) as stream:
+            while stream.alive and not self._stopping.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    # past it even if it fails, so it isn't tried forever
+                    self.resume_token = change['_id']
+                    self._receive(change)
+            if not stream.alive:  # invalidated: the collection went away
+                self.resume_token = None
+
+    def _receive(self, change):
+        self.changes += 1
+        made = change.get('clusterTime')
+        if made is not None:
+            self.lag = max(time.time() - made.time, 0)
+            self.worst_lag = max(self.lag, self.worst_lag or 0)
+            if self.max_lag is not None and self.lag > self.max_lag:
+                self._pending.clear()
+                self.reset()
+                return
+        if self.in_thread:
+            self.apply(change)
+        elif len(self._pending) >= self.max_pending:
+            self._pending.clear()
+            self.reset()
+        else:
+            self._pending.append(change)
+
+    def apply_pending(self):
+        """Apply the queued changes, and return how many there were"""
+        count = 0
+        while True:
+            try:
+                change = self._pending.popleft()
+            except IndexError:
+                return count
+            self.apply(change)
+            count += 1
+
+    def apply(self, change):
+        """Bring the live instances up to date with one change event"""
+        kind = change['operationType']
+        if kind in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+            self.reset()
+            return
+        _id = change.get('documentKey', {}).get('_id', _missing)
+        if _id is _missing:
+            return
+        collection = self.model.collection
+        if collection.query_cache.size:
+            collection.query_cache.invalidate([_id])
+        instance = collection.identity_map.peek(_id)
+        if instance is None:
+            return
+        document = change.get('fullDocument')
+        if document is None or self.policy == EVICT:  # deleted, or forget
+            collection.identity_map.evict(_id)
+            self.evicted += 1
+            return
+        if _pending_in_any_session(instance):
+            return  # it'll be written over anyway
+        instance._reload(document, self.policy)
+        self.applied += 1
+
+    def reset(self):
+        """Forget every live instance and cached query result"""
+        collection = self.model.collection
+        collection.identity_map.clear()
+        collection.query_cache.clear()
+        self.resets += 1
+
+    def stats(self):
+        return {'changes': self.changes, 'applied': self.applied,
+                'evicted': self.evicted, 'resets': self.resets,
+                'pending': len(self._pending), 'errors': self.errors,
+                'restarts': self.restarts, 'lag': self.lag,
+                'worst_lag': self.worst_lag}
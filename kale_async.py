@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+    kale_async
+
+    asyncio versions of kale's models, collections and cursors. The work is
+    done by kale's own (blocking) collection in an executor, like motor does
+    with pymongo, so documents are inflated and tracked exactly as they are
+    by kale.
+
+    :requires: pymongo, python 3.5+
+    :copyright: Calama Consulting, written and maintained by uniphil
+    :license: :) see http://license.visualidiot.com/
+"""
+
+import asyncio
+import functools
+import itertools
+import collections
+import kale
+
+try:
+    from contextvars import copy_context
+except ImportError:  # python < 3.7
+    copy_context = None
+
+
+def _run(executor, fn, *args, **kwargs):
+    """Run a blocking fn in the executor (None for the loop's default). On
+    python 3.7+ it runs in a copy of the caller's context, so it sees the
+    kale.Session the calling task is in.
+    """
+    loop = asyncio.get_event_loop()
+    call = functools.partial(fn, *args, **kwargs)
+    if copy_context is not None:
+        call = functools.partial(copy_context().run, call)
+    return loop.run_in_executor(executor, call)
+
+
+class AsyncCursor(object):
+    """Iterate a kale.Cursor with `async for`. Documents are fetched and
+    inflated `batch` at a time in the executor.
+    """
+
+    def __init__(self, cursor, executor=None, batch=100):
+        self._cursor = cursor
+        self._executor = executor
+        self._batch = batch
+        self._buffer = collections.deque()
+        self._exhausted = False
+
+    # set up the underlying cursor, and return this one for chaining
+    _chainable = frozenset([
+        'sort', 'limit', 'skip', 'batch_size', 'hint', 'max_time_ms',
+        'comment', 'where', 'collation', 'allow_disk_use'])
+
+    def __getattr__(self, name):
+        if name not in self._chainable:
+            raise AttributeError(name)
+        method = getattr(self._cursor, name)
+
+        @functools.wraps(method)
+        def chain(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+        return chain
+
+    def _take(self, count):
+        return list(itertools.islice(self._cursor, count))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            if not self._exhausted:
+                self._buffer.extend(await _run(self._executor, self._take,
+                                               self._batch))
+                self._exhausted = len(self._buffer) < self._batch
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.popleft()
+
+    async def to_list(self, length=None):
+        """Up to `length` (or all the) remaining instances, in a list"""
+        instances = []
+        async for instance in self:
+            instances.append(instance)
+            if length is not None and len(instances) >= length:
+                break
+        return instances
+
+    async def close(self):
+        self._exhausted = True
+        self._buffer.clear()
+        await _run(self._executor, self._cursor.close)
+
+
+class AsyncCollection(object):
+    """Awaitable access to a model's kale.Collection"""
+
+    # the collection's methods that are simply run in the executor
+    _passthrough = frozenset([
+        'insert_one', 'insert_many', 'replace_one', 'update_one',
+        'update_many', 'delete_one', 'delete_many', 'bulk_write',
+        'count_documents', 'estimated_document_count', 'distinct',
+        'create_index', 'create_indexes', 'drop'])
+
+    def __init__(self, collection, executor=None, max_batch=1000):
+        self.collection = collection
+        self._executor = executor
+        self._max_batch = max_batch
+        self._pending = collections.OrderedDict()  # _id -> [futures]
+        self._flush_scheduled = False
+
+    def __getattr__(self, name):
+        if name not in self._passthrough:
+            raise AttributeError(name)
+        method = getattr(self.collection, name)
+
+        @functools.wraps(method)
+        async def run(*args, **kwargs):
+            return await _run(self._executor, method, *args, **kwargs)
+        return run
+
+    def find(self, *args, **kwargs):
+        """Like kale's find, but for `async for`. Pass `batch` to set how many
+        instances are fetched per trip to the executor.
+        """
+        batch = kwargs.pop('batch', 100)
+        return AsyncCursor(self.collection.find(*args, **kwargs),
+                           self._executor, batch)
+
+    async def find_one(self, *args, **kwargs):
+        return await _run(self._executor, self.collection.find_one, *args,
+                          **kwargs)
+
+    async def get(self, _id):
+        """The instance for _id, or None if there's no such document.
+
+        A live instance is returned straight away if the model's refresh
+        policy is KEEP_LOCAL. Otherwise lookups made at the same time are
+        gathered into one `$in` query.
+        """
+        model = self.collection._model_class
+        if model._refresh_policy == kale.KEEP_LOCAL:
+            live = self.collection.identity_map.get(_id)
+            if live is not None:
+                return live
+        future = asyncio.get_event_loop().create_future()
+        self._pending.setdefault(_id, []).append(future)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, collections.OrderedDict()
+        ids = list(pending)
+        for start in range(0, len(ids), self._max_batch):
+            batch = dict((_id, pending[_id])
+                         for _id in ids[start:start + self._max_batch])
+            asyncio.ensure_future(self._resolve(batch))
+
+    async def _resolve(self, batch):
+        try:
+            found = await _run(self._executor, self._get_many, list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for _id, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(found.get(_id))
+
+    def _get_many(self, ids):
+        query = {'_id': {'$in': ids}} if len(ids) > 1 else {'_id': ids[0]}
+        return dict((instance['_id'], instance)
+                    for instance in self.collection.find(query))
+
+
+class AsyncModel(kale.Model):
+    """A kale.Model with awaitable save, insert and remove.
+    Set `_executor` to run them somewhere other than the loop's default.
+    """
+
+    _executor = None
+
+    @kale.classproperty
+    @classmethod
+    def async_collection(cls):
+        """An AsyncCollection for the model, made once per kale.Collection"""
+        collection = cls.collection
+        async_collection = getattr(collection, '_async_collection', None)
+        if async_collection is None:
+            async_collection = AsyncCollection(collection, cls._executor)
+            collection._async_collection = async_collection
+        return async_collection
+
+    @classmethod
+    async def save_many(cls, instances, *args, **kwargs):
+        return await _run(cls._executor, super(AsyncModel, cls).save_many,
+                          instances, *args, **kwargs)
+
+    @classmethod
+    async def insert_many(cls, instances, *args, **kwargs):
+        return await _run(cls._executor, super(AsyncModel, cls).insert_many,
+                          instances, *args, **kwargs)
+
+    @classmethod
+    async def remove_many(cls, instances, *args, **kwargs):
+        return await _run(cls._executor, super(AsyncModel, cls).remove_many,
+                          instances, *args, **kwargs)
+
+    async def save(self, *args, **kwargs):
+        return await _run(self._executor, super(AsyncModel, self).save,
+                          *args, **kwargs)
+
+    async def insert(self, *args, **kwargs):
+        return await _run(self._executor, super(AsyncModel, self).insert,
+                          *args, **kwargs)
+
+    async def remove(self, spec=None, *args, **kwargs):
+        if spec:  # before the executor, so the error isn't deferred
+            raise kale.WrongLevel('Collection-level removes blah blah blah '
+                                  'use Model.async_collection.delete_many')
+        return await _run(self._executor, super(AsyncModel, self).remove,
+                          *args, **kwargs)
@@ -8,11 +8,16 @@
     :license: :) see http://license.visualidiot.com/
 """
 
+import sys
 from setuptools import setup
 
 
 readme = open('README.md').read()
 
+py_modules = ['kale']
+if sys.version_info >= (3, 5):  # kale_async is async/await syntax
+    py_modules.append('kale_async')
+
 
 setup(
     name='kale',
@@ -23,6 +28,6 @@ setup(
     license=':) released by Calama Consulting',
     description='Tiny PyMongo model layer',
     long_description=readme,
-    install_requires=['pymongo'],
-    py_modules=['kale'],
+    install_requires=['pymongo>=3.7,<4'],
+    py_modules=py_modules,
 )
@@ -1,6 +1,16 @@
+import gc
+import sys
+import json
+import time
+import datetime
 import unittest
+import weakref
 import warnings
+import functools
+import threading
+import bson
 import pymongo
+from bson.raw_bson import RawBSONDocument
 from bson import ObjectId
 import kale
 
@@ -299,6 +309,414 @@ class TestModel(unittest.TestCase):
         gc.collect()
         self.assertFalse(self.EmptyModel._live_documents, 'document lived!')
 
+    def test_identity_map_per_collection(self):
+        class OtherModel(kale.Model):
+            _database = self.connection[self.database_name]
+            _collection_name = 'other_models'
+
+        a = self.EmptyModel.inflate({'_id': 1})
+        b = OtherModel.inflate({'_id': 1})
+        self.assertIsNot(a, b)
+        self.assertIs(type(b), OtherModel)
+        self.assertIs(self.EmptyModel.inflate({'_id': 1}), a)
+
+    def test_identity_map_stats(self):
+        a = self.EmptyModel.inflate({'_id': 1})
+        self.EmptyModel.inflate({'_id': 1})
+        self.EmptyModel.inflate({'_id': 2})
+        stats = self.EmptyModel.identity_map.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(stats['live'], 1)
+        self.assertEqual(stats['held'], 0)
+
+    def test_identity_map_keep(self):
+        import gc
+
+        class KeepModel(self.EmptyModel):
+            _identity_map_keep = 2
+
+        for _id in range(3):
+            KeepModel.inflate({'_id': _id})
+        gc.collect()
+        self.assertNotIn(0, KeepModel.identity_map)
+        self.assertIn(1, KeepModel.identity_map)
+        self.assertIn(2, KeepModel.identity_map)
+        self.assertEqual(KeepModel.identity_map.stats()['evictions'], 1)
+        KeepModel.inflate({'_id': 1})  # now the most recently used
+        KeepModel.inflate({'_id': 3})
+        gc.collect()
+        self.assertIn(1, KeepModel.identity_map)
+        self.assertNotIn(2, KeepModel.identity_map)
+
+    def test_identity_map_evict_and_clear(self):
+        a = self.EmptyModel.inflate({'_id': 1})
+        b = self.EmptyModel.inflate({'_id': 2})
+        self.EmptyModel.identity_map.evict(1)
+        self.assertIsNot(self.EmptyModel.inflate({'_id': 1}), a)
+        self.EmptyModel.identity_map.clear()
+        self.assertFalse(self.EmptyModel.identity_map)
+        self.assertIsNot(self.EmptyModel.inflate({'_id': 2}), b)
+
+    def test_live_documents_dict_api(self):
+        live = self.EmptyModel._live_documents
+        a = self.EmptyModel.inflate({'_id': 1})
+        b = self.EmptyModel.inflate({'_id': 2})
+        self.assertEqual(sorted(live), [1, 2])
+        self.assertEqual(sorted(live.keys()), [1, 2])
+        self.assertEqual(sorted(live.items()), [(1, a), (2, b)])
+        self.assertIn(b, live.values())
+        self.assertIs(live.get(3, 'nope'), 'nope')
+        del live[1]
+        self.assertNotIn(1, live)
+        self.assertRaises(KeyError, live.__delitem__, 1)
+        self.assertIs(live.pop(2), b)
+        self.assertIsNone(live.pop(2, None))
+        self.assertRaises(KeyError, live.pop, 2)
+
+    def test_remove_evicts(self):
+        a = self.EmptyModel()
+        _id = a.save()
+        a.remove()
+        self.assertNotIn(_id, self.EmptyModel.identity_map)
+
+    def test_refresh_keep_local(self):
+        a = self.EmptyModel.inflate({'_id': 1, 'x': 1})
+        b = self.EmptyModel.inflate({'_id': 1, 'x': 2})
+        self.assertIs(b, a)
+        self.assertEqual(a.x, 1)
+
+    def test_refresh_overwrite(self):
+        a = self.EmptyModel.inflate({'_id': 1, 'x': 1, 'y': 1})
+        a.y = 5
+        b = self.EmptyModel.inflate({'_id': 1, 'x': 2}, kale.OVERWRITE)
+        self.assertIs(b, a)
+        self.assertEqual(dict(a), {'_id': 1, 'x': 2})
+        self.assertEqual(a.pending_changes(), {})
+
+    def test_refresh_merge(self):
+        a = self.EmptyModel.inflate({'_id': 1, 'n': {'x': 1, 'y': 1}, 'z': 1})
+        a.n.y = 5
+        del a.z
+        self.EmptyModel.inflate({'_id': 1, 'n': {'x': 2, 'y': 2}, 'z': 2},
+                                kale.MERGE)
+        self.assertEqual(a, {'_id': 1, 'n': {'x': 2, 'y': 5}})
+        self.assertEqual(a.pending_changes(), {'$set': {'n.y': 5},
+                                       '$unset': {'z': ''}})
+
+    def test_refresh_unchanged_keeps_values(self):
+        a = self.EmptyModel.inflate({'_id': 1, 'n': {'x': 1}})
+        n = a.n
+        self.EmptyModel.inflate({'_id': 1, 'n': {'x': 1}}, kale.OVERWRITE)
+        self.assertIs(a.n, n)
+
+    def test_refresh_bad_policy(self):
+        a = self.EmptyModel.inflate({'_id': 1})
+        with self.assertRaises(ValueError):
+            self.EmptyModel.inflate({'_id': 1}, 'lalala')
+
+    def test_refresh_policy_on_queries(self):
+        class FreshModel(self.EmptyModel):
+            _refresh_policy = kale.OVERWRITE
+
+        a = FreshModel({'x': 1})
+        _id = a.save()
+        FreshModel.collection.raw().update_one({'_id': _id},
+                                               {'$set': {'x': 2}})
+        self.assertEqual(FreshModel.collection.find_one(_id).x, 2)
+        FreshModel.collection.raw().update_one({'_id': _id},
+                                               {'$set': {'x': 3}})
+        found = FreshModel.collection.find_one(_id, refresh=kale.KEEP_LOCAL)
+        self.assertEqual(found.x, 2)
+        self.assertEqual([m.x for m in FreshModel.collection.find()], [3])
+        self.assertIs(a, found)
+
+    def test_partial_save_is_scoped(self):
+        raw = self.EmptyModel.collection.raw()
+        _id = raw.insert_one({'a': 1, 'b': {'c': 2, 'd': 3}}).inserted_id
+        partial = self.EmptyModel.collection.find_one(_id, ['a'])
+        self.assertEqual(set(dict.keys(partial)), set(['_id', 'a']))
+        partial.a = 5
+        partial.save()
+        self.assertEqual(raw.find_one(_id),
+                         {'_id': _id, 'a': 5, 'b': {'c': 2, 'd': 3}})
+        partial.save(w=1)  # whole-document save fetches the rest first
+        self.assertEqual(raw.find_one(_id),
+                         {'_id': _id, 'a': 5, 'b': {'c': 2, 'd': 3}})
+
+    def test_partial_fetches_on_access(self):
+        raw = self.EmptyModel.collection.raw()
+        _id = raw.insert_one({'a': 1, 'b': {'c': 2, 'd': 3}}).inserted_id
+        partial = self.EmptyModel.collection.find_one(_id, {'b.c': 1})
+        self.assertEqual(partial.b, {'c': 2})
+        del partial.b.c
+        self.assertEqual(partial['a'], 1)
+        self.assertEqual(partial.b, {'d': 3}, 'local changes stay')
+        self.assertEqual(partial.pending_changes(), {'$unset': {'b.c': ''}})
+        with self.assertRaises(AttributeError):
+            partial.lalala
+        with self.assertRaises(KeyError):
+            partial['lalala']
+
+    def test_partial_get(self):
+        raw = self.EmptyModel.collection.raw()
+        _id = raw.insert_one({'a': 1, 'sub': {'b': 2}}).inserted_id
+        partial = self.EmptyModel.collection.find_one(_id, ['a'])
+        self.assertEqual(partial.get('sub'), {'b': 2})
+        self.assertIsNone(partial.get('lalala'))
+        self.assertEqual(partial.get('lalala', 3), 3)
+
+    def test_partial_contains(self):
+        raw = self.EmptyModel.collection.raw()
+        _id = raw.insert_one({'a': 1, 'sub': {'b': 2}}).inserted_id
+        partial = self.EmptyModel.collection.find_one(_id, ['a'])
+        self.assertIn('sub', partial)
+        self.assertNotIn('lalala', partial)
+        self.assertEqual(partial.sub.b, 2)
+
+    def test_partial_fetch_together(self):
+        raw = self.EmptyModel.collection.raw()
+        raw.insert_many([{'n': n, 'x': -n} for n in range(5)])
+        fetches = []
+        find = raw.find
+
+        def counting_find(*args, **kwargs):
+            fetches.append(args)
+            return find(*args, **kwargs)
+        raw.find = counting_find
+        try:
+            together = list(self.EmptyModel.collection.find(
+                {}, ['n'], fetch_together=True))
+            self.assertEqual([m.x for m in together], [0, -1, -2, -3, -4])
+            self.assertEqual(len(fetches), 1)
+            self.EmptyModel.identity_map.clear()
+            alone = list(self.EmptyModel.collection.find({}, ['n']))
+            self.assertEqual([m.x for m in alone], [0, -1, -2, -3, -4])
+            self.assertEqual(len(fetches), 6)
+        finally:
+            del raw.find
+
+    def test_partial_refresh(self):
+        a = self.EmptyModel({'x': 1, 'y': {'z': 1, 'w': 1}})
+        _id = a.save()
+        a.x = 5
+        self.EmptyModel.collection.raw().update_one(
+            {'_id': _id}, {'$set': {'y.z': 2}})
+        self.EmptyModel.collection.find_one(_id, ['y.z'],
+                                            refresh=kale.OVERWRITE)
+        self.assertEqual(a, {'_id': _id, 'x': 5, 'y': {'z': 2, 'w': 1}})
+        self.assertEqual(a.pending_changes(), {'$set': {'x': 5}})
+        assert a._partial is None, 'a was loaded whole before'
+
+    def count_queries(self, model):
+        queries = []
+        collection = model.collection
+        find = collection.find
+
+        def counting_find(*args, **kwargs):
+            queries.append(args)
+            return find(*args, **kwargs)
+        collection.find = counting_find
+        self.addCleanup(delattr, collection, 'find')
+        return queries
+
+    def test_query_cache_off(self):
+        _id = self.EmptyModel().save()
+        queries = self.count_queries(self.EmptyModel)
+        self.EmptyModel.collection.find_one(_id)
+        self.EmptyModel.collection.find_one(_id)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(self.EmptyModel.query_cache.stats()['hits'], 0)
+
+    def test_query_cache(self):
+        class CachedModel(self.EmptyModel):
+            _query_cache_size = 10
+
+        a = CachedModel({'email': 'a@example.com'})
+        b = CachedModel({'email': 'b@example.com'})
+        a_id, b_id = a.save(), b.save()
+        queries = self.count_queries(CachedModel)
+        find_one = CachedModel.collection.find_one
+        self.assertIs(find_one(a_id), a)
+        self.assertIs(find_one({'_id': a_id}), a)
+        self.assertIs(find_one({'email': 'b@example.com'}), b)
+        self.assertIsNone(find_one('missing'))
+        self.assertIsNone(find_one('missing'))
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(CachedModel.query_cache.stats()['hits'], 2)
+
+        b.email = 'c@example.com'
+        b.save()
+        self.assertIs(find_one(a_id), a, 'other documents stay cached')
+        self.assertEqual(len(queries), 3)
+        self.assertIsNone(find_one({'email': 'b@example.com'}))
+        self.assertEqual(len(queries), 4)
+
+        CachedModel.collection.insert_one({'_id': 'missing'})
+        self.assertEqual(find_one('missing'), {'_id': 'missing'})
+        CachedModel.collection.update_many({}, {'$set': {'x': 1}})
+        self.assertEqual(find_one('missing').x, 1)
+        a.remove()
+        self.assertIsNone(find_one(a_id))
+        self.assertEqual(len(queries), 7)
+
+    def test_query_cache_bounds(self):
+        class CachedModel(self.EmptyModel):
+            _query_cache_size = 2
+            _query_cache_ttl = 60
+
+        ids = [CachedModel({'n': n}).save() for n in range(3)]
+        for _id in ids:
+            CachedModel.collection.find_one(_id)
+        cache = CachedModel.query_cache
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        now = kale._now
+        kale._now = lambda: now() + 61
+        try:
+            CachedModel.collection.find_one(ids[2])
+        finally:
+            kale._now = now
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_query_cache_invalidated_while_reading(self):
+        class CachedModel(self.EmptyModel):
+            _query_cache_size = 10
+
+        _id = CachedModel({'n': 1}).save()
+        collection = CachedModel.collection
+        find = collection.find
+
+        def racing_find(*args, **kwargs):
+            cursor = find(*args, **kwargs)
+            collection.query_cache.invalidate([_id])  # a write, meanwhile
+            return cursor
+        collection.find = racing_find
+        try:
+            collection.find_one(_id)
+        finally:
+            del collection.find
+        self.assertEqual(len(collection.query_cache), 0)
+        collection.find_one(_id)
+        self.assertEqual(len(collection.query_cache), 1)
+
+    def test_query_cache_key(self):
+        key = kale.QueryCache.key
+        self.assertEqual(key({'a': 1, 'b': 2}), key({'b': 2, 'a': 1}))
+        self.assertEqual(key(1), key({'_id': 1}))
+        self.assertEqual(key({}, ['a', 'b']), key({}, {'b': 1, 'a': 1}))
+        self.assertNotEqual(key({}), key({}, ['a']))
+        self.assertIsNone(key({'a': object()}))
+
+    def test_decoded_documents(self):
+        _id = self.EmptyModel.collection.raw().insert_one({
+            'meta': {'a': {'b': 1}}, 'items': [{'k': 1}, 2],
+        }).inserted_id
+        instance = self.EmptyModel.collection.find_one(_id)
+        self.assertIs(type(instance), self.EmptyModel)
+        self.assertIs(type(instance.meta), kale.AttrDict)
+        self.assertIs(type(instance.meta.a), kale.AttrDict)
+        self.assertIs(type(instance['items'][0]), kale.AttrDict)
+        instance.meta.a.b = 2
+        instance['items'][0].k = 2
+        self.assertEqual(instance.pending_changes(), {'$set': {
+            'meta.a.b': 2, 'items': [{'k': 2}, 2]}})
+        self.assertIs(self.EmptyModel.collection.find_one(_id), instance)
+        plain = self.EmptyModel.collection.find_one(_id, inflate=False)
+        self.assertIs(type(plain), dict)
+        self.assertIs(type(plain['meta']), dict)
+
+    def test_decoded_in_place(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n, 'meta': {'a': n}} for n in range(5)])
+        decoded = []
+        inflate_many = self.EmptyModel.inflate_many
+
+        def spying(documents, *args):
+            decoded.extend((document, type(document))
+                           for document in documents)
+            return inflate_many(documents, *args)
+        self.EmptyModel.inflate_many = spying
+        try:
+            instances = list(self.EmptyModel.collection.find().batch_size(2))
+            self.EmptyModel.identity_map.clear()
+            instances += list(self.EmptyModel.collection.aggregate(
+                [{'$sort': {'n': 1}}], batch_size=2))
+        finally:
+            del self.EmptyModel.inflate_many
+        self.assertEqual(len(instances), 10)
+        for instance, (document, kind) in zip(instances, decoded):
+            self.assertIs(kind, kale._DecodedDocument)
+            self.assertIs(instance, document)
+
+    def test_other_results_plain(self):
+        _id = self.EmptyModel.collection.raw().insert_one(
+            {'meta': {'a': 1}, 'items': [{'k': 1}]}).inserted_id
+        found = self.EmptyModel.collection.find_one_and_update(
+            {'_id': _id}, {'$set': {'n': 1}})
+        self.assertIs(type(found), dict)
+        self.assertIs(type(found['meta']), dict)
+        self.assertIs(type(found['items'][0]), dict)
+
+    def test_decoded_documents_slots(self):
+        class SlotModel(self.EmptyModel):
+            __slots__ = ('extra',)
+
+        raw = SlotModel.collection.raw()
+        _id = raw.insert_one({'a': {'b': 1}}).inserted_id
+        instance = SlotModel.collection.find_one(_id)
+        self.assertIs(type(instance), SlotModel)
+        instance.a.b = 2
+        self.assertEqual(instance.pending_changes(), {'$set': {'a.b': 2}})
+
+    def test_raw_bson(self):
+        class RawModel(self.EmptyModel):
+            _raw_bson = True
+
+        _id = RawModel.collection.raw().insert_one({
+            'meta': {'a': {'b': 1}}, 'items': [{'k': 1}, 2], 'n': 1,
+        }).inserted_id
+        instance = RawModel.collection.find_one(_id)
+        assert isinstance(instance, RawModel)
+        self.assertIs(type(dict.__getitem__(instance, 'meta')),
+                      RawBSONDocument)
+        self.assertEqual(instance.meta.a.b, 1)
+        assert isinstance(instance.meta.a, kale.AttrDict)
+        self.assertEqual(instance['items'][0].k, 1)
+        self.assertEqual(instance.n, 1)
+        self.assertIs(type(RawModel.collection.raw().find_one(_id)), dict)
+
+        sent = []
+        save = RawModel.collection.save
+        RawModel.collection.save = lambda doc, *a, **kw: (
+            sent.append(doc) or save(doc, *a, **kw))
+        self.addCleanup(delattr, RawModel.collection, 'save')
+        instance.save(w=1)
+        self.assertIs(type(sent[-1]), RawBSONDocument, 'sent as it came')
+        instance.meta.a.b = 2
+        self.assertEqual(instance.pending_changes(), {'$set': {'meta.a.b': 2}})
+        instance.save(w=1)
+        self.assertIs(sent[-1], instance, 'changed, so encoded again')
+        self.assertEqual(RawModel.collection.raw().find_one(_id)['meta'],
+                         {'a': {'b': 2}})
+
+    def test_raw_bson_json(self):
+        class RawModel(self.EmptyModel):
+            _raw_bson = True
+
+        RawModel.collection.raw().insert_many([
+            {'_id': n, 'meta': {'a': {'b': n}}, 'items': [{'k': n}]}
+            for n in range(3)])
+        instance = RawModel.collection.find_one(1)
+        expected = {'_id': 1, 'meta': {'a': {'b': 1}}, 'items': [{'k': 1}]}
+        for extended in (False, True):
+            self.assertEqual(json.loads(instance.to_json(extended)),
+                             expected)
+            chunks = RawModel.collection.find().sort('_id').iter_json(
+                size=2, extended=extended)
+            self.assertEqual([document['meta']['a']['b'] for document in
+                              json.loads(''.join(chunks))], [0, 1, 2])
+
     def test_cached_db_regression(self):
         db1 = self.connection[self.database_name]
         db2 = self.connection[self.database_name + '2']
@@ -317,10 +735,1080 @@ class TestModel(unittest.TestCase):
         finally:
             self.connection.drop_database(self.database_name + '2')
 
+    def test_inflated_has_no_changes(self):
+        instance = self.EmptyModel.inflate({'_id': 1, 'a': {'b': [{}]}})
+        self.assertEqual(instance.pending_changes(), {})
+
+    def test_changes_top_level(self):
+        instance = self.EmptyModel.inflate({'_id': 1, 'a': 1, 'b': 2})
+        instance.a = 3
+        del instance.b
+        instance.c = 4
+        self.assertEqual(instance.pending_changes(), {'$set': {'a': 3, 'c': 4},
+                                              '$unset': {'b': ''}})
+
+    def test_changes_nested(self):
+        instance = self.EmptyModel.inflate({'_id': 1, 'a': {'b': {'c': 1}}})
+        instance.a.b.c = 2
+        instance.a.b.pop('missing', None)
+        self.assertEqual(instance.pending_changes(), {'$set': {'a.b.c': 2}})
+
+    def test_changes_in_lists(self):
+        instance = self.EmptyModel.inflate({'_id': 1, 'l': [{'a': 1}, 2]})
+        instance.l[0].a = 5
+        self.assertEqual(instance.pending_changes(),
+                         {'$set': {'l': [{'a': 5}, 2]}})
+        instance._mark_clean()
+        instance.l.append(3)
+        self.assertEqual(instance.pending_changes(),
+                         {'$set': {'l': [{'a': 5}, 2, 3]}})
+
+    def test_changes_replaced_parent(self):
+        instance = self.EmptyModel.inflate({'_id': 1, 'a': {'b': 1}})
+        old_a = instance.a
+        instance.a.b = 2
+        instance.a = {'c': 3}
+        old_a.b = 4
+        self.assertEqual(instance.pending_changes(), {'$set': {'a': {'c': 3}}})
+
+    def test_save_sends_only_changes(self):
+        instance = self.EmptyModel({'a': 1, 'b': 1})
+        _id = instance.save()
+        self.EmptyModel.collection.raw().update_one({'_id': _id},
+                                                   {'$set': {'b': 2}})
+        instance.a = 2
+        instance.save()
+        self.assertEqual(instance.pending_changes(), {})
+        stored = self.EmptyModel.collection.raw().find_one(_id)
+        self.assertEqual(stored, {'_id': _id, 'a': 2, 'b': 2})
+
+    def test_save_unchanged_is_noop(self):
+        instance = self.EmptyModel({'a': 1})
+        _id = instance.save()
+        self.EmptyModel.collection.raw().remove(_id)
+        self.assertEqual(instance.save(), _id)
+        self.assertEqual(self.EmptyModel.collection.count(), 0)
+
+    def test_save_changes_after_outside_remove(self):
+        instance = self.EmptyModel({'a': 1})
+        _id = instance.save()
+        self.EmptyModel.collection.raw().remove(_id)
+        instance.b = 2
+        instance.save()
+        stored = self.EmptyModel.collection.raw().find_one(_id)
+        self.assertEqual(stored, {'_id': _id, 'a': 1, 'b': 2})
+
+    def test_save_changes_unacknowledged(self):
+        self.EmptyModel.collection.raw().insert_one({'_id': 1, 'a': 1})
+        unacknowledged = pymongo.MongoClient(w=0)
+        self.addCleanup(unacknowledged.close)
+
+        class FireAndForgetModel(kale.Model):
+            _database = unacknowledged[self.database_name]
+            _collection_name = 'empty_models'
+
+        instance = FireAndForgetModel.collection.find_one(1)
+        instance.a = 2
+        self.assertEqual(instance.save(), 1)
+        for _ in range(50):  # nothing waits for it to be written
+            if FireAndForgetModel.collection.raw().find_one(1)['a'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.EmptyModel.collection.raw().find_one(1),
+                         {'_id': 1, 'a': 2})
+
+    def test_copies_track_separately(self):
+        import copy
+        instance = self.EmptyModel.inflate({'_id': 1, 'a': {'b': 1}})
+        duplicate = copy.deepcopy(instance)
+        duplicate._mark_clean()
+        duplicate.a.b = 2
+        self.assertEqual(instance.pending_changes(), {})
+        self.assertEqual(duplicate.pending_changes(), {'$set': {'a.b': 2}})
+
+    def lazy_model(self):
+        class LazyModel(self.EmptyModel):
+            _lazy_inflate = True
+        return LazyModel
+
+    def test_lazy_inflate_access(self):
+        json = {'_id': 1, 'a': {'b': {'c': 1}}, 'l': [{'d': 2}, 3, [4]]}
+        instance = self.lazy_model().inflate(json)
+        self.assertIs(type(instance.a), kale.AttrDict)
+        self.assertIs(instance.a, instance['a'])
+        self.assertIs(type(instance.a.b), kale.AttrDict)
+        self.assertEqual(instance.a.b.c, 1)
+        self.assertIsInstance(instance.l, list)
+        self.assertIs(type(instance.l[0]), kale.AttrDict)
+        self.assertEqual(instance.l[0].d, 2)
+        self.assertIs(type(instance.l[2]), list)
+
+    def test_lazy_inflate_matches_eager(self):
+        json = {'_id': 1, 'a': {'b': [{'c': 1}]}, 'd': 'e'}
+        lazy = self.lazy_model().inflate(json)
+        eager = self.EmptyModel.inflate(json)
+        self.assertEqual(repr(lazy)[len('<LazyModel'):],
+                         repr(eager)[len('<EmptyModel'):])
+        self.assertEqual(lazy, eager)
+        self.assertIs(type(lazy.get('a')), kale.AttrDict)
+        for value in self.lazy_model().inflate(json).values():
+            self.assertNotIn(type(value), (dict, list))
+        for key, value in self.lazy_model().inflate(json).items():
+            self.assertNotIn(type(value), (dict, list))
+
+    def test_lazy_inflate_tracks_changes(self):
+        instance = self.lazy_model().inflate({'_id': 1, 'a': {'b': [{}]}})
+        self.assertEqual(instance.pending_changes(), {})
+        instance.a.b[0].c = 1
+        self.assertEqual(instance.pending_changes(),
+                         {'$set': {'a.b': [{'c': 1}]}})
+
+    @unittest.skipIf(sys.version_info < (3,), 'py2 copies dicts directly')
+    def test_lazy_inflate_copies(self):
+        def updated(d):
+            copied = {}
+            copied.update(d)
+            return copied
+        json = {'_id': 1, 'l': [1], 'a': {'b': 1}}
+        for copy in (dict, lambda d: dict(**d), updated):
+            instance = self.lazy_model().inflate(json)
+            copied = copy(instance)
+            copied['l'].append(2)
+            copied['a']['b'] = 2
+            self.assertEqual(instance.pending_changes(),
+                             {'$set': {'l': [1, 2], 'a.b': 2}})
+        self.assertEqual(json, {'_id': 1, 'l': [1], 'a': {'b': 1}})
+
+    def test_lazy_inflate_round_trip(self):
+        LazyModel = self.lazy_model()
+        _id = LazyModel({'a': {'b': [{'c': 1}]}}).save()
+        LazyModel._live_documents.clear()
+        loaded = LazyModel.collection.find_one(_id)
+        loaded.a.b[0].c = 2
+        loaded.save()
+        stored = LazyModel.collection.raw().find_one(_id)
+        self.assertEqual(stored, {'_id': _id, 'a': {'b': [{'c': 2}]}})
+
+    def test_save_many(self):
+        existing = self.EmptyModel({'a': 0})
+        existing.save()
+        existing.a = 1
+        instances = [existing] + [self.EmptyModel({'a': n})
+                                  for n in range(2, 7)]
+        ids = self.EmptyModel.save_many(instances, batch_size=2)
+        self.assertEqual(ids, [instance._id for instance in instances])
+        self.assertEqual(self.EmptyModel.collection.count(), 6)
+        for instance in instances:
+            self.assertEqual(instance.pending_changes(), {})
+            self.assertIs(self.EmptyModel.collection.find_one(instance._id),
+                          instance)
+        self.assertEqual(
+            self.EmptyModel.collection.raw().find_one(existing._id)['a'], 1)
+
+    def test_save_many_clean(self):
+        instances = [self.EmptyModel({'a': n}) for n in range(3)]
+        ids = self.EmptyModel.save_many(instances)
+        self.assertEqual(self.EmptyModel.save_many(instances), ids)
+        found = self.EmptyModel.collection.find_one(ids[0])
+        self.assertEqual(self.EmptyModel.save_many([found]), [ids[0]])
+        instances[2].a = 5
+        self.EmptyModel.save_many(instances, batch_size=2)  # clean, then not
+        self.assertEqual(
+            self.EmptyModel.collection.raw().find_one(ids[2])['a'], 5)
+
+    def test_save_many_restores_removed(self):
+        instance = self.EmptyModel({'a': 1})
+        instance.save()
+        self.EmptyModel.collection.raw().remove(instance._id)
+        instance.b = 2
+        self.EmptyModel.save_many([instance])
+        stored = self.EmptyModel.collection.raw().find_one(instance._id)
+        self.assertEqual(stored, {'_id': instance._id, 'a': 1, 'b': 2})
+
+    def test_insert_many_errors(self):
+        existing = self.EmptyModel()
+        existing.insert()
+        duplicate = self.EmptyModel({'_id': existing._id})
+        before, after = self.EmptyModel(), self.EmptyModel()
+        with self.assertRaises(kale.BulkError) as e:
+            self.EmptyModel.insert_many([before, duplicate, after])
+        self.assertEqual([i for i, _ in e.exception.errors], [duplicate])
+        self.assertEqual(e.exception.unwritten, [after])
+        assert before.is_in_db()
+        assert not after.is_in_db(), 'unwritten instances get no _id'
+        self.assertEqual(self.EmptyModel.collection.count(), 2)
+
+    def test_insert_many_unordered_errors(self):
+        existing = self.EmptyModel()
+        existing.insert()
+        duplicate = self.EmptyModel({'_id': existing._id})
+        after = self.EmptyModel()
+        with self.assertRaises(kale.BulkError) as e:
+            self.EmptyModel.insert_many([duplicate, after], ordered=False)
+        self.assertEqual(len(e.exception.errors), 1)
+        self.assertEqual(e.exception.unwritten, [])
+        assert after.is_in_db()
+        self.assertEqual(self.EmptyModel.collection.count(), 2)
+
+    def test_remove_many(self):
+        instances = [self.EmptyModel() for _ in range(5)]
+        self.EmptyModel.insert_many(instances)
+        unsaved = self.EmptyModel()
+        removed = self.EmptyModel.remove_many(instances[:3] + [unsaved],
+                                              batch_size=2)
+        self.assertEqual(removed, 3)
+        self.assertEqual(self.EmptyModel.collection.count(), 2)
+        assert not instances[0].is_in_db()
+
+    def test_collection_is_cached(self):
+        self.assertIs(self.EmptyModel.collection, self.EmptyModel.collection)
+        self.assertIs(self.EmptyModel().collection,
+                      self.EmptyModel.collection)
+
+    def test_collection_cache_per_class(self):
+        class SubModel(self.EmptyModel):
+            _collection_name = 'sub_models'
+
+        self.EmptyModel.collection  # warm the parent's cache
+        self.assertEqual(SubModel.collection.name, 'sub_models')
+        self.assertIs(SubModel.collection._model_class, SubModel)
+        self.assertEqual(self.EmptyModel.collection.name, 'empty_models')
+
+    def test_collection_cache_renamed(self):
+        first = self.EmptyModel.collection
+        self.EmptyModel._collection_name = 'renamed_models'
+        self.assertIsNot(self.EmptyModel.collection, first)
+        self.assertEqual(self.EmptyModel.collection.name, 'renamed_models')
+
+    def test_collection_cache_equal_database(self):
+        connection, name = self.connection, self.database_name
+
+        class FreshDatabaseModel(kale.Model):
+            _collection_name = 'empty_models'
+
+            @kale.classproperty
+            @classmethod
+            def _database(cls):
+                return connection[name]  # a new, equal one every time
+
+        self.assertIsNot(FreshDatabaseModel._database,
+                         FreshDatabaseModel._database)
+        self.assertIs(FreshDatabaseModel.collection,
+                      FreshDatabaseModel.collection)
+
+    def test_collection_cache_threads(self):
+        import threading
+        collections = []
+
+        def grab():
+            collections.append(self.EmptyModel.collection)
+
+        threads = [threading.Thread(target=grab) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, collections))), 1)
+
+
+class TestCompactModel(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = pymongo.MongoClient()
+        self.database_name = 'kale_testing_database'
+
+        class User(kale.CompactModel):
+            _database = self.connection[self.database_name]
+            _collection_name = 'users'
+            _fields = ('name', 'tags', 'address')
+
+        self.User = User
+
+    def tearDown(self):
+        self.connection.drop_database(self.database_name)
+
+    def test_to_json(self):
+        user = self.User({'name': 'uniphil', 'tags': ['a'], 'extra': 1})
+        self.assertEqual(json.loads(user.to_json()),
+                         {'name': 'uniphil', 'tags': ['a'], 'extra': 1})
+
+    def test_fields_in_slots(self):
+        user = self.User({'name': 'bob', 'shoe_size': 11})
+        self.assertEqual(dict.__len__(user), 1)
+        self.assertEqual(len(user), 2)
+        self.assertEqual(sorted(user), ['name', 'shoe_size'])
+        self.assertEqual(user.name, 'bob')
+        self.assertEqual(user['shoe_size'], 11)
+        self.assertNotIn('tags', user)
+        self.assertRaises(AttributeError, lambda: user.tags)
+        self.assertRaises(KeyError, lambda: user['tags'])
+        self.assertEqual(user, {'name': 'bob', 'shoe_size': 11})
+
+    def test_fields_are_cast(self):
+        user = self.User(address={'city': 'Montreal'}, tags=({'a': 1},))
+        self.assertIsInstance(user.address, kale.AttrDict)
+        self.assertIsInstance(user.tags, kale.TrackedList)
+        self.assertIsInstance(user.tags[0], kale.AttrDict)
+
+    def test_bad_fields(self):
+        for fields in (('_id',), ('save',), ('not a name',)):
+            with self.assertRaises(TypeError):
+                class Bad(kale.CompactModel):
+                    _fields = fields
+
+    def test_subclass_fields(self):
+        class Admin(self.User):
+            _fields = ('level',)
+        self.assertEqual(Admin._fields, ('name', 'tags', 'address', 'level'))
+        admin = Admin(name='root', level=9)
+        self.assertEqual(dict.__len__(admin), 0)
+        self.assertEqual(admin, {'name': 'root', 'level': 9})
+
+    def test_save_and_find(self):
+        user = self.User(name='bob', tags=['a'], address={'city': 'Paris'},
+                         shoe_size=11)
+        _id = user.save()
+        stored = self.User.collection.raw().find_one(_id)
+        self.assertEqual(stored, dict(user, _id=_id))
+        self.User.identity_map.clear()
+        found = self.User.collection.find_one(_id)
+        self.assertIsInstance(found, self.User)
+        self.assertEqual(found, stored)
+        self.assertEqual(found.address.city, 'Paris')
+
+    def test_save_sends_only_changes(self):
+        user = self.User(name='bob', tags=['a'], address={'city': 'Paris'})
+        user.save()
+        user.address.city = 'Lyon'
+        user.tags.append('b')
+        del user.name
+        self.assertEqual(user.pending_changes(), {
+            '$set': {'address.city': 'Lyon', 'tags': ['a', 'b']},
+            '$unset': {'name': ''}})
+        user.save()
+        self.assertEqual(self.User.collection.raw().find_one(user._id),
+                         {'_id': user._id, 'tags': ['a', 'b'],
+                          'address': {'city': 'Lyon'}})
+
+    def test_projection_fetches_fields(self):
+        _id = self.User(name='bob', tags=['a']).save()
+        self.User.identity_map.clear()
+        user = self.User.collection.find_one(_id, {'name': 1})
+        self.assertEqual(dict.__len__(user), 1)
+        self.assertEqual(user.tags, ['a'])
+        self.User.identity_map.clear()
+        user = self.User.collection.find_one(_id, {'name': 1})
+        self.assertIn('tags', user)
+        self.User.identity_map.clear()
+        user = self.User.collection.find_one(_id, {'name': 1})
+        self.assertEqual(user.get('tags'), ['a'])
+
+    def test_reload(self):
+        user = self.User(name='bob', tags=['a'])
+        _id = user.save()
+        self.User.collection.raw().update_one({'_id': _id},
+                                              {'$unset': {'tags': ''}})
+        self.User.collection.find_one(_id, refresh=kale.OVERWRITE)
+        self.assertEqual(user, {'_id': _id, 'name': 'bob'})
+
+    def test_copies_track_separately(self):
+        import copy
+        user = self.User.inflate({'_id': 1, 'address': {'city': 'Paris'}})
+        duplicate = copy.deepcopy(user)
+        duplicate._mark_clean()
+        duplicate.address.city = 'Lyon'
+        self.assertEqual(user.pending_changes(), {})
+        self.assertEqual(duplicate.pending_changes(),
+                         {'$set': {'address.city': 'Lyon'}})
+        self.assertEqual(user.address.city, 'Paris')
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = pymongo.MongoClient()
+        self.database_name = 'kale_testing_database'
+
+        class EmptyModel(kale.Model):
+            _database = self.connection[self.database_name]
+            _collection_name = 'empty_models'
+
+        self.EmptyModel = EmptyModel
+        self.events = []
+        kale.add_listener(self.events.append)
+        self.addCleanup(kale.remove_listener, self.events.append)
+
+    def tearDown(self):
+        self.connection.drop_database(self.database_name)
+
+    def operations(self):
+        return [event.operation for event in self.events]
+
+    def test_writes(self):
+        instance = self.EmptyModel(a=1)
+        instance.save()
+        instance.remove()
+        self.assertEqual(self.operations(), ['save', 'remove'])
+        save = self.events[0]
+        self.assertEqual(save.namespace, 'kale_testing_database.empty_models')
+        self.assertEqual(save.documents, 1)
+        self.assertGreater(save.duration, 0)
+        self.assertGreater(save.bytes, 0)
+
+    def test_find(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(5)])
+        list(self.EmptyModel.collection.find().batch_size(3))
+        self.assertEqual(self.operations(),
+                         ['find', 'inflate', 'find', 'inflate'])
+        self.assertEqual([event.documents for event in self.events],
+                         [3, 3, 2, 2])
+
+    def test_identity_map_hits(self):
+        instance = self.EmptyModel(a=1)
+        instance.save()
+        del self.events[:]
+        self.EmptyModel.collection.find_one(instance._id)
+        inflate, = [event for event in self.events
+                    if event.operation == 'inflate']
+        self.assertEqual((inflate.hits, inflate.misses), (1, 0))
+        self.assertEqual(self.operations()[-1], 'find_one')
+
+    def test_remove_listener(self):
+        kale.remove_listener(self.events.append)
+        self.EmptyModel().save()
+        self.assertEqual(self.events, [])
+
+    def test_operation_stats(self):
+        stats = kale.OperationStats(sizes=True)
+        kale.add_listener(stats)
+        self.addCleanup(kale.remove_listener, stats)
+        for n in range(3):
+            self.EmptyModel(n=n).save()
+        saves = stats.stats()[('save', 'kale_testing_database.empty_models')]
+        self.assertEqual(saves['count'], 3)
+        self.assertEqual(saves['documents'], 3)
+        self.assertGreater(saves['bytes'], 0)
+        self.assertAlmostEqual(saves['mean'] * 3, saves['seconds'])
+        stats.clear()
+        self.assertEqual(stats.stats(), {})
+
+    def test_statsd(self):
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        statsd = kale.StatsdListener(server.getsockname(), prefix='app')
+        self.addCleanup(statsd.close)
+        kale.add_listener(statsd)
+        self.addCleanup(kale.remove_listener, statsd)
+        self.EmptyModel().save()
+        lines = server.recv(4096).decode('utf-8').split('\n')
+        name = 'app.kale_testing_database.empty_models.save'
+        self.assertTrue(lines[0].startswith(name + '.time:'))
+        self.assertTrue(lines[0].endswith('|ms'))
+        self.assertIn(name + '.calls:1|c', lines)
+        self.assertIn(name + '.documents:1|c', lines)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = pymongo.MongoClient()
+        self.database_name = 'kale_testing_database'
+
+        class IndexedModel(kale.Model):
+            _database = self.connection[self.database_name]
+            _collection_name = 'indexed_models'
+            _indexes = [
+                'n',
+                [('team', pymongo.ASCENDING), ('joined', pymongo.DESCENDING)],
+                pymongo.IndexModel('email', unique=True),
+                pymongo.IndexModel('seen', expireAfterSeconds=3600),
+            ]
+            _explain_sample = 1
+
+        self.IndexedModel = IndexedModel
+        self.events = []
+        kale.add_listener(self.events.append)
+        self.addCleanup(kale.remove_listener, self.events.append)
+
+    def tearDown(self):
+        self.connection.drop_database(self.database_name)
+
+    def plans(self):
+        return [event for event in self.events
+                if event.operation == 'explain']
+
+    def test_provision(self):
+        names = ['n_1', 'team_1_joined_-1', 'email_1', 'seen_1']
+        namespace = self.IndexedModel.collection.full_name
+        self.assertEqual(kale.provision_indexes([self.IndexedModel]),
+                         {namespace: names})
+        self.assertEqual(kale.provision_indexes()[namespace], names,
+                         'every model, and again is fine')
+        information = self.IndexedModel.collection.index_information()
+        self.assertEqual(sorted(information), sorted(names + ['_id_']))
+        self.assertTrue(information['email_1']['unique'])
+
+        class Subclass(self.IndexedModel):
+            _indexes = self.IndexedModel._indexes + ['other']
+        self.assertEqual(kale.provision_indexes(
+            [self.IndexedModel, Subclass]), {namespace: names + ['other_1']})
+        self.assertEqual(kale.provision_indexes([kale.CompactModel]), {})
+
+    def test_explain_sample(self):
+        kale.provision_indexes([self.IndexedModel])
+        self.IndexedModel.collection.raw().insert_many(
+            [{'n': n, 'k': n % 2, 'email': n} for n in range(20)])
+        list(self.IndexedModel.collection.find({'k': 1}))
+        list(self.IndexedModel.collection.find({'k': 0}))
+        self.IndexedModel.collection.find_one({'n': 3})
+        list(self.IndexedModel.collection.find({'k': 1}).sort('n'))
+        plans = self.plans()
+        self.assertEqual([plan.shape for plan in plans],
+                         ['{"k": "?"}', '{"n": "?"}',
+                          '{"k": "?"} sort [["n", 1]]'])
+        self.assertEqual([plan.problem for plan in plans],
+                         ['COLLSCAN', None, 'COLLSCAN'])
+        self.assertIn('IXSCAN', plans[1].stages)
+        self.assertIs(plans[0].model, self.IndexedModel)
+        self.assertEqual((plans[0].examined, plans[0].returned), (20, 10))
+        finds = [event for event in self.events if event.operation == 'find']
+        self.assertEqual(len(finds), 4, 'explaining is not a find')
+
+    def test_explain_off(self):
+        self.IndexedModel._explain_sample = 0
+        list(self.IndexedModel.collection.find({'k': 1}))
+        self.assertEqual(self.plans(), [])
+
+    def test_query_shape(self):
+        self.assertEqual(kale._query_shape(
+            {'a': 1, 'b': {'$in': [1, 2]},
+             '$or': [{'c': 'x'}, {'d': {'$gt': 5}}]}),
+            {'a': '?', 'b': {'$in': '?'},
+             '$or': [{'c': '?'}, {'d': {'$gt': '?'}}]})
+
+    def test_unselective(self):
+        plan = {'queryPlanner': {'winningPlan': {
+                    'stage': 'FETCH', 'inputStage': {
+                        'stage': 'IXSCAN', 'indexName': 'k_1'}}},
+                'executionStats': {'nReturned': 5, 'totalKeysExamined': 900,
+                                   'totalDocsExamined': 900}}
+        event = kale.QueryPlan(self.IndexedModel, '{"k": "?"}', plan, 0.01)
+        self.assertEqual(event.stages, ['FETCH', 'IXSCAN'])
+        self.assertEqual(event.index, 'k_1')
+        self.assertEqual(event.problem, 'unselective')
+        plan['executionStats']['nReturned'] = 500
+        event = kale.QueryPlan(self.IndexedModel, '{"k": "?"}', plan, 0.01)
+        self.assertIsNone(event.problem)
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = pymongo.MongoClient()
+        self.database_name = 'kale_testing_database'
+
+        class EmptyModel(kale.Model):
+            _database = self.connection[self.database_name]
+            _collection_name = 'empty_models'
+
+        self.EmptyModel = EmptyModel
+        self.writes = []
+        collection = EmptyModel.collection
+        bulk_write = collection.bulk_write
+
+        def counting_bulk_write(requests, *args, **kwargs):
+            self.writes.append(list(requests))
+            return bulk_write(requests, *args, **kwargs)
+        collection.bulk_write = counting_bulk_write
+
+    def tearDown(self):
+        self.connection.drop_database(self.database_name)
+
+    def stored(self):
+        return list(self.EmptyModel.collection.raw().find().sort('n'))
+
+    def test_saves_coalesce(self):
+        existing = self.EmptyModel(n=0)
+        existing.save()
+        with kale.Session():
+            new = self.EmptyModel(n=1)
+            _id = new.save()
+            new.n = 2
+            new.save()
+            existing.n = 3
+            existing.save()
+            existing.save()
+            self.assertEqual(self.writes, [])
+            self.assertEqual(new._id, _id)
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(len(self.writes[0]), 2)
+        self.assertEqual(self.stored(), [{'_id': _id, 'n': 2},
+                                         {'_id': existing._id, 'n': 3}])
+        self.assertEqual(new.pending_changes(), {})
+        self.assertEqual(existing.pending_changes(), {})
+
+    def test_reads_see_pending(self):
+        existing = self.EmptyModel(n=0)
+        existing.save()
+        _id = existing._id
+        with kale.Session():
+            new = self.EmptyModel(n=1)
+            new.save()
+            self.assertIs(self.EmptyModel.collection.find_one(new._id), new)
+            existing.remove()
+            self.assertIsNone(self.EmptyModel.collection.find_one(_id))
+            self.assertFalse(existing.is_in_db())
+        self.assertEqual(self.stored(), [{'_id': new._id, 'n': 1}])
+
+    def test_pipelined_refresh_keeps_pending(self):
+        existing = self.EmptyModel(n=1)
+        existing.save()
+        with kale.Session():
+            existing.n = 99
+            existing.save()
+            for ahead in (False, True):
+                found = list(self.EmptyModel.collection.find(
+                    refresh=kale.OVERWRITE).pipeline(inflate=ahead))
+                self.assertEqual(found, [existing])
+                self.assertEqual(existing.n, 99)
+        self.assertEqual(self.stored(), [{'_id': existing._id, 'n': 99}])
+
+    def test_remove_unsaved(self):
+        with kale.Session():
+            instance = self.EmptyModel(n=1)
+            instance.save()
+            instance.remove()
+        self.assertEqual(self.writes, [])
+        self.assertFalse(instance.is_in_db())
+
+    def test_flush(self):
+        with kale.Session() as session:
+            self.EmptyModel(n=1).insert()
+            session.flush()
+            self.assertEqual(len(self.stored()), 1)
+            self.assertEqual(len(session), 0)
+        self.assertEqual(len(self.writes), 1)
+
+    def test_exception_rolls_back(self):
+        existing = self.EmptyModel(n=0)
+        existing.save()
+        _id = existing._id
+        with self.assertRaises(ValueError):
+            with kale.Session():
+                new = self.EmptyModel(n=1)
+                new.save()
+                existing.remove()
+                raise ValueError()
+        self.assertEqual(self.writes, [])
+        self.assertNotIn('_id', new)
+        self.assertEqual(existing._id, _id)
+        self.assertIs(self.EmptyModel.identity_map.get(_id), existing)
+        self.assertEqual(self.stored(), [{'_id': _id, 'n': 0}])
+
+    def test_failed_flush(self):
+        existing = self.EmptyModel(n=0)
+        existing.save()
+        with self.assertRaises(kale.BulkError) as raised:
+            with kale.Session():
+                first = self.EmptyModel(n=1)
+                first.save()
+                duplicate = self.EmptyModel(_id=existing._id, n=2)
+                duplicate.insert()
+                last = self.EmptyModel(n=3)
+                last.save()
+        self.assertEqual([instance for instance, _ in
+                          raised.exception.errors], [duplicate])
+        self.assertEqual(raised.exception.unwritten, [last])
+        self.assertTrue(first.is_in_db())
+        self.assertFalse(last.is_in_db())
+        self.assertEqual([doc['n'] for doc in self.stored()], [0, 1])
+
+    def test_models_sharing_a_collection(self):
+        class Special(self.EmptyModel):
+            pass
+
+        with kale.Session():
+            plain = self.EmptyModel(n=1)
+            plain.save()
+            special = Special(n=2)
+            special.save()
+            special.n = 3
+            special.save()
+        self.assertEqual([doc['n'] for doc in self.stored()], [1, 3])
+        self.assertIs(Special.identity_map.get(special._id), special)
+        self.assertIsNone(self.EmptyModel.identity_map.get(special._id))
+        self.assertIs(self.EmptyModel.identity_map.get(plain._id), plain)
+
+
+class TestChangeWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = pymongo.MongoClient()
+        self.database_name = 'kale_testing_database'
+
+        class EmptyModel(kale.Model):
+            _database = self.connection[self.database_name]
+            _collection_name = 'empty_models'
+            _query_cache_size = 10
+
+        self.EmptyModel = EmptyModel
+        self.instance = EmptyModel({'a': 1, 'b': 1})
+        self.instance.save()
+
+    def tearDown(self):
+        self.connection.drop_database(self.database_name)
+
+    def change(self, kind='update', document=None, lag=0):
+        _id = self.instance._id
+        return {'_id': {'_data': 'token'}, 'operationType': kind,
+                'documentKey': {'_id': _id},
+                'fullDocument': document and dict(document, _id=_id),
+                'clusterTime': bson.Timestamp(int(time.time() - lag), 1)}
+
+    def test_merge(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel)
+        self.instance.b = 5
+        watcher.apply(self.change(document={'a': 2, 'b': 2}))
+        self.assertEqual(self.instance.a, 2)
+        self.assertEqual(self.instance.b, 5, 'unsaved changes stay')
+        self.assertEqual(watcher.applied, 1)
+
+    def test_overwrite(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel, kale.OVERWRITE)
+        self.instance.b = 5
+        watcher.apply(self.change(document={'a': 2, 'b': 2}))
+        self.assertEqual((self.instance.a, self.instance.b), (2, 2))
+
+    def test_evict(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel, kale.EVICT)
+        watcher.apply(self.change(document={'a': 2}))
+        self.assertEqual(self.instance.a, 1)
+        self.assertNotIn(self.instance._id, self.EmptyModel.identity_map)
+        self.assertEqual(watcher.evicted, 1)
+
+    def test_delete(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel)
+        found = self.EmptyModel.collection.find_one(self.instance._id)
+        self.assertIs(found, self.instance)
+        self.assertEqual(len(self.EmptyModel.query_cache), 1)
+        watcher.apply(self.change('delete'))
+        self.assertNotIn(self.instance._id, self.EmptyModel.identity_map)
+        self.assertEqual(len(self.EmptyModel.query_cache), 0)
+
+    def test_drop(self):
+        other = self.EmptyModel()
+        other.save()
+        watcher = kale.ChangeWatcher(self.EmptyModel)
+        watcher.apply({'_id': {}, 'operationType': 'drop'})
+        self.assertEqual(len(self.EmptyModel.identity_map), 0)
+        self.assertEqual(watcher.resets, 1)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, kale.ChangeWatcher, self.EmptyModel,
+                          kale.KEEP_LOCAL)
+
+    def test_session_in_another_thread(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel, kale.OVERWRITE)
+        with kale.Session():
+            self.instance.b = 5
+            self.instance.save()
+            applying = threading.Thread(target=watcher.apply, args=(
+                self.change(document={'a': 2, 'b': 2}),))
+            applying.start()
+            applying.join()
+            self.assertEqual(self.instance.b, 5)
+        self.assertEqual(self.EmptyModel.collection.raw().find_one(
+            self.instance._id)['b'], 5)
+
+    def test_errors_keep_watching(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel)
+        calls = []
+
+        def broken():
+            calls.append(1)
+            if len(calls) == 2:
+                watcher._stopping.set()
+            raise ValueError('not a change we know')
+        watcher._follow = broken
+        watcher._run()
+        self.assertEqual(len(calls), 2)
+        self.assertIsInstance(watcher.error, ValueError)
+        self.assertEqual((watcher.errors, watcher.restarts), (2, 1))
+
+    def test_pending(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel, max_pending=2)
+        watcher._receive(self.change(document={'a': 2}))
+        watcher._receive(self.change(document={'a': 3}))
+        self.assertEqual(self.instance.a, 1)
+        self.assertEqual(watcher.stats()['pending'], 2)
+        self.assertEqual(watcher.apply_pending(), 2)
+        self.assertEqual(self.instance.a, 3)
+        for n in range(3):
+            watcher._receive(self.change(document={'a': n}))
+        self.assertEqual(watcher.resets, 1, 'too far behind')
+        self.assertEqual(watcher.stats()['pending'], 0)
+        self.assertEqual(len(self.EmptyModel.identity_map), 0)
+
+    def test_lag(self):
+        watcher = kale.ChangeWatcher(self.EmptyModel, in_thread=True,
+                                     max_lag=60)
+        watcher._receive(self.change(document={'a': 2}, lag=5))
+        stats = watcher.stats()
+        self.assertTrue(4 <= stats['lag'] <= 7)
+        self.assertEqual(stats['worst_lag'], stats['lag'])
+        self.assertEqual(self.instance.a, 2)
+        watcher._receive(self.change(document={'a': 3}, lag=120))
+        self.assertEqual(self.instance.a, 2)
+        self.assertEqual(watcher.resets, 1)
+        self.assertTrue(watcher.stats()['worst_lag'] >= 119)
+
+    def test_watch(self):
+        if not self.connection.admin.command('ismaster').get('setName'):
+            self.skipTest('change streams need a replica set')
+        with kale.ChangeWatcher(self.EmptyModel, in_thread=True,
+                                max_await_time_ms=50) as w:
+            time.sleep(0.5)
+            self.EmptyModel.collection.raw().update_one(
+                {'_id': self.instance._id}, {'$set': {'a': 2}})
+            for _ in range(100):
+                if w.applied:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(self.instance.a, 2)
+        self.assertIsNotNone(w.resume_token)
+
+
+class Author(kale.Model):
+    _database = pymongo.MongoClient(connect=False).kale_testing_database
+    _collection_name = 'authors'
+
+
+class Tag(kale.Model):
+    _database = pymongo.MongoClient(connect=False).kale_testing_database
+    _collection_name = 'tags'
+
+
+class Post(kale.Model):
+    _database = pymongo.MongoClient(connect=False).kale_testing_database
+    _collection_name = 'posts'
+    author = kale.Reference(Author)
+    tags = kale.Reference('Tag', many=True)
+    editor = kale.Reference(Author, key='editor_id')
+
+
+class TestReference(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = pymongo.MongoClient()
+        self.queries = []
+        for model in (Author, Tag, Post):
+            model.identity_map.clear()
+            def counting_find(*args, **kwargs):
+                self.queries.append(args)
+                return kwargs.pop('_find')(*args, **kwargs)
+            self.addCleanup(delattr, model.collection, 'find')
+            model.collection.find = functools.partial(
+                counting_find, _find=model.collection.find)
+
+    def tearDown(self):
+        self.connection.drop_database('kale_testing_database')
+
+    def test_lazy(self):
+        author = Author(name='ann')
+        author.save()
+        post = Post(author=author['_id'])
+        post.save()
+        del author
+        self.assertEqual(post.author.name, 'ann')
+        self.assertEqual(len(self.queries), 1)
+        post.author
+        self.assertEqual(len(self.queries), 1, 'kept with the post')
+        self.assertEqual(post['author'], post.author['_id'])
+
+    def test_assign(self):
+        author = Author(name='ann')
+        author.save()
+        post = Post()
+        post.author = author
+        post.editor = author
+        self.assertEqual(post['author'], author['_id'])
+        self.assertEqual(post['editor_id'], author['_id'])
+        self.assertIs(post.author, author)
+        self.assertEqual(self.queries, [])
+        self.assertRaises(ValueError, setattr, post, 'author', Author())
+        post.author = None
+        self.assertIsNone(post.author)
+
+    def test_many(self):
+        tags = [Tag(name=name) for name in 'abc']
+        Tag.save_many(tags)
+        post = Post(tags=[tag['_id'] for tag in tags] + ['gone'])
+        self.assertEqual([tag.name for tag in post.tags], ['a', 'b', 'c'])
+        self.assertEqual(self.queries, [({'_id': 'gone'},)],
+                         'the rest are live already')
+        post['tags'].pop(0)
+        self.assertEqual([tag.name for tag in post.tags], ['b', 'c'])
+
+    def test_prefetch(self):
+        authors = [Author(n=n) for n in range(3)]
+        Author.save_many(authors)
+        tags = [Tag(n=n) for n in range(3)]
+        Tag.save_many(tags)
+        Post.collection.raw().insert_many([
+            {'n': n, 'author': authors[n % 3]['_id'],
+             'editor_id': authors[0]['_id'],
+             'tags': [tag['_id'] for tag in tags[:n % 3]]}
+            for n in range(10)])
+        author_ids = [author['_id'] for author in authors]
+        del authors, tags
+        Author.identity_map.clear()
+        Tag.identity_map.clear()
+        posts = list(Post.collection.find().prefetch('author', 'editor',
+                                                      'tags'))
+        self.assertEqual(len(self.queries), 3, 'posts, authors and tags')
+        for post in posts:
+            self.assertEqual(post.author['_id'], author_ids[post.n % 3])
+            self.assertEqual(post.editor['_id'], author_ids[0])
+            self.assertEqual(len(post.tags), post.n % 3)
+        self.assertEqual(len(self.queries), 3)
+
+    def test_unknown_prefetch(self):
+        Post().save()
+        with self.assertRaises(AttributeError):
+            list(Post.collection.find().prefetch('nope'))
+
+
+class ScanModel(kale.Model):
+    # parallel_scan sends the model to its workers, so it can't be local
+    _database = pymongo.MongoClient(connect=False).kale_testing_database
+    _collection_name = 'scan_models'
+
+
+def double(instance):
+    return instance.n * 2
+
+
+def one(instance):
+    return 1
+
+
+def count(total, value):
+    return total + 1
+
+
+def fail_on_seven(instance):
+    if instance.n == 7:
+        raise ValueError('seven')
+    return instance.n
+
+
+class TestParallelScan(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = ScanModel.collection
+        self.collection.raw().insert_many(
+            [{'_id': n, 'n': n, 'even': n % 2 == 0} for n in range(50)])
+
+    def tearDown(self):
+        self.collection.drop()
+
+    def test_partition(self):
+        queries = self.collection.partition(partitions=4)
+        self.assertEqual(queries, self.collection.partition(partitions=4))
+        self.assertEqual(len(queries), 4)
+        counts = [self.collection.count_documents(query)
+                  for query in queries]
+        self.assertEqual(sum(counts), 50)
+        self.assertTrue(all(10 <= count <= 15 for count in counts), counts)
+
+    def test_partition_spec(self):
+        queries = self.collection.partition({'even': True}, partitions=3)
+        found = [doc['n'] for query in queries
+                 for doc in self.collection.raw().find(query)]
+        self.assertEqual(sorted(found), list(range(0, 50, 2)))
+
+    def test_partition_nulls(self):
+        self.collection.raw().update_many({'n': {'$lt': 20}},
+                                          {'$set': {'n': None}})
+        for partitions in (2, 3, 4, 6):
+            queries = self.collection.partition(key='n',
+                                                partitions=partitions)
+            found = [doc['_id'] for query in queries
+                     for doc in self.collection.raw().find(query)]
+            self.assertEqual(sorted(found), list(range(50)))
+
+    def test_scan(self):
+        results = self.collection.parallel_scan(fn=double, workers=3,
+                                                chunk=4)
+        self.assertEqual(sorted(results), [n * 2 for n in range(50)])
+
+    def test_scan_instances(self):
+        instances = list(self.collection.parallel_scan({'n': {'$lt': 5}},
+                                                       workers=2))
+        self.assertEqual(sorted(instance.n for instance in instances),
+                         list(range(5)))
+        for instance in instances:
+            self.assertIsInstance(instance, ScanModel)
+            self.assertEqual(instance.pending_changes(), {})
+
+    def test_reduce(self):
+        import operator
+        total = self.collection.parallel_scan(fn=double, workers=2,
+                                              partitions=5,
+                                              reduce=operator.add, initial=0)
+        self.assertEqual(total, sum(n * 2 for n in range(50)))
+
+    def test_reduce_initial_once(self):
+        import operator
+        for workers in (1, 4):
+            total = self.collection.parallel_scan(
+                fn=one, workers=workers, partitions=4, reduce=operator.add,
+                initial=10)
+            self.assertEqual(total, 60)
+        empty = self.collection.parallel_scan(
+            {'n': {'$lt': 0}}, fn=one, workers=2, reduce=operator.add,
+            initial=10)
+        self.assertEqual(empty, 10)
+
+    def test_reduce_combine(self):
+        import operator
+        total = self.collection.parallel_scan(
+            fn=one, workers=4, partitions=4, reduce=count, initial=0,
+            combine=operator.add)
+        self.assertEqual(total, 50)
+
+    def test_errors(self):
+        with self.assertRaises(kale.ScanError) as raised:
+            list(self.collection.parallel_scan(fn=fail_on_seven, workers=2))
+        self.assertIsInstance(raised.exception.error, ValueError)
+        self.assertIn('seven', raised.exception.traceback)
 
 
 class TestAttrDict(unittest.TestCase):
 
+    def test_to_json(self):
+        import datetime
+        import uuid
+        _id = ObjectId('5f0000000000000000000000')
+        thing = kale.AttrDict({
+            '_id': _id, 'when': datetime.datetime(2020, 1, 2, 3, 4, 5),
+            'uuid': uuid.UUID(int=1), 'data': bson.Binary(b'\x00\x01'),
+            'nested': {'ids': [_id], 'n': 1.5}})
+        self.assertEqual(json.loads(thing.to_json()), {
+            '_id': '5f0000000000000000000000',
+            'when': '2020-01-02T03:04:05Z',
+            'uuid': '00000000-0000-0000-0000-000000000001',
+            'data': 'AAE=', 'nested': {'ids': ['5f0000000000000000000000'],
+                                       'n': 1.5}})
+        extended = json.loads(kale.to_json([thing], extended=True))
+        self.assertEqual(extended[0]['_id'],
+                         {'$oid': '5f0000000000000000000000'})
+        self.assertRaises(TypeError, kale.to_json, {'no': object()})
+
     def test_bad_multi_arg_update(self):
         ad = kale.AttrDict()
         with self.assertRaises(TypeError):
@@ -362,6 +1850,77 @@ class TestAttrDict(unittest.TestCase):
         ad = kale.AttrDict(d)
         self.assertIs(type(ad.a[0]), list)
 
+    def test_dot_access(self):
+        ad = kale.AttrDict({'a': 1, 'keys': 2})
+        self.assertEqual(ad.a, 1)
+        self.assertEqual(ad['keys'], 2)
+        self.assertTrue(callable(ad.keys), 'methods beat keys')
+        self.assertIsNone(getattr(ad, 'lalala', None))
+        with self.assertRaises(AttributeError) as e:
+            ad.lalala
+        self.assertIn('lalala', str(e.exception))
+
+    def test_dot_set_and_delete(self):
+        class Described(kale.AttrDict):
+            note = None
+
+        ad = Described()
+        ad.a = 1
+        ad.note = 'class-level names are attributes'
+        self.assertEqual(dict(ad), {'a': 1})
+        self.assertEqual(ad.note, 'class-level names are attributes')
+        del ad.a
+        del ad.note
+        self.assertEqual(dict(ad), {})
+        self.assertIsNone(ad.note)
+
+    def test_attributes_added_later(self):
+        class Described(kale.AttrDict):
+            pass
+
+        class More(Described):
+            pass
+
+        ad = More(foo='key')
+        self.assertEqual(ad.foo, 'key')
+        Described.foo = property(lambda self: 'property')
+        self.assertEqual(ad.foo, 'property')
+        ad.bar = 1
+        More.bar = None
+        ad.bar = 2
+        self.assertEqual(dict(ad), {'foo': 'key', 'bar': 1})
+        del Described.foo
+        self.assertEqual(ad.foo, 'key')
+
+    def test_classes_collected(self):
+        def make():
+            class Local(kale.AttrDict):
+                pass
+            Local(a=1).a
+            return weakref.ref(Local)
+
+        ref = make()
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_list_cast_is_list(self):
+        ad = kale.AttrDict({'a': [1]})
+        self.assertIsInstance(ad.a, list)
+        self.assertEqual(ad.a, [1])
+
+    def test_pickle(self):
+        import pickle
+        ad = kale.AttrDict({'a': {'b': [{'c': 1}]}})
+        loaded = pickle.loads(pickle.dumps(ad))
+        self.assertEqual(loaded, ad)
+        self.assertIs(type(loaded.a.b[0]), kale.AttrDict)
+
+    def test_list_of_numbers_cast(self):
+        d = {'a': [1, {}]}
+        ad = kale.AttrDict(d)
+        self.assertIs(type(ad.a[1]), kale.AttrDict)
+        self.assertEqual(ad.a[0], 1)
+
     def test_mixed_list(self):
         d = {'a': ['b', {}]}
         ad = kale.AttrDict(d)
@@ -395,12 +1954,289 @@ class TestModelCollection(unittest.TestCase):
         out = self.EmptyModel.collection.find()[0]
         assert isinstance(out, self.EmptyModel)
 
+    def test_find_iteration_type(self):
+        self.EmptyModel().save()
+        for out in self.EmptyModel.collection.find():
+            assert isinstance(out, self.EmptyModel)
+
     def test_cursor_slice(self):
         for model in range(5):
             self.EmptyModel().save()
         self.connection.fsync()
         self.EmptyModel.collection.find()[2:4]
 
+    def test_find_batches_inflation(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(7)])
+        cursor = self.EmptyModel.collection.find().sort('n').batch_size(3)
+        instances = list(cursor)
+        self.assertEqual([instance.n for instance in instances],
+                         list(range(7)))
+        for instance in instances:
+            assert isinstance(instance, self.EmptyModel)
+        self.assertIs(self.EmptyModel.collection.find_one(instances[4]._id),
+                      instances[4])
+
+    def test_iter_batches(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(7)])
+        batches = list(self.EmptyModel.collection.find().sort('n')
+                       .batch_size(2).iter_batches(3))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual([instance.n for batch in batches
+                          for instance in batch], list(range(7)))
+        assert isinstance(batches[0][0], self.EmptyModel)
+
+    def test_cursor_alive(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(10)])
+        for size in (0, 3):
+            cursor = self.EmptyModel.collection.find().batch_size(size)
+            instances = []
+            while cursor.alive:
+                instances.append(next(cursor))
+            self.assertEqual(sorted(instance.n for instance in instances),
+                             list(range(10)))
+        cursor = self.EmptyModel.collection.aggregate([{'$sort': {'n': 1}}])
+        instances = []
+        while cursor.alive:
+            instances.append(next(cursor))
+        self.assertEqual(len(instances), 10)
+
+    def test_find_raw(self):
+        self.EmptyModel({'n': 1}).save()
+        cursor = self.EmptyModel.collection.find(inflate=False)
+        for out in cursor:
+            self.assertIs(type(out), dict)
+        self.assertIs(type(self.EmptyModel.collection.find(
+            inflate=False)[0]), dict)
+        self.assertIs(type(self.EmptyModel.collection.find_one(
+            inflate=False)), dict)
+        assert isinstance(self.EmptyModel.collection.find()[0],
+                          self.EmptyModel)
+
+    def test_cursor_rewind(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(3)])
+        cursor = self.EmptyModel.collection.find().sort('n')
+        self.assertEqual(next(cursor).n, 0)
+        cursor.rewind()
+        self.assertEqual([instance.n for instance in cursor], [0, 1, 2])
+
+    def test_cursor_index(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(5)])
+        self.assertIsInstance(self.EmptyModel.collection.find()[3],
+                              self.EmptyModel)
+        sliced = list(self.EmptyModel.collection.find().sort('n')[1:3])
+        self.assertEqual([instance.n for instance in sliced], [1, 2])
+        for instance in sliced:
+            self.assertIsInstance(instance, self.EmptyModel)
+
+    def test_aggregate(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'k': n % 3, 'n': n} for n in range(7)])
+        cursor = self.EmptyModel.collection.aggregate(
+            [{'$sort': {'n': 1}}], batch_size=2, allow_disk_use=True)
+        instances = list(cursor)
+        self.assertEqual([instance.n for instance in instances],
+                         list(range(7)))
+        for instance in instances:
+            self.assertIsInstance(instance, self.EmptyModel)
+        self.assertIs(self.EmptyModel.collection.find_one(instances[3]._id),
+                      instances[3])
+        batches = list(self.EmptyModel.collection.aggregate(
+            [{'$sort': {'n': 1}}], batch_size=2).iter_batches(3))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        plain = next(self.EmptyModel.collection.aggregate([], inflate=False))
+        self.assertIs(type(plain), dict)
+
+    def test_aggregate_projected_save(self):
+        raw = self.EmptyModel.collection.raw()
+        _id = raw.insert_one({'a': 1, 'b': 2, 'c': {'d': 3}}).inserted_id
+        found, = self.EmptyModel.collection.aggregate(
+            [{'$project': {'a': 1}}], model=self.EmptyModel)
+        self.assertEqual(found.a, 1)
+        found.a = 5
+        found.save()
+        found.save(w=1)
+        self.assertEqual(raw.find_one(_id),
+                         {'_id': _id, 'a': 5, 'b': 2, 'c': {'d': 3}})
+        self.EmptyModel.identity_map.clear()
+        whole, = self.EmptyModel.collection.aggregate([{'$match': {}}])
+        self.assertIsNone(whole._partial)
+
+    def test_aggregate_into_model(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'k': n % 3, 'n': n} for n in range(7)])
+
+        class Total(kale.Model):
+            _database = self.connection[self.database_name]
+            _collection_name = 'totals'
+
+        totals = list(self.EmptyModel.collection.aggregate(
+            [{'$group': {'_id': '$k', 'total': {'$sum': '$n'}}},
+             {'$sort': {'_id': 1}}], model=Total))
+        self.assertEqual([total.total for total in totals], [9, 5, 7])
+        for total in totals:
+            self.assertIsInstance(total, Total)
+        self.assertIs(Total.identity_map.peek(0), totals[0])
+        self.assertNotIn(0, self.EmptyModel.identity_map)
+
+    def test_aggregate_reshaped_unmapped(self):
+        raw = self.EmptyModel.collection.raw()
+        raw.insert_many([{'_id': n, 'k': n % 3, 'n': n} for n in range(7)])
+        totals = list(self.EmptyModel.collection.aggregate(
+            [{'$group': {'_id': '$k', 'total': {'$sum': '$n'}}},
+             {'$sort': {'_id': 1}}]))
+        self.assertEqual([total.total for total in totals], [9, 5, 7])
+        self.assertIsInstance(totals[0], self.EmptyModel)
+        self.assertNotIn(0, self.EmptyModel.identity_map)
+        self.assertNotIn('n', totals[0], "doesn't fetch from _id 0")
+        found = self.EmptyModel.collection.find_one(0)
+        self.assertIsNot(found, totals[0])
+        self.assertEqual(found.n, 0)
+
+    def test_to_json(self):
+        self.EmptyModel.collection.raw().insert_one(
+            {'_id': 1, 'sub': {'a': [{'b': 1}]}})
+        instance = self.EmptyModel.collection.find_one(1)
+        self.assertEqual(instance.to_json(), '{"_id":1,"sub":{"a":[{"b":1}]}}')
+        self.assertIsInstance(instance.sub, kale.AttrDict)
+
+    def test_iter_json(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'_id': n, 'when': datetime.datetime(2020, 1, 1)}
+             for n in range(5)])
+        cursor = self.EmptyModel.collection.find().sort('_id')
+        chunks = list(cursor.iter_json(size=2))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual([document['_id'] for document in
+                          json.loads(''.join(chunks))], list(range(5)))
+        self.assertEqual(json.loads(''.join(chunks))[0]['when'],
+                         '2020-01-01T00:00:00Z')
+        lines = ''.join(self.EmptyModel.collection.find(
+            inflate=False).sort('_id').iter_json(ndjson=True)).splitlines()
+        self.assertEqual([json.loads(line)['_id'] for line in lines],
+                         list(range(5)))
+        empty = self.EmptyModel.collection.find({'_id': 'nope'})
+        self.assertEqual(''.join(empty.iter_json()), '[]')
+        aggregated = self.EmptyModel.collection.aggregate(
+            [{'$sort': {'_id': -1}}, {'$limit': 2}])
+        self.assertEqual([document['_id'] for document in
+                          json.loads(''.join(aggregated.iter_json()))],
+                         [4, 3])
+
+    def test_pipeline(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(10)])
+        for ahead in (False, True):
+            cursor = (self.EmptyModel.collection.find().sort('n')
+                      .batch_size(3).pipeline(depth=1, inflate=ahead))
+            instances = list(cursor)
+            self.assertEqual([instance.n for instance in instances],
+                             list(range(10)))
+            for instance in instances:
+                self.assertIsInstance(instance, self.EmptyModel)
+            self.assertRaises(StopIteration, next, cursor)
+        raw = self.EmptyModel.collection.find(inflate=False).pipeline()
+        documents = list(raw)
+        self.assertEqual(len(documents), 10)
+        self.assertIs(type(documents[0]), dict)
+
+    def test_pipeline_alive(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(10)])
+        for depth in (1, 4):
+            cursor = (self.EmptyModel.collection.find().sort('n')
+                      .batch_size(3).pipeline(depth=depth))
+            instances = [next(cursor)]
+            if depth == 4:  # the rest is queued, and pymongo is done
+                cursor._fetcher.join(5)
+            while cursor.alive:
+                instances.append(next(cursor))
+            self.assertEqual([instance.n for instance in instances],
+                             list(range(10)))
+
+    def test_pipeline_close(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(10)])
+        cursor = (self.EmptyModel.collection.find().sort('n').batch_size(2)
+                  .pipeline(depth=1))
+        with cursor:
+            for instance in cursor:
+                if instance.n == 2:
+                    break
+        fetcher = cursor._fetcher
+        self.assertIsNone(fetcher)
+        self.assertFalse(cursor.alive)
+        self.assertRaises(StopIteration, next, cursor)
+        cursor = (self.EmptyModel.collection.find().batch_size(2)
+                  .pipeline(depth=1))
+        next(cursor)
+        fetcher = cursor._fetcher
+        del cursor
+        fetcher.join(5)
+        self.assertFalse(fetcher.is_alive(), 'goes with the cursor')
+
+    def test_pipeline_rewind(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(5)])
+        cursor = (self.EmptyModel.collection.find().sort('n').batch_size(2)
+                  .pipeline())
+        self.assertEqual(next(cursor).n, 0)
+        cursor.rewind()
+        self.assertEqual([instance.n for instance in cursor], list(range(5)))
+
+    def test_pipeline_error(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(5)])
+        cursor = self.EmptyModel.collection.find().batch_size(2).pipeline()
+
+        def broken(*args, **kwargs):
+            raise pymongo.errors.OperationFailure('lost the cursor')
+        cursor._fetch_batch = broken  # before the fetcher starts
+        self.assertRaises(pymongo.errors.OperationFailure, next, cursor)
+        self.assertRaises(StopIteration, next, cursor)
+
+    def test_page(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'_id': n} for n in range(10)])
+        collection = self.EmptyModel.collection
+
+        def ids(page):
+            return [instance['_id'] for instance in page]
+        first = collection.page(size=4)
+        self.assertEqual(ids(first), [0, 1, 2, 3])
+        self.assertIsNone(first.previous_token)
+        self.assertIsInstance(first[0], self.EmptyModel)
+        second = collection.page(size=4, token=first.next_token)
+        self.assertEqual(ids(second), [4, 5, 6, 7])
+        last = collection.page(size=4, token=second.next_token)
+        self.assertEqual(ids(last), [8, 9])
+        self.assertIsNone(last.next_token)
+        back = collection.page(size=4, token=last.previous_token)
+        self.assertEqual(ids(back), [4, 5, 6, 7])
+        back = collection.page(size=4, token=back.previous_token)
+        self.assertEqual(ids(back), [0, 1, 2, 3])
+        self.assertIsNone(back.previous_token)
+
+    def test_pages_sort(self):
+        self.EmptyModel.collection.raw().insert_many(
+            [{'_id': n, 'group': n % 3} for n in range(9)])
+        pages = list(self.EmptyModel.collection.pages(
+            {'_id': {'$ne': 4}}, size=3, sort=[('group', -1)]))
+        self.assertEqual([[instance['_id'] for instance in page]
+                          for page in pages],
+                         [[2, 5, 8], [1, 7, 0], [3, 6]])
+
+    def test_page_token_checks(self):
+        collection = self.EmptyModel.collection
+        collection.raw().insert_many([{'_id': n, 'a': n} for n in range(3)])
+        token = collection.page(size=1).next_token
+        self.assertRaises(ValueError, collection.page, token='nonsense')
+        self.assertRaises(ValueError, collection.page, sort='a', token=token)
+
     def test_raw_collection(self):
         self.EmptyModel().save()
         self.connection.fsync()
@@ -408,6 +2244,12 @@ class TestModelCollection(unittest.TestCase):
         assert isinstance(out, dict)
         assert not isinstance(out, self.EmptyModel)
 
+    def test_raw_collection_cached(self):
+        raw = self.EmptyModel.collection.raw()
+        self.assertIs(raw, self.EmptyModel.collection.raw())
+        self.assertEqual(raw.full_name, self.EmptyModel.collection.full_name)
+        assert not isinstance(raw, kale.Collection)
+
     def test_sub_subclass_type(self):
         class SubSubModel(self.EmptyModel):
             _collection_name = 'test_subnode'
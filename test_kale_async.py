@@ -0,0 +1,136 @@
+import sys
+import asyncio
+import unittest
+import pymongo
+import kale
+import kale_async
+
+
+class TestAsyncModel(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.connection = pymongo.MongoClient()
+        self.database_name = 'kale_testing_database'
+
+        class AsyncEmptyModel(kale_async.AsyncModel):
+            _database = self.connection[self.database_name]
+            _collection_name = 'empty_models'
+
+        self.AsyncEmptyModel = AsyncEmptyModel
+
+    def tearDown(self):
+        self.loop.close()
+        self.connection.drop_database(self.database_name)
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_base_model(self):
+        self.assertRaises(TypeError, kale_async.AsyncModel)
+
+    def test_save(self):
+        instance = self.AsyncEmptyModel({'a': 1})
+        _id = self.wait(instance.save())
+        self.assertEqual(instance._id, _id)
+        instance.a = 2
+        self.wait(instance.save())
+        stored = self.AsyncEmptyModel.collection.raw().find_one(_id)
+        self.assertEqual(stored, {'_id': _id, 'a': 2})
+
+    def test_insert_and_remove(self):
+        instance = self.AsyncEmptyModel()
+        self.wait(instance.insert())
+        self.assertEqual(self.AsyncEmptyModel.collection.count(), 1)
+        self.wait(instance.remove())
+        self.assertEqual(self.AsyncEmptyModel.collection.count(), 0)
+        assert not instance.is_in_db()
+
+    def test_wronglevel_remove(self):
+        instance = self.AsyncEmptyModel()
+        with self.assertRaises(kale.WrongLevel):
+            self.wait(instance.remove({'_id': '1234'}))
+
+    def test_save_many(self):
+        instances = [self.AsyncEmptyModel({'n': n}) for n in range(5)]
+        ids = self.wait(self.AsyncEmptyModel.save_many(instances, batch_size=2))
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(self.AsyncEmptyModel.collection.count(), 5)
+
+    def test_find_one(self):
+        instance = self.AsyncEmptyModel()
+        _id = self.wait(instance.save())
+        found = self.wait(self.AsyncEmptyModel.async_collection.find_one(_id))
+        self.assertIs(found, instance)
+
+    def test_async_for(self):
+        self.AsyncEmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(7)])
+
+        async def scan():
+            cursor = self.AsyncEmptyModel.async_collection.find(batch=3)
+            return [instance async for instance in cursor.sort('n')]
+        instances = self.wait(scan())
+        self.assertEqual([instance.n for instance in instances],
+                         list(range(7)))
+        for instance in instances:
+            self.assertIsInstance(instance, self.AsyncEmptyModel)
+
+    def test_to_list(self):
+        self.AsyncEmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(5)])
+        cursor = self.AsyncEmptyModel.async_collection.find(batch=2)
+        self.assertEqual(len(self.wait(cursor.to_list(3))), 3)
+        self.assertEqual(len(self.wait(cursor.to_list())), 2)
+
+    def test_get_batches_lookups(self):
+        ids = self.AsyncEmptyModel.collection.raw().insert_many(
+            [{'n': n} for n in range(5)]).inserted_ids
+        collection = self.AsyncEmptyModel.async_collection
+        queries = []
+        get_many = collection._get_many
+
+        def counting_get_many(batch):
+            queries.append(batch)
+            return get_many(batch)
+        collection._get_many = counting_get_many
+
+        async def lookup():
+            return await asyncio.gather(*[collection.get(_id)
+                                          for _id in ids + ['missing']])
+        found = self.wait(lookup())
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([instance.n for instance in found[:-1]],
+                         list(range(5)))
+        self.assertIsNone(found[-1])
+        again = self.wait(collection.get(ids[0]))
+        self.assertIs(again, found[0])
+        self.assertEqual(len(queries), 1, 'live instances need no query')
+
+    def test_passthrough(self):
+        collection = self.AsyncEmptyModel.async_collection
+        self.wait(collection.insert_one({'n': 1}))
+        self.assertEqual(self.wait(collection.count_documents({})), 1)
+        with self.assertRaises(AttributeError):
+            collection.lalala
+
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs contextvars')
+    def test_session(self):
+        model = self.AsyncEmptyModel
+
+        async def write(n, pause):
+            with kale.Session() as session:
+                instance = model({'n': n})
+                await instance.save()
+                await asyncio.sleep(pause)  # let the other task run
+                return len(session), model.collection.count_documents({})
+
+        async def both():
+            return await asyncio.gather(write(1, 0.05), write(2, 0.01))
+        found = self.wait(both())
+        self.assertEqual(found, [(1, 1), (1, 0)], 'a session per task')
+        self.assertEqual(model.collection.count_documents({}), 2)
+
+if __name__ == '__main__':
+    unittest.main()